@@ -0,0 +1,85 @@
+# app/analysis_cache.py
+import time
+import sqlite3
+import threading
+from typing import Optional
+
+from .db import configure
+
+STORE_SQL = ("INSERT OR REPLACE INTO analysis_cache (hash, kind, model, prompt_hash, result, created_at) "
+             "VALUES (?, ?, ?, ?, ?, ?)")
+
+# kind -> what `result` holds
+KINDS = {"vision": "VisionOutput JSON", "ocr": "OCR text"}
+
+
+class AnalysisCache:
+    """
+    Vision and OCR results by content hash, so a rescan, a new embedding model or
+    a copy of a known photo never pays for the LLM or tesseract again.
+
+    Vision rows are keyed on (hash, model, prompt hash); OCR rows on (hash, engine).
+    Lookups come from the scan's worker threads, so they use a private read
+    connection; rows are written by the scan's writer through `store()`.
+    """
+
+    def __init__(self, conn, vision_model: str = "", prompt_hash: str = "", ocr_engine: str = ""):
+        self.vision_key = (vision_model or "", prompt_hash or "")
+        self.ocr_key = (ocr_engine or "", "")
+        self.hits = {kind: 0 for kind in KINDS}
+        self.misses = {kind: 0 for kind in KINDS}
+        self._lock = threading.Lock()
+        self._conn = None
+        path = conn.execute("PRAGMA database_list").fetchone()[2]
+        if path:
+            self._conn = configure(sqlite3.connect(path, check_same_thread=False))
+
+    def _key(self, kind):
+        return self.vision_key if kind == "vision" else self.ocr_key
+
+    def get(self, kind: str, content_hash: str) -> Optional[str]:
+        if self._conn is None:
+            return None
+        model, prompt_hash = self._key(kind)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM analysis_cache WHERE hash=? AND kind=? AND model=? AND prompt_hash=?",
+                (content_hash, kind, model, prompt_hash),
+            ).fetchone()
+            if row:
+                self.hits[kind] += 1
+            else:
+                self.misses[kind] += 1
+        return row[0] if row else None
+
+    def row(self, kind: str, content_hash: str, result: str):
+        """Parameters for STORE_SQL; the scan's writer batches them."""
+        model, prompt_hash = self._key(kind)
+        return (content_hash, kind, model, prompt_hash, result, time.time())
+
+    def store(self, cur, kind: str, content_hash: str, result: str):
+        cur.execute(STORE_SQL, self.row(kind, content_hash, result))
+
+    def stats(self):
+        return {kind: {"hits": self.hits[kind], "misses": self.misses[kind]} for kind in KINDS}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def clear(conn, kind: Optional[str] = None):
+    if kind:
+        conn.execute("DELETE FROM analysis_cache WHERE kind=?", (kind,))
+    else:
+        conn.execute("DELETE FROM analysis_cache")
+    conn.commit()
+
+
+def summary(conn):
+    """Cached rows per kind and model."""
+    rows = conn.execute(
+        "SELECT kind, model, prompt_hash, COUNT(*) FROM analysis_cache GROUP BY kind, model, prompt_hash"
+    ).fetchall()
+    return [{"kind": k, "model": m, "prompt_hash": ph, "entries": n} for k, m, ph, n in rows]
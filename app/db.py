@@ -1,6 +1,13 @@
 # app/db.py
+import os
+import re
+import uuid
 import sqlite3
+import threading
 import numpy as np
+from contextlib import contextmanager
+
+from . import thumbnails
 
 # Updated Schema for Phase 1.5
 SCHEMA = """
@@ -19,22 +26,277 @@ CREATE TABLE IF NOT EXISTS memories (
     vision_status TEXT,
     embedding BLOB,
     thumbnail BLOB,
-    schema_version INTEGER DEFAULT 2
+    schema_version INTEGER DEFAULT 2,
+    vec_id INTEGER,
+    phash INTEGER,
+    dhash INTEGER,
+    cluster_id TEXT
 );
-CREATE INDEX IF NOT EXISTS idx_hash ON memories(hash);
 CREATE INDEX IF NOT EXISTS idx_path ON memories(path);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_vec_id ON memories(vec_id);
+-- Near-duplicate clusters (see perceptual.py); cluster_id is the representative's file_id
+CREATE INDEX IF NOT EXISTS idx_cluster ON memories(cluster_id);
+-- Keyset pagination for /memories: each page is a range seek on (sort column, file_id)
+-- plus one row lookup per result. The grid shows summary and tags, so no index covers it.
+CREATE INDEX IF NOT EXISTS idx_keyset_created ON memories(created_at, file_id);
+CREATE INDEX IF NOT EXISTS idx_keyset_exif ON memories(exif_date, file_id);
+CREATE INDEX IF NOT EXISTS idx_page_status_created ON memories(vision_status, created_at, file_id);
+CREATE INDEX IF NOT EXISTS idx_page_status_exif ON memories(vision_status, exif_date, file_id);
+-- Superseded by the idx_keyset_* indexes
+DROP INDEX IF EXISTS idx_exif_date;
+DROP INDEX IF EXISTS idx_page_created;
+DROP INDEX IF EXISTS idx_page_exif;
+
+CREATE TABLE IF NOT EXISTS index_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+-- Every change to a memory's vector, so a saved FAISS index can catch up by delta
+CREATE TABLE IF NOT EXISTS vector_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    vec_id INTEGER
+);
+CREATE TRIGGER IF NOT EXISTS trg_vector_log_ins AFTER INSERT ON memories
+WHEN NEW.vec_id IS NOT NULL BEGIN
+    INSERT INTO vector_log (vec_id) VALUES (NEW.vec_id);
+END;
+CREATE TRIGGER IF NOT EXISTS trg_vector_log_upd AFTER UPDATE OF embedding, vec_id ON memories BEGIN
+    INSERT INTO vector_log (vec_id) SELECT OLD.vec_id WHERE OLD.vec_id IS NOT NULL AND OLD.vec_id IS NOT NEW.vec_id;
+    INSERT INTO vector_log (vec_id) SELECT NEW.vec_id WHERE NEW.vec_id IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_vector_log_del AFTER DELETE ON memories
+WHEN OLD.vec_id IS NOT NULL BEGIN
+    INSERT INTO vector_log (vec_id) VALUES (OLD.vec_id);
+END;
+
+CREATE TABLE IF NOT EXISTS index_config (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    index_type TEXT,
+    train_threshold INTEGER,
+    nlist INTEGER,
+    pq_m INTEGER,
+    hnsw_m INTEGER,
+    nprobe INTEGER,
+    ef_search INTEGER,
+    store_dtype TEXT DEFAULT 'float32'
+);
+
+-- Thumbnails per content hash, size and format (see thumbnails.py). Kept out of
+-- memories so row scans don't page through image bytes.
+CREATE TABLE IF NOT EXISTS thumbnails (
+    hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    data BLOB,
+    PRIMARY KEY (hash, size, format)
+);
+
+-- Vision/OCR output per content hash and model/prompt (see analysis_cache.py)
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    hash TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    model TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    result TEXT,
+    created_at REAL,
+    PRIMARY KEY (hash, kind, model, prompt_hash)
+);
+
+-- Every file holding a memory's bytes. memories has one row per content hash; its
+-- path column is just one of these (see indexer.link_paths)
+CREATE TABLE IF NOT EXISTS memory_paths (
+    path TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    modified_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_memory_paths_hash ON memory_paths(hash);
+
+-- Last seen stat per path; unchanged files are skipped without reading them
+CREATE TABLE IF NOT EXISTS file_state (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    inode INTEGER,
+    partial_hash TEXT,
+    hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_file_state_partial ON file_state(size, partial_hash);
+
+-- Background scan jobs (see jobs.py) and the paths each one has finished
+CREATE TABLE IF NOT EXISTS scan_jobs (
+    job_id TEXT PRIMARY KEY,
+    root TEXT,
+    rescan INTEGER,
+    config TEXT,
+    status TEXT,
+    discovered INTEGER DEFAULT 0,
+    processed INTEGER DEFAULT 0,
+    skipped INTEGER DEFAULT 0,
+    failed INTEGER DEFAULT 0,
+    error TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+
+CREATE TABLE IF NOT EXISTS scan_checkpoints (
+    job_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (job_id, path)
+) WITHOUT ROWID;
+
+-- Cached query expansions (TEXT) and query vectors (float32 BLOB), see query_cache.py
+CREATE TABLE IF NOT EXISTS query_cache (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB,
+    created_at REAL,
+    PRIMARY KEY (kind, key)
+);
 
 CREATE TABLE IF NOT EXISTS vision_config (
     id INTEGER PRIMARY KEY CHECK (id = 1),
     endpoint_url TEXT,
     model_name TEXT,
-    api_key TEXT
+    api_key TEXT,
+    max_concurrency INTEGER DEFAULT 4,
+    max_edge INTEGER DEFAULT 1024,
+    image_format TEXT DEFAULT 'jpeg',
+    quality INTEGER DEFAULT 85
 );
 """
 
+# Text the vision model produced, flattened for full-text search
+_VISION_TEXT = """
+    CASE WHEN json_valid(NEW.vision_json) THEN
+        COALESCE(json_extract(NEW.vision_json, '$.description'), '') || ' ' ||
+        COALESCE(json_extract(NEW.vision_json, '$.activity'), '') || ' ' ||
+        COALESCE(json_extract(NEW.vision_json, '$.setting'), '') || ' ' ||
+        COALESCE(json_extract(NEW.vision_json, '$.social_context'), '') || ' ' ||
+        COALESCE(json_extract(NEW.vision_json, '$.objects'), '') || ' ' ||
+        COALESCE(json_extract(NEW.vision_json, '$.text_content'), '') || ' ' ||
+        COALESCE(json_extract(NEW.vision_json, '$.weather'), '') || ' ' ||
+        COALESCE(json_extract(NEW.vision_json, '$.time_of_day'), '')
+    END"""
+
+# BM25 index over OCR, summary, tags and vision fields. rowid = memories.vec_id,
+# which survives INSERT OR REPLACE (whose implicit delete fires no trigger).
+FTS_SCHEMA = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(
+    ocr_text, memory_summary, tags, vision_text,
+    tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS trg_fts_ins AFTER INSERT ON memories
+WHEN NEW.vec_id IS NOT NULL BEGIN
+    DELETE FROM memories_fts WHERE rowid = NEW.vec_id;
+    INSERT INTO memories_fts (rowid, ocr_text, memory_summary, tags, vision_text)
+    VALUES (NEW.vec_id, NEW.ocr_text, NEW.memory_summary, NEW.tags, {_VISION_TEXT});
+END;
+CREATE TRIGGER IF NOT EXISTS trg_fts_upd AFTER UPDATE OF ocr_text, memory_summary, tags, vision_json, vec_id ON memories BEGIN
+    DELETE FROM memories_fts WHERE rowid = OLD.vec_id;
+    INSERT INTO memories_fts (rowid, ocr_text, memory_summary, tags, vision_text)
+    SELECT NEW.vec_id, NEW.ocr_text, NEW.memory_summary, NEW.tags, {_VISION_TEXT} WHERE NEW.vec_id IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_fts_del AFTER DELETE ON memories BEGIN
+    DELETE FROM memories_fts WHERE rowid = OLD.vec_id;
+END;
+"""
+
+# bm25() column weights: ocr_text, memory_summary, tags, vision_text
+FTS_WEIGHTS = (1.0, 2.0, 2.0, 1.0)
+
+# Applied to every connection. synchronous=NORMAL is crash-safe in WAL mode (a power
+# cut can lose the last commits, never corrupt the file) and skips the fsync per commit.
+PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",   # 256 MiB of the file read through the page cache
+    "PRAGMA cache_size=-65536",     # 64 MiB page cache (negative = KiB)
+    "PRAGMA temp_store=MEMORY",
+)
+# Larger pages suit rows carrying embedding and thumbnail BLOBs; only applies to new files
+PAGE_SIZE = 8192
+
+def configure(conn):
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class ConnectionPool:
+    """
+    Connections to one mounted DB:
+    - `writer`, the scan's connection, used only by whoever holds main.scan_lock
+      (scans, scan jobs, watch batches);
+    - `write()`, a short transaction on a connection of its own for every other
+      write (settings, caches, job bookkeeping, lazily rendered thumbnails), so an
+      API request can never commit or roll back part of a scan's batch;
+    - a read-only connection per thread for the API's reads. WAL lets readers run
+      alongside the writers, so browsing never queues behind a scan's transaction.
+    `write_lock` is held for every write transaction on either connection.
+    """
+
+    def __init__(self, db_path: str, writer):
+        self.db_path = db_path
+        self.writer = writer
+        self.write_lock = threading.RLock()
+        self._api_writer = None
+        self._local = threading.local()
+        self._readers = []
+        self._lock = threading.Lock()
+
+    def reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = configure(sqlite3.connect(self.db_path, check_same_thread=False))
+            conn.execute("PRAGMA query_only=ON")
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    @contextmanager
+    def write(self, blocking: bool = True):
+        """
+        The API write connection inside one transaction, committed on exit and rolled
+        back on error. With blocking=False it yields None while another write is running.
+        """
+        if not self.write_lock.acquire(blocking):
+            yield None
+            return
+        try:
+            if self._api_writer is None:
+                self._api_writer = configure(sqlite3.connect(self.db_path, check_same_thread=False))
+            conn = self._api_writer
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        finally:
+            self.write_lock.release()
+
+    def close(self):
+        # The scan's writer belongs to whoever opened it; the readers and the API writer are closed here
+        with self._lock:
+            readers, self._readers = self._readers, []
+        with self.write_lock:
+            if self._api_writer is not None:
+                readers.append(self._api_writer)
+                self._api_writer = None
+        for conn in readers:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
 def init_db(db_path: str):
+    new = not os.path.exists(db_path) or os.path.getsize(db_path) == 0
     conn = sqlite3.connect(db_path, check_same_thread=False)
+    if new:
+        # Must precede WAL mode and the first table
+        conn.execute(f"PRAGMA page_size={PAGE_SIZE}")
     conn.execute("PRAGMA journal_mode=WAL;")
+    configure(conn)
 
     # Check for existing schema and migrate if needed
     try:
@@ -43,12 +305,162 @@ def init_db(db_path: str):
     except sqlite3.OperationalError:
         # Columns missing, run migration
         _migrate_to_phase_1_5(conn)
+    _migrate_vec_ids(conn)
 
     cur = conn.cursor()
     cur.executescript(SCHEMA)
+    _migrate_vision_config(conn)
+    _migrate_index_config(conn)
+    _migrate_thumbnails(conn)
+    _migrate_memory_paths(conn)
+    _init_fts(conn)
+    # Rows indexed before vec_id existed get their rowid as a stable vector id
+    conn.execute("UPDATE memories SET vec_id = rowid WHERE vec_id IS NULL")
+    # Identity of this DB, so an index file is never paired with another library
+    conn.execute("INSERT OR IGNORE INTO index_meta (key, value) VALUES ('db_uuid', ?)", (str(uuid.uuid4()),))
     conn.commit()
     return conn
 
+def _migrate_vec_ids(conn):
+    # Must run before SCHEMA, which indexes these columns
+    for column in ("vec_id INTEGER", "phash INTEGER", "dhash INTEGER", "cluster_id TEXT"):
+        try:
+            conn.execute(f"ALTER TABLE memories ADD COLUMN {column}")
+        except sqlite3.OperationalError: pass
+
+def _init_fts(conn):
+    # FTS5 is compiled into practically every SQLite build, but search degrades to vector-only without it
+    existed = conn.execute("SELECT 1 FROM sqlite_master WHERE name='memories_fts'").fetchone()
+    try:
+        conn.executescript(FTS_SCHEMA)
+    except sqlite3.OperationalError as e:
+        print(f"Full-text search unavailable: {e}")
+        return
+    if not existed:
+        rebuild_fts(conn)
+
+def rebuild_fts(conn):
+    conn.execute("DELETE FROM memories_fts")
+    conn.execute(f"""
+        INSERT INTO memories_fts (rowid, ocr_text, memory_summary, tags, vision_text)
+        SELECT NEW.vec_id, NEW.ocr_text, NEW.memory_summary, NEW.tags, {_VISION_TEXT}
+        FROM memories AS NEW WHERE NEW.vec_id IS NOT NULL
+    """)
+
+def has_fts(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name='memories_fts'").fetchone() is not None
+
+def fts_match_expr(query: str):
+    # Every word as a quoted term, OR-ed: recall first, bm25 ranks docs matching more terms higher
+    terms = [t for t in re.findall(r"\w+", query.lower()) if len(t) > 1]
+    return " OR ".join(f'"{t}"' for t in terms)
+
+def fts_tag_expr(tag: str):
+    # Phrase match restricted to the tags column
+    words = re.findall(r"\w+", tag.lower())
+    return f'tags : "{" ".join(words)}"' if words else ""
+
+def fts_search(conn, query: str, limit: int, clauses=(), params=()):
+    """vec_ids ranked by BM25 for the query words; optional SQL filters on memories columns."""
+    expr = fts_match_expr(query)
+    if not expr or not has_fts(conn):
+        return []
+    where = "".join(f" AND {cl}" for cl in clauses)
+    weights = ", ".join(str(w) for w in FTS_WEIGHTS)
+    try:
+        rows = conn.execute(f"""
+            SELECT memories_fts.rowid FROM memories_fts
+            JOIN memories ON memories.vec_id = memories_fts.rowid
+            WHERE memories_fts MATCH ?{where}
+            ORDER BY bm25(memories_fts, {weights})
+            LIMIT ?
+        """, (expr, *params, limit)).fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"Keyword search failed: {e}")
+        return []
+    return [r[0] for r in rows]
+
+def get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM index_meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+def vector_log_seq(conn):
+    # Last seq ever handed out (AUTOINCREMENT keeps it even after the log is pruned)
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name='vector_log'").fetchone()
+    return row[0] if row else 0
+
+def next_vec_id(conn):
+    row = conn.execute("SELECT COALESCE(MAX(vec_id), 0) + 1 FROM memories").fetchone()
+    return row[0]
+
+def _migrate_vision_config(conn):
+    # Columns added to vision_config after it was first created
+    try:
+        conn.execute("ALTER TABLE vision_config ADD COLUMN max_concurrency INTEGER DEFAULT 4")
+    except sqlite3.OperationalError: pass
+    for column in ("max_edge INTEGER DEFAULT 1024", "image_format TEXT DEFAULT 'jpeg'", "quality INTEGER DEFAULT 85"):
+        try:
+            conn.execute(f"ALTER TABLE vision_config ADD COLUMN {column}")
+        except sqlite3.OperationalError: pass
+
+def _migrate_index_config(conn):
+    try:
+        conn.execute("ALTER TABLE index_config ADD COLUMN store_dtype TEXT DEFAULT 'float32'")
+    except sqlite3.OperationalError: pass
+
+def _migrate_thumbnails(conn):
+    # Inline 256px JPEGs from memories.thumbnail move to the thumbnails table, plus a copy
+    # in the default format: lookups ask for that one, and would otherwise re-render
+    # every thumbnail from the original on first view
+    if not conn.execute("SELECT 1 FROM memories WHERE thumbnail IS NOT NULL LIMIT 1").fetchone():
+        return
+    print("Moving thumbnails out of the memories table...")
+    last = 0
+    while True:
+        rows = conn.execute(
+            "SELECT rowid, hash, thumbnail FROM memories WHERE thumbnail IS NOT NULL AND hash IS NOT NULL"
+            " AND rowid > ? ORDER BY rowid LIMIT 500", (last,)
+        ).fetchall()
+        if not rows:
+            break
+        last = rows[-1][0]
+        out = []
+        for _, h, data in rows:
+            out.append((h, 256, "jpeg", data))
+            if thumbnails.DEFAULT_FORMAT != "jpeg":
+                try:
+                    out.append((h, 256, thumbnails.DEFAULT_FORMAT, thumbnails.reencode(data, 256)))
+                except Exception:
+                    pass  # unreadable; rendered from the original when first viewed
+        conn.executemany("INSERT OR IGNORE INTO thumbnails (hash, size, format, data) VALUES (?, ?, ?, ?)", out)
+    conn.execute("UPDATE memories SET thumbnail = NULL WHERE thumbnail IS NOT NULL")
+
+def _migrate_memory_paths(conn):
+    # One memory per content hash: record every known copy as a path, merge duplicate
+    # memories into the oldest, then make hash unique
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name='idx_hash_unique'").fetchone():
+        return
+    conn.execute("""
+        INSERT OR IGNORE INTO memory_paths (path, hash, modified_at)
+        SELECT path, hash, modified_at FROM memories WHERE path IS NOT NULL AND hash IS NOT NULL
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO memory_paths (path, hash, modified_at)
+        SELECT path, hash, strftime('%Y-%m-%dT%H:%M:%S', mtime_ns / 1e9, 'unixepoch', 'localtime')
+        FROM file_state WHERE hash IN (SELECT hash FROM memories)
+    """)
+    merged = conn.execute("""
+        DELETE FROM memories WHERE hash IS NOT NULL AND rowid NOT IN
+            (SELECT MIN(rowid) FROM memories WHERE hash IS NOT NULL GROUP BY hash)
+    """).rowcount
+    if merged:
+        print(f"Merged {merged} duplicate memories")
+    conn.execute("DROP INDEX IF EXISTS idx_hash")
+    conn.execute("CREATE UNIQUE INDEX idx_hash_unique ON memories(hash)")
+
 def _migrate_to_phase_1_5(conn):
     print("Migrating DB to Phase 1.5...")
     try:
@@ -0,0 +1,73 @@
+# app/embedding.py
+import queue
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import List
+
+import numpy as np
+
+
+class EmbeddingService:
+    """
+    Wraps a SentenceTransformer so every caller gets batched, L2-normalized float32 vectors.
+
+    - `encode(texts)` runs one forward pass over a list (indexer batches, /search/batch).
+    - `submit(text)` / `aencode(text)` queue a single text; a background thread groups
+      pending texts and flushes when `batch_size` is reached or `flush_seconds` elapse,
+      so concurrent searches share a forward pass.
+    """
+
+    def __init__(self, model, dim: int = 384, batch_size: int = 64, flush_seconds: float = 0.01):
+        self.model = model
+        self.dim = dim
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._pending = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Returns an (n, dim) float32 matrix of unit-length vectors."""
+        if not texts:
+            return np.zeros((0, self.dim), dtype="float32")
+        try:
+            vecs = self.model.encode(list(texts), batch_size=self.batch_size,
+                                     convert_to_numpy=True, normalize_embeddings=True)
+            vecs = np.asarray(vecs, dtype="float32").reshape(len(texts), -1)
+        except Exception as e:
+            print(f"Embedding failed: {e}")
+            return np.zeros((len(texts), self.dim), dtype="float32")
+        # Models without a Normalize module (or mocks) still come back unit-length
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        np.divide(vecs, norms, out=vecs, where=norms > 0)
+        return vecs
+
+    # --- micro-batching for concurrent single-text callers ---
+
+    def submit(self, text: str) -> Future:
+        self._ensure_worker()
+        fut = Future()
+        self._pending.put((text, fut))
+        return fut
+
+    async def aencode(self, text: str) -> np.ndarray:
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get(timeout=self.flush_seconds))
+                except queue.Empty:
+                    break
+            vecs = self.encode([text for text, _ in batch])
+            for (_, fut), vec in zip(batch, vecs):
+                fut.set_result(vec)
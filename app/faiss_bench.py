@@ -0,0 +1,117 @@
+# app/faiss_bench.py
+"""
+Recall-vs-latency report for the FAISS index types, measured against the exact
+flat index on the library's own embeddings.
+
+    python -m app.faiss_bench path/to/.memory_index.db
+    python -m app.faiss_bench --synthetic 200000
+"""
+import sys
+import time
+import sqlite3
+from typing import List, Optional
+
+import numpy as np
+
+from .faiss_mgr import FaissManager, IndexConfig
+
+DEFAULT_CONFIGS = [
+    IndexConfig(index_type="hnsw", ef_search=32),
+    IndexConfig(index_type="hnsw", ef_search=128),
+    IndexConfig(index_type="ivf_flat", nprobe=8),
+    IndexConfig(index_type="ivf_flat", nprobe=32),
+    IndexConfig(index_type="ivf_pq", nprobe=16),
+    IndexConfig(index_type="ivf_pq", nprobe=64),
+    IndexConfig(index_type="sq8"),
+    IndexConfig(index_type="sq_fp16"),
+]
+
+
+def load_vectors(conn, dim):
+    rows = conn.execute(
+        "SELECT vec_id, embedding FROM memories WHERE vec_id IS NOT NULL AND length(embedding) = ?", (dim * 4,)
+    ).fetchall()
+    ids = np.array([r[0] for r in rows], dtype="int64")
+    mat = np.frombuffer(b"".join(r[1] for r in rows), dtype="float32").reshape(-1, dim)
+    return ids, mat
+
+
+def synthetic_vectors(n, dim, seed=0):
+    # Clustered unit vectors, closer to real embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 500), dim)).astype("float32")
+    mat = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.standard_normal((n, dim)).astype("float32")
+    mat /= np.linalg.norm(mat, axis=1, keepdims=True)
+    return np.arange(1, n + 1, dtype="int64"), mat
+
+
+def _run(mgr, queries, k):
+    found, times = [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        hits = mgr.search(q, topk=k)
+        times.append((time.perf_counter() - t0) * 1000)
+        found.append({h["vec_id"] for h in hits})
+    return found, np.array(times)
+
+
+def benchmark(conn, dim, configs: Optional[List[IndexConfig]] = None, n_queries=200, k=10, vectors=None):
+    """
+    Builds every config (forcing it regardless of train_threshold) and reports
+    build time, mean/p99 query latency and recall@k against the flat baseline.
+    """
+    ids, mat = vectors if vectors is not None else load_vectors(conn, dim)
+    if len(ids) == 0:
+        return []
+    rng = np.random.default_rng(1)
+    # Queries: perturbed library vectors, so there is a meaningful neighbourhood
+    queries = mat[rng.choice(len(mat), min(n_queries, len(mat)), replace=False)]
+    queries = queries + 0.05 * rng.standard_normal(queries.shape).astype("float32")
+
+    report = []
+    baseline = None
+    for cfg in [IndexConfig(index_type="flat")] + list(configs or DEFAULT_CONFIGS):
+        cfg = cfg.model_copy(update={"train_threshold": 0})
+        mgr = FaissManager(dim, cfg)
+        t0 = time.perf_counter()
+        try:
+            mgr._build(ids, mat)
+        except Exception as e:
+            report.append({**cfg.model_dump(), "error": str(e)})
+            continue
+        build_s = time.perf_counter() - t0
+        found, times = _run(mgr, queries, k)
+        if baseline is None:
+            baseline = found
+        recall = np.mean([len(f & b) / max(1, len(b)) for f, b in zip(found, baseline)])
+        report.append({
+            "index_type": cfg.index_type,
+            "nprobe": cfg.nprobe if cfg.index_type.startswith("ivf") else None,
+            "ef_search": cfg.ef_search if cfg.index_type == "hnsw" else None,
+            "vectors": int(len(ids)),
+            "build_s": round(build_s, 3),
+            "mean_ms": round(float(times.mean()), 3),
+            "p99_ms": round(float(np.percentile(times, 99)), 3),
+            f"recall@{k}": round(float(recall), 4),
+        })
+    return report
+
+
+def _print(report):
+    if not report:
+        print("No vectors to benchmark.")
+        return
+    cols = [c for c in report[0].keys()]
+    print(" | ".join(cols))
+    for row in report:
+        print(" | ".join(str(row.get(c, "")) for c in cols))
+
+
+if __name__ == "__main__":
+    dim = 384
+    if len(sys.argv) > 2 and sys.argv[1] == "--synthetic":
+        _print(benchmark(None, dim, vectors=synthetic_vectors(int(sys.argv[2]), dim)))
+    elif len(sys.argv) > 1:
+        _print(benchmark(sqlite3.connect(sys.argv[1]), dim))
+    else:
+        print(__doc__)
@@ -1,60 +1,430 @@
 # app/faiss_mgr.py
+import os
+import json
+from typing import Optional
+
 import faiss
 import numpy as np
+from pydantic import BaseModel
+
+from .db import get_meta, set_meta, vector_log_seq
+from .vector_store import EmbeddingStore, CHUNK_ROWS, dequantize
+
+# Bump when the on-disk layout of the index/meta files changes
+INDEX_FORMAT_VERSION = 3
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "sq8", "sq_fp16")
+# IVF indexes store ids in their inverted lists, so they are not wrapped in IDMap2
+IVF_TYPES = ("ivf_flat", "ivf_pq")
+
+def index_path_for(db_path: str) -> str:
+    # .memory_index.db -> .memory_index.faiss (meta lives in .memory_index.faiss.json)
+    return os.path.splitext(db_path)[0] + ".faiss"
+
+
+class IndexConfig(BaseModel):
+    """Which FAISS index to build, and its build/search knobs."""
+    index_type: str = "flat"          # one of INDEX_TYPES
+    train_threshold: int = 20000      # below this many vectors the index stays exact (flat)
+    nlist: Optional[int] = None       # IVF lists; defaults to ~sqrt(n)
+    pq_m: int = 48                    # IVF-PQ sub-quantizers (must divide the dimension)
+    hnsw_m: int = 32                  # HNSW graph degree
+    nprobe: int = 16                  # IVF lists visited per query
+    ef_search: int = 64               # HNSW candidate list size per query
+    store_dtype: str = "float32"      # embedding store on disk: one of vector_store.STORE_DTYPES
+
+
+def load_index_config(conn) -> IndexConfig:
+    row = conn.execute(
+        "SELECT index_type, train_threshold, nlist, pq_m, hnsw_m, nprobe, ef_search, store_dtype FROM index_config WHERE id=1"
+    ).fetchone()
+    if not row:
+        return IndexConfig()
+    keys = ["index_type", "train_threshold", "nlist", "pq_m", "hnsw_m", "nprobe", "ef_search", "store_dtype"]
+    return IndexConfig(**{k: v for k, v in zip(keys, row) if v is not None})
+
 
 class FaissManager:
-    def __init__(self, dim):
+    """
+    Vector index keyed by `memories.vec_id` (a stable integer per memory), through
+    IndexIDMap2 or the IVF lists' own ids, so single rows can be added, replaced or
+    removed in place.
+    A full rebuild from SQLite only happens on request or when `is_consistent` fails.
+
+    The underlying index is Flat, HNSW, IVF-Flat, IVF-PQ or a scalar-quantized flat
+    index (SQ8 / SQfp16, 4x / 2x smaller than Flat; see IndexConfig). Libraries
+    smaller than `train_threshold` always use Flat; crossing it triggers a (trained) rebuild.
+    HNSW cannot remove vectors, so removals there become tombstones filtered at search time,
+    re-added ids go to a small Flat `delta` index, and both are folded in by `compact()`.
+
+    With a `store` (EmbeddingStore), rebuilds read the memory-mapped embedding matrix
+    instead of the memories table.
+    """
+
+    def __init__(self, dim, config: IndexConfig = None, store: Optional[EmbeddingStore] = None):
         self.dim = dim
-        self.index = faiss.IndexFlatL2(dim)
-        self.ids = []  # list of tuples (file_id, path)
+        self.config = config or IndexConfig()
+        self.store = store
+        self.kind = "flat"
+        self.index = self._new_index("flat", 0)
+        self.delta = None
+        self.tombstones = set()
+        # Last vector_log seq reflected in self.index
+        self.synced_seq = 0
+        # seq of the saved file self.index matches; None once it was rebuilt or never saved
+        self.saved_seq = None
+        # Set while self.index is memory-mapped from a saved file
+        self.mapped_path = None
+
+    # --- construction ---
+
+    def _nlist(self, n):
+        return self.config.nlist or int(min(65536, max(16, np.sqrt(max(n, 1)))))
+
+    def target_kind(self, n):
+        if self.config.index_type not in INDEX_TYPES or n < self.config.train_threshold:
+            return "flat"
+        return self.config.index_type
+
+    def _new_index(self, kind, n):
+        spec = {
+            "flat": "Flat",
+            "hnsw": f"HNSW{self.config.hnsw_m}",
+            "ivf_flat": f"IVF{self._nlist(n)},Flat",
+            "ivf_pq": f"IVF{self._nlist(n)},PQ{self.config.pq_m}",
+            "sq8": "SQ8",
+            "sq_fp16": "SQfp16",
+        }[kind]
+        # IDMap2 around IVF breaks on remove_ids (its id table goes out of step with the lists)
+        return faiss.index_factory(self.dim, spec if kind in IVF_TYPES else "IDMap2," + spec)
+
+    def _build(self, ids, mat):
+        # mat may be a memory-mapped float16/int8 store; it is converted chunk by chunk,
+        # so peak memory stays at the index itself plus one chunk
+        kind = self.target_kind(len(ids))
+        index = self._new_index(kind, len(ids))
+        if len(ids):
+            if not index.is_trained:
+                # ~100 points per centroid is plenty for k-means; more only slows training
+                cap = 100 * self._nlist(len(ids))
+                if len(mat) > cap:
+                    sample = dequantize(mat[np.sort(np.random.default_rng(0).choice(len(mat), cap, replace=False))])
+                else:
+                    sample = dequantize(mat)
+                index.train(sample)
+            for i in range(0, len(ids), CHUNK_ROWS):
+                index.add_with_ids(dequantize(mat[i:i + CHUNK_ROWS]), np.asarray(ids[i:i + CHUNK_ROWS], dtype="int64"))
+        self.index, self.kind = index, kind
+        self.delta = None
+        self.tombstones = set()
+        self.mapped_path = None
+        self.saved_seq = None
 
     def reset(self):
-        self.index = faiss.IndexFlatL2(self.dim)
-        self.ids = []
+        self._build([], np.zeros((0, self.dim), dtype="float32"))
 
     def build_from_db(self, conn):
+        if self.store is not None:
+            try:
+                ids, mat = self.store.sync(conn)
+                self.synced_seq = self.store.seq
+                self._build(ids, mat)
+                return
+            except Exception as e:
+                print(f"Embedding store unavailable ({e}), reading vectors from the DB")
+        self.synced_seq = vector_log_seq(conn)
+        # One preallocated matrix filled in chunks, instead of a list of rows plus a vstack copy
+        n = conn.execute("SELECT COUNT(*) FROM memories WHERE vec_id IS NOT NULL AND length(embedding) = ?",
+                         (self.dim * 4,)).fetchone()[0]
+        ids = np.empty(n, dtype="int64")
+        mat = np.empty((n, self.dim), dtype="float32")
         c = conn.cursor()
-        c.execute("SELECT file_id, path, embedding FROM memories")
-        rows = c.fetchall()
-        vecs = []
-        self.ids = []
-        for fid, path, emb_blob in rows:
-            if emb_blob:
-                arr = np.frombuffer(emb_blob, dtype=np.float32)
-                if arr.size == self.dim:
-                    vecs.append(arr)
-                    self.ids.append((fid, path))
-        if vecs:
-            mat = np.vstack(vecs).astype("float32")
-            self.index.reset()
-            self.index.add(mat)
+        c.execute("SELECT vec_id, embedding FROM memories WHERE vec_id IS NOT NULL AND length(embedding) = ?", (self.dim * 4,))
+        pos = 0
+        while pos < n:
+            rows = c.fetchmany(min(CHUNK_ROWS, n - pos))
+            if not rows:
+                break
+            ids[pos:pos + len(rows)] = [r[0] for r in rows]
+            mat[pos:pos + len(rows)] = np.frombuffer(b"".join(r[1] for r in rows), dtype="float32").reshape(-1, self.dim)
+            pos += len(rows)
+        self._build(ids[:pos], mat[:pos])
+
+    def _unmap(self):
+        """Moves a memory-mapped index into RAM, before it is modified or its file replaced."""
+        if not self.mapped_path:
+            return
+        if self.kind in IVF_TYPES:
+            # Mapped IVF lists are read-only and can't be cloned; nothing has changed them yet
+            self.index = faiss.read_index(self.mapped_path)
         else:
-            self.reset()
+            self.index = faiss.clone_index(self.index)
+        self.mapped_path = None
+
+    def _as_matrix(self, vecs):
+        return np.ascontiguousarray(np.asarray(vecs, dtype="float32").reshape(-1, self.dim))
+
+    # --- incremental updates ---
 
-    def add_vector(self, vec, id_tuple):
-        # vec: numpy float32 vector
-        if vec is None:
+    @property
+    def supports_remove(self):
+        return self.kind != "hnsw"
+
+    def add(self, vec_ids, vecs):
+        """Adds vectors for ids that are not in the index yet."""
+        if len(vec_ids) == 0:
+            return
+        ids = np.asarray(vec_ids, dtype="int64")
+        mat = self._as_matrix(vecs)
+        if self.kind in IVF_TYPES:
+            self._unmap()
+        if self.supports_remove or not self.tombstones:
+            self.index.add_with_ids(mat, ids)
             return
-        if hasattr(vec, "reshape"):
-            arr = np.array(vec).astype("float32").reshape(1, -1)
+        # Ids whose old vector is still in the HNSW graph go to the delta index
+        stale = np.isin(ids, np.fromiter(self.tombstones, dtype="int64"))
+        if (~stale).any():
+            self.index.add_with_ids(mat[~stale], ids[~stale])
+        if stale.any():
+            if self.delta is None:
+                self.delta = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+            self.delta.add_with_ids(mat[stale], ids[stale])
+
+    def remove(self, vec_ids):
+        if len(vec_ids) == 0:
+            return 0
+        ids = np.asarray(vec_ids, dtype="int64")
+        removed = 0
+        if self.delta is not None and self.delta.ntotal:
+            removed += self.delta.remove_ids(ids)
+        if self.supports_remove:
+            if self.index.ntotal:
+                if self.kind in IVF_TYPES:
+                    self._unmap()
+                removed += self.index.remove_ids(ids)
         else:
-            arr = np.array(vec, dtype="float32").reshape(1, -1)
-        if self.index.ntotal == 0:
-            self.index.add(arr)
-            self.ids.append(id_tuple)
+            present = np.isin(ids, self._main_ids())
+            self.tombstones.update(int(i) for i in ids[present])
+            removed += int(present.sum())
+        return removed
+
+    def update(self, vec_ids, vecs):
+        """Replaces (or inserts) vectors for the given ids."""
+        self.remove(vec_ids)
+        self.add(vec_ids, vecs)
+
+    def compact(self):
+        """Folds HNSW tombstones and the delta index back into one graph."""
+        if not self.tombstones and self.delta is None:
+            return
+        ids = self._main_ids()
+        mat = self.index.index.reconstruct_n(0, self.index.ntotal) if self.index.ntotal else np.zeros((0, self.dim), dtype="float32")
+        keep = ~np.isin(ids, np.fromiter(self.tombstones, dtype="int64"))
+        ids, mat = ids[keep], mat[keep]
+        if self.delta is not None and self.delta.ntotal:
+            ids = np.concatenate([ids, faiss.vector_to_array(self.delta.id_map)])
+            mat = np.vstack([mat, self.delta.index.reconstruct_n(0, self.delta.ntotal)])
+        self._build(ids, np.ascontiguousarray(mat, dtype="float32"))
+
+    # --- bookkeeping ---
+
+    def _main_ids(self):
+        if self.kind not in IVF_TYPES:
+            return faiss.vector_to_array(self.index.id_map)
+        invlists = faiss.extract_index_ivf(self.index).invlists
+        parts = []
+        for list_no in range(invlists.nlist):
+            size = invlists.list_size(list_no)
+            if size:
+                ptr = invlists.get_ids(list_no)
+                parts.append(faiss.rev_swig_ptr(ptr, size).copy())
+                invlists.release_ids(list_no, ptr)
+        return np.concatenate(parts) if parts else np.zeros(0, dtype="int64")
+
+    def ids(self):
+        ids = self._main_ids()
+        if self.tombstones:
+            ids = ids[~np.isin(ids, np.fromiter(self.tombstones, dtype="int64"))]
+        if self.delta is not None and self.delta.ntotal:
+            ids = np.concatenate([ids, faiss.vector_to_array(self.delta.id_map)])
+        return ids
+
+    def count(self):
+        n = self.index.ntotal - len(self.tombstones)
+        return n + (self.delta.ntotal if self.delta is not None else 0)
+
+    def is_consistent(self, conn):
+        # Same set of ids as the rows that carry a usable embedding
+        c = conn.cursor()
+        c.execute("SELECT vec_id FROM memories WHERE vec_id IS NOT NULL AND length(embedding) = ?", (self.dim * 4,))
+        db_ids = np.fromiter((r[0] for r in c), dtype="int64")
+        if db_ids.size != self.count():
+            return False
+        return bool(np.array_equal(np.sort(db_ids), np.sort(self.ids())))
+
+    def sync(self, conn):
+        """
+        Rebuilds only if the index drifted from the DB, or the library crossed
+        `train_threshold` so a different index type applies. Returns True if a rebuild ran.
+        """
+        if self.target_kind(self.count()) != self.kind:
+            print(f"Switching FAISS index {self.kind} -> {self.target_kind(self.count())}, rebuilding...")
+        elif self.is_consistent(conn):
+            return False
         else:
-            # append to index. IndexFlatL2 supports add
-            self.index.add(arr)
-            self.ids.append(id_tuple)
+            print("FAISS index out of sync with DB, rebuilding...")
+        self.build_from_db(conn)
+        return True
+
+    def catch_up(self, conn):
+        """
+        Applies vector changes logged since `synced_seq` (adds, re-embeds, deletes).
+        Idempotent, so it is safe after incremental adds that were already applied.
+        Returns the number of ids touched.
+        """
+        head = vector_log_seq(conn)
+        if head <= self.synced_seq:
+            return 0
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT vec_id FROM vector_log WHERE seq > ? AND seq <= ?", (self.synced_seq, head))
+        changed = [r[0] for r in c.fetchall()]
+        present_ids, present_vecs = [], []
+        for i in range(0, len(changed), 500):
+            chunk = changed[i:i + 500]
+            c.execute(f"SELECT vec_id, embedding FROM memories WHERE vec_id IN ({','.join('?' * len(chunk))})", chunk)
+            for vec_id, emb_blob in c.fetchall():
+                if emb_blob and len(emb_blob) == self.dim * 4:
+                    present_ids.append(vec_id)
+                    present_vecs.append(np.frombuffer(emb_blob, dtype=np.float32))
+        self.remove(changed)
+        self.add(present_ids, present_vecs)
+        self.synced_seq = head
+        return len(changed)
+
+    # --- persistence ---
 
-    def search(self, qvec, topk=10):
-        if self.index.ntotal == 0:
+    def save(self, path, conn):
+        """
+        Writes the index plus a meta file tying it to this DB and log position.
+        Skipped (returns False) when the saved file already matches: no logged changes
+        since it was written or loaded, and no rebuild or compaction since.
+        """
+        self.catch_up(conn)
+        self.compact()
+        if self.saved_seq is not None and self.synced_seq <= self.saved_seq:
+            return False
+        # Detach from the mapped file first; Windows refuses to replace a mapped file
+        self._unmap()
+        tmp = path + ".tmp"
+        faiss.write_index(self.index, tmp)
+        os.replace(tmp, path)
+        meta = {
+            "version": INDEX_FORMAT_VERSION,
+            "db_uuid": get_meta(conn, "db_uuid"),
+            "seq": self.synced_seq,
+            "dim": self.dim,
+            "kind": self.kind,
+            "ntotal": int(self.index.ntotal),
+        }
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".json.tmp", path + ".json")
+        # The saved file covers everything up to seq; older log rows are no longer needed,
+        # except by an embedding store that still has to catch up from them
+        prune = self.synced_seq
+        if self.store is not None and self.store.seq is not None:
+            prune = min(prune, self.store.seq)
+        conn.execute("DELETE FROM vector_log WHERE seq <= ?", (prune,))
+        set_meta(conn, "log_pruned_seq", prune)
+        conn.commit()
+        self.saved_seq = self.synced_seq
+        return True
+
+    def load(self, path, conn):
+        """
+        Memory-maps a saved index and catches it up from vector_log.
+        Returns False if the file is missing, belongs to another DB, is older than the log,
+        or was built as a different index type than the config now asks for.
+        """
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (meta.get("version") != INDEX_FORMAT_VERSION or meta.get("dim") != self.dim
+                or meta.get("db_uuid") != get_meta(conn, "db_uuid")):
+            return False
+        if meta.get("kind") != self.target_kind(meta["ntotal"]):
+            return False
+        # Changes between the file and the oldest remaining log row were pruned: can't catch up
+        if meta["seq"] < int(get_meta(conn, "log_pruned_seq", 0)):
+            return False
+        mapped = path
+        try:
+            index = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+        except Exception:
+            mapped = None
+            try:
+                index = faiss.read_index(path)
+            except Exception as e:
+                print(f"Failed to read FAISS index {path}: {e}")
+                return False
+        if index.ntotal != meta["ntotal"] or index.d != self.dim:
+            return False
+        self.index = index
+        self.kind = meta["kind"]
+        self.delta = None
+        self.tombstones = set()
+        self.mapped_path = mapped
+        self.synced_seq = self.saved_seq = meta["seq"]
+        changed = self.catch_up(conn)
+        if changed:
+            print(f"FAISS index caught up {changed} changed vectors")
+        return True
+
+    # --- search ---
+
+    def _search_params(self, allowed_ids=None):
+        # Returns the params plus the selector objects, which must outlive the search call
+        keep = []
+        sel = None
+        if allowed_ids is not None:
+            keep.append(faiss.IDSelectorBatch(np.asarray(allowed_ids, dtype="int64")))
+            sel = keep[-1]
+        if self.tombstones:
+            keep.append(faiss.IDSelectorBatch(np.fromiter(self.tombstones, dtype="int64")))
+            keep.append(faiss.IDSelectorNot(keep[-1]))
+            if sel is not None:
+                keep.append(faiss.IDSelectorAnd(sel, keep[-1]))
+            sel = keep[-1]
+        if self.kind == "hnsw":
+            return faiss.SearchParametersHNSW(efSearch=self.config.ef_search, sel=sel), keep
+        if self.kind in ("ivf_flat", "ivf_pq"):
+            return faiss.SearchParametersIVF(nprobe=self.config.nprobe, sel=sel), keep
+        return (faiss.SearchParameters(sel=sel) if sel is not None else None), keep
+
+    def search(self, qvec, topk=10, allowed_ids=None):
+        """
+        Nearest vec_ids to qvec. `allowed_ids` restricts the search to a subset
+        (e.g. rows matching a SQL date filter) instead of post-filtering the top k.
+        """
+        if self.count() == 0:
+            return []
+        if allowed_ids is not None and len(allowed_ids) == 0:
             return []
-        D, I = self.index.search(np.array([qvec]).astype("float32"), topk)
+        q = self._as_matrix(qvec)
+        params, _keep = self._search_params(allowed_ids)
+        D, I = self.index.search(q, topk, params=params)
+        hits = list(zip(D[0], I[0]))
+        if self.delta is not None and self.delta.ntotal:
+            dparams = None
+            if allowed_ids is not None:
+                dparams = faiss.SearchParameters(sel=_keep[0])
+            dD, dI = self.delta.search(q, topk, params=dparams)
+            hits = sorted(hits + list(zip(dD[0], dI[0])), key=lambda h: h[0])[:topk]
         results = []
-        for dist, idx in zip(D[0], I[0]):
-            if idx == -1:
+        for dist, vec_id in hits:
+            if vec_id == -1:
                 continue
-            fid, path = self.ids[idx]
-            results.append({"file_id": fid, "path": path, "score": float(dist)})
+            results.append({"vec_id": int(vec_id), "score": float(dist)})
         return results
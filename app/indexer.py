@@ -1,20 +1,45 @@
 # app/indexer.py
 import os
+import time
 import hashlib
 import io
 import uuid
-import asyncio
+import threading
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from PIL import Image, ImageOps
-import pytesseract
-import numpy as np
 from tqdm import tqdm
-from .db import row_to_dict
+from .db import next_vec_id
+from .pipeline import Pipeline, PipelineConfig
+from .embedding import EmbeddingService
+from .analysis_cache import AnalysisCache, STORE_SQL as CACHE_SQL
+from .writer import BatchWriter
+from .vision.contract import VisionOutput
+from . import thumbnails, perceptual, ocr
 from datetime import datetime
-import json
+from collections import namedtuple
 
 SUPPORTED_EXT = {".jpg", ".jpeg", ".png", ".webp", ".tiff", ".tif", ".gif"}
-THUMB_SIZE = (256, 256)
+PARTIAL_BLOCK = 64 * 1024
+# Largest edge any derivative needs: OCR input. The vision copy is smaller still.
+OCR_MAX_EDGE = 2048
+VISION_MAX_EDGE = 1024
+# Cache key for OCR results: a different engine or input size gives different text
+OCR_ENGINE = f"tesseract@{OCR_MAX_EDGE}"
+
+MEMORY_SQL = """
+    INSERT OR REPLACE INTO memories
+    (file_id, path, hash, created_at, modified_at, exif_date, ocr_text, caption, memory_summary, tags, vision_json, vision_status, embedding, vec_id,
+     phash, dhash, cluster_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+FILE_STATE_SQL = "INSERT OR REPLACE INTO file_state (path, size, mtime_ns, inode, partial_hash, hash) VALUES (?, ?, ?, ?, ?, ?)"
+
+# What the walker learns from metadata alone; compared with file_state to skip unchanged files
+FileStat = namedtuple("FileStat", "path size mtime_ns inode")
 
 def file_hash(path: Path):
     h = hashlib.sha256()
@@ -23,27 +48,83 @@ def file_hash(path: Path):
             h.update(chunk)
     return h.hexdigest()
 
-def make_thumbnail_bytes(path: Path, size=THUMB_SIZE):
-    try:
-        im = Image.open(path)
-        im = ImageOps.exif_transpose(im)
-        im.thumbnail(size)
-        buf = io.BytesIO()
-        im.convert("RGB").save(buf, format="JPEG", quality=85)
-        return buf.getvalue()
-    except Exception:
-        # generate blank
-        im = Image.new("RGB", size, (100,100,100))
-        buf = io.BytesIO()
-        im.save(buf, format="JPEG", quality=85)
-        return buf.getvalue()
-
-def do_ocr(path: Path):
-    try:
-        txt = pytesseract.image_to_string(str(path))
-        return txt
-    except Exception:
-        return ""
+def partial_hash(path: Path, size: int, block=PARTIAL_BLOCK):
+    """Size plus the first and last block. Cheap fingerprint used to recognise moved files."""
+    h = hashlib.sha1(str(size).encode())
+    with open(path, "rb") as f:
+        h.update(f.read(block))
+        if size > 2 * block:
+            f.seek(-block, os.SEEK_END)
+            h.update(f.read(block))
+        elif size > block:
+            h.update(f.read())
+    return h.hexdigest()
+
+def encode_image(im, fmt="JPEG", quality=85):
+    buf = io.BytesIO()
+    im.save(buf, format=fmt, quality=quality)
+    return buf.getvalue()
+
+class ImageContext:
+    """
+    One read and one decode per file. `data` is the byte string the hash stage
+    already read; the image is decoded once (JPEG draft mode decodes at 1/2..1/8
+    scale when that still covers `max_edge`) and the thumbnails, OCR input and
+    downscaled vision copy are all cut from that decode.
+    """
+
+    def __init__(self, path, data: bytes = None, max_edge: int = OCR_MAX_EDGE):
+        self.path = Path(path)
+        self.data = data if data is not None else self.path.read_bytes()
+        self.max_edge = max_edge
+        self._image = None
+        self._exif = None
+
+    @property
+    def image(self):
+        if self._image is None:
+            im = Image.open(io.BytesIO(self.data))
+            self._exif = im.getexif()
+            w, h = im.size
+            scale = self.max_edge / max(w, h, 1)
+            if scale < 1:
+                im.draft("RGB", (max(1, int(w * scale)), max(1, int(h * scale))))
+            self._image = ImageOps.exif_transpose(im).convert("RGB")
+        return self._image
+
+    def exif_date(self):
+        self.image
+        # 36867 = DateTimeOriginal, format: YYYY:MM:DD HH:MM:SS
+        date_str = self._exif.get(36867) if self._exif else None
+        if date_str:
+            try:
+                return datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S").isoformat()
+            except ValueError:
+                return None
+        return None
+
+    def resized(self, max_edge: int):
+        im = self.image.copy()
+        im.thumbnail((max_edge, max_edge))
+        return im
+
+    def render_thumbnails(self, sizes=thumbnails.SCAN_SIZES, fmt=thumbnails.DEFAULT_FORMAT):
+        return thumbnails.render_all(self.image, sizes, fmt)
+
+    def vision_copy(self, max_edge=VISION_MAX_EDGE, fmt="JPEG", quality=85):
+        return encode_image(self.resized(max_edge), fmt, quality)
+
+    def ocr_image(self):
+        return self.image.convert("L")
+
+    def ocr_input(self, precheck=True):
+        """Grayscale buffer for an OCR worker, or None if the pre-check sees no text."""
+        return ocr.prepare(self.ocr_image(), precheck)
+
+    def perceptual_hashes(self):
+        # From a thumbnail-sized copy: the same input a backfill has from stored thumbnails
+        small = self.resized(thumbnails.DEFAULT_SIZE)
+        return perceptual.phash(small), perceptual.dhash(small)
 
 def summarize_text(ocr_text: str, filename: str):
     # simple heuristic summary for Phase1
@@ -60,148 +141,629 @@ def datetime_iso(path: Path):
     ct = getattr(st, "st_ctime", st.st_mtime)
     return datetime.fromtimestamp(ct).isoformat()
 
-def get_exif_date(path: Path):
+def walk_images(root: Path):
+    """Yields a FileStat per image. os.scandir keeps this to one metadata read per entry."""
+    stack = [str(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError as e:
+            print(f"Cannot list {e.filename}: {e}")
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in SUPPORTED_EXT:
+                        st = entry.stat()
+                        yield FileStat(Path(entry.path), st.st_size, st.st_mtime_ns, entry.inode())
+                except OSError:
+                    continue
+
+def stat_file(path: Path) -> FileStat:
+    st = os.stat(path)
+    return FileStat(Path(path), st.st_size, st.st_mtime_ns, st.st_ino)
+
+def stat_paths(paths):
+    """FileStat for each listed image that still exists (watcher batches)."""
+    for p in paths:
+        if os.path.splitext(str(p))[1].lower() not in SUPPORTED_EXT:
+            continue
+        try:
+            yield stat_file(Path(p))
+        except OSError:
+            continue
+
+def mtime_iso(mtime_ns: int) -> str:
+    return datetime.fromtimestamp(mtime_ns / 1e9).isoformat()
+
+def _repoint(cur, content_hash, old_path):
+    # A memory's main path no longer holds its bytes: show another copy if there is one
+    other = cur.execute("SELECT path FROM memory_paths WHERE hash=? AND path!=? LIMIT 1",
+                        (content_hash, old_path)).fetchone()
+    if other:
+        cur.execute("UPDATE memories SET path=? WHERE hash=? AND path=?", (other[0], content_hash, old_path))
+
+def link_paths(cur, rows):
+    """Path records for file_state rows (path, size, mtime_ns, inode, partial_hash, hash)."""
+    for p, _, mtime_ns, _, _, h in rows:
+        old = cur.execute("SELECT hash FROM memory_paths WHERE path=?", (p,)).fetchone()
+        cur.execute("INSERT OR REPLACE INTO memory_paths (path, hash, modified_at) VALUES (?, ?, ?)",
+                    (p, h, mtime_iso(mtime_ns)))
+        if old and old[0] != h:
+            _repoint(cur, old[0], p)
+
+def unlink_paths(cur, paths):
+    """Drops the path records of files that are gone; their memories move to a remaining copy."""
+    for p in paths:
+        row = cur.execute("SELECT hash FROM memory_paths WHERE path=?", (p,)).fetchone()
+        cur.execute("DELETE FROM memory_paths WHERE path=?", (p,))
+        if row:
+            _repoint(cur, row[0], p)
+
+def remove_paths(conn, paths, faiss_mgr=None, session=None):
+    """
+    Drops the memories and file stats of deleted files, and their vectors from FAISS.
+    A memory with another copy on disk is kept and points at that copy instead.
+    Paths that exist again (e.g. replaced by an editor) are left alone. Returns the number removed.
+    """
+    gone = [(str(p),) for p in paths if not os.path.exists(p)]
+    if not gone:
+        return 0
+    cur = conn.cursor()
+    unlink_paths(cur, [p for (p,) in gone])
+    vec_ids = []
+    for (p,) in gone:
+        vec_ids += [r[0] for r in cur.execute("SELECT vec_id FROM memories WHERE path=?", (p,)) if r[0] is not None]
+    cur.executemany("DELETE FROM memories WHERE path=?", gone)
+    cur.executemany("DELETE FROM file_state WHERE path=?", gone)
+    conn.commit()
+    if session:
+        session.forget(conn, [p for (p,) in gone])
+    if faiss_mgr:
+        faiss_mgr.remove(vec_ids)
+    return len(vec_ids)
+
+def load_file_states(conn):
+    """path -> (size, mtime_ns, inode, hash), and (size, partial_hash) -> (path, hash) for move detection."""
+    states, partials = {}, {}
+    for path, size, mtime_ns, inode, partial_h, h in conn.execute(
+            "SELECT path, size, mtime_ns, inode, partial_hash, hash FROM file_state"):
+        states[path] = (size, mtime_ns, inode, h)
+        if partial_h:
+            partials[(size, partial_h)] = (path, h)
+    return states, partials
+
+def decode_file(path_str: str, data: bytes = None, vision=None, ocr_input=True, precheck=True):
+    """
+    CPU-bound per-file work (EXIF, thumbnails, OCR input, vision copy) from a single
+    decode. Runs in a worker process, so it only takes and returns picklable values.
+    `vision` is the adapter's encode_options(); without it no vision copy is made.
+    "ocr_input" is the grayscale buffer the OCR stage reads, None when not wanted
+    (`ocr_input=False`, text already cached) or when the pre-check finds no text.
+    """
+    p = Path(path_str)
+    created = datetime_iso(p)
+    ctx = ImageContext(p, data)
     try:
-        im = Image.open(path)
-        exif = im.getexif()
-        # 36867 = DateTimeOriginal
-        date_str = exif.get(36867)
-        if date_str:
-            # format: YYYY:MM:DD HH:MM:SS
+        out = {
+            "created": created,
+            "modified": created,
+            "exif_date": ctx.exif_date() or created,
+            "ocr_input": ctx.ocr_input(precheck) if ocr_input else None,
+            "thumbs": ctx.render_thumbnails(),
+            "vision_image": None,
+        }
+        out["phash"], out["dhash"] = ctx.perceptual_hashes()
+        if vision:
+            max_edge, fmt, mime, quality = vision
+            t0 = time.perf_counter()
+            out["vision_image"] = ctx.vision_copy(max_edge, fmt, quality)
+            out["vision_mime"] = mime
+            out["vision_encode_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        return out
+    except Exception as e:
+        print(f"Failed to decode {p}: {e}")
+        return {"created": created, "modified": created, "exif_date": created, "ocr_input": None,
+                "thumbs": thumbnails.blank(), "vision_image": None, "decoded": False}
+
+def backfill_perceptual_hashes(conn, clusters):
+    """Hashes and clusters for memories indexed before perceptual hashing, from their stored thumbnails."""
+    rows = conn.execute("""
+        SELECT m.file_id, t.data FROM memories m
+        JOIN thumbnails t ON t.hash = m.hash AND t.size = (SELECT MAX(size) FROM thumbnails WHERE hash = m.hash)
+        WHERE m.phash IS NULL
+        GROUP BY m.file_id ORDER BY m.rowid
+    """).fetchall()
+    if not rows:
+        return 0
+    print(f"Computing perceptual hashes for {len(rows)} memories...")
+    updates = []
+    for file_id, data in rows:
+        try:
+            im = Image.open(io.BytesIO(data)).convert("RGB")
+            ph, dh = perceptual.phash(im), perceptual.dhash(im)
+        except Exception:
+            continue
+        rep = clusters.assign(ph, dh, file_id)
+        rep["done"].set()
+        if rep["cluster_id"] == file_id:
+            rep["stored"] = True
+        updates.append((perceptual.to_sql(ph), perceptual.to_sql(dh), rep["cluster_id"], file_id))
+    conn.executemany("UPDATE memories SET phash=?, dhash=?, cluster_id=? WHERE file_id=?", updates)
+    conn.commit()
+    return len(updates)
+
+class ScanSession:
+    """
+    What a scan loads once per library: the snapshot of known hashes and file stats
+    the hash workers check against, the near-duplicate cluster index and the decode
+    process pool. A full scan opens its own. Watch mode keeps one open across batches
+    and each batch records what it committed, so a few changed files never reload the library.
+    """
+
+    def __init__(self, conn, config: PipelineConfig = None):
+        config = config or PipelineConfig()
+        # Snapshot of known hashes and file stats so hash workers never touch the connection
+        self.known = {h: (fid, vec_id, path) for h, fid, vec_id, path in
+                      conn.execute("SELECT hash, file_id, vec_id, path FROM memories")}
+        self.states, self.partials = load_file_states(conn)
+        # Content held by several files; editing one copy must not rewrite the shared memory
+        self.shared = {h for (h,) in conn.execute("SELECT hash FROM memory_paths GROUP BY hash HAVING COUNT(*) > 1")}
+        self.clusters = perceptual.ClusterIndex(conn, config.near_dup_distance)
+        backfill_perceptual_hashes(conn, self.clusters)
+        self.decode_workers = config.decode_workers or os.cpu_count() or 1
+        self.pool = self._new_pool()
+        self._pool_lock = threading.Lock()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=self.decode_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def run(self, fn, *args):
+        """
+        fn(*args) on the decode pool. A worker that dies (e.g. OOM on a huge image) breaks
+        the whole pool: it is replaced and the call retried once, so only the file that
+        breaks the new pool too fails, not every batch after it.
+        """
+        for attempt in (0, 1):
+            pool = self.pool
             try:
-                dt = datetime.strptime(date_str, "%Y:%m:%d %H:%M:%S")
-                return dt.isoformat()
-            except ValueError:
-                return None
-    except Exception:
-        pass
-    return None
+                return pool.submit(fn, *args).result()
+            except BrokenProcessPool:
+                with self._pool_lock:
+                    if self.pool is pool:
+                        print("Decode worker died, starting a new process pool")
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        self.pool = self._new_pool()
+                if attempt:
+                    raise
+
+    def record(self, conn, row, file_id=None, vec_id=None):
+        """A committed file_state row, and the memory it produced if it made one."""
+        p, size, mtime_ns, inode, partial_h, h = row
+        prev = self.states.get(p)
+        self.states[p] = (size, mtime_ns, inode, h)
+        if partial_h:
+            self.partials[(size, partial_h)] = (p, h)
+        if file_id is not None:
+            self.known[h] = (file_id, vec_id, p)
+        elif h in self.known and self.known[h][2] != p:
+            self.shared.add(h)
+        if prev and prev[3] != h:
+            # The path's old content may have moved to another copy (see _repoint)
+            self._reload(conn, prev[3])
+
+    def moved(self, conn, old, h):
+        self.states.pop(old, None)
+        self._reload(conn, h)
+
+    def forget(self, conn, paths):
+        """Deleted files, after remove_paths committed."""
+        for p in paths:
+            prev = self.states.pop(str(p), None)
+            if prev:
+                self._reload(conn, prev[3])
+
+    def _reload(self, conn, h):
+        row = conn.execute("SELECT file_id, vec_id, path FROM memories WHERE hash=?", (h,)).fetchone()
+        if row:
+            self.known[h] = tuple(row)
+        else:
+            self.known.pop(h, None)
+        if conn.execute("SELECT COUNT(*) FROM memory_paths WHERE hash=?", (h,)).fetchone()[0] > 1:
+            self.shared.add(h)
+        else:
+            self.shared.discard(h)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.clusters.close()
 
-def scan_and_index(root: Path, conn, model, rebuild=False, faiss_mgr=None, vision_adapter=None):
+def derive_text(item):
+    # Summary, tags and the text we embed, from vision output when we have it
+    vision_res = item.get("vision")
+    ocr = item["ocr"]
+    caption = item["path"].stem
+    if vision_res:
+        summary = vision_res.summary
+        tag_list = vision_res.objects[:5] + [vision_res.setting, vision_res.time_of_day]
+        tags = ", ".join([str(t) for t in tag_list if t])
+        emb_text = f"{summary} {tags} {ocr}"
+    else:
+        summary = summarize_text(ocr, caption)
+        tags = "ocr-fallback"
+        emb_text = f"{caption} {summary} {ocr}"
+    item.update({"caption": caption, "summary": summary, "tags": tags, "emb_text": emb_text})
+    return item
+
+def scan_and_index(root: Path, conn, model, rebuild=False, faiss_mgr=None, vision_adapter=None, config: PipelineConfig = None, job=None, paths=None, stats=None, session: ScanSession = None,
+                   write_lock=None):
     """
     Walk root for supported image files. Insert new entries into DB.
+    Files flow through a staged pipeline: walk -> hash -> decode (process pool)
+    -> vision (async) -> OCR (process pool) -> batched embedding -> a single writer on this thread.
+    `model` may be a SentenceTransformer or an EmbeddingService.
+    `job` (a jobs.ScanJob) receives progress, can pause/cancel the pipeline and
+    checkpoints finished paths.
+    `paths` limits the scan to those files instead of walking root (watch mode).
+    `stats`, if given, receives {"ocr": ...} timings and skip counts.
+    `session` is a ScanSession kept open by the caller (watch mode); without it the
+    scan opens and closes its own.
+    `write_lock` is held for every write transaction; the API shares it.
     Returns (added, skipped)
     """
+    config = config or PipelineConfig()
     cur = conn.cursor()
-    files = []
-    for dp, _, fns in os.walk(root):
-        for fn in fns:
-            if Path(fn).suffix.lower() in SUPPORTED_EXT:
-                files.append(Path(dp) / fn)
-    added = 0
-    skipped = 0
-
-    # We need an event loop to run async vision adapter calls
-    # Since FastAPI is async, but this function is called synchronously or needs to bridge,
-    # we'll create a loop or run_until_complete if we are in a thread.
-    # However, scan is called from a sync endpoint wrapper currently?
-    # Wait, scan endpoint is sync `def scan`. We can use asyncio.run if not already in loop.
-    # But usually better to use `asyncio.create_task` or run in executor.
-    # For simplicity here, we'll do a mini-wrapper to run async vision call.
-
-    def run_vision(path_str):
-        if not vision_adapter:
-            return None
-        try:
-             # This is a bit hacky inside a sync loop, but sufficient for local single-user tool
-             # Ideally the whole scan pipeline becomes async
-             return asyncio.run(vision_adapter.analyze_image(path_str))
-        except RuntimeError:
-             # Already in event loop?
-             # If `scan` endpoint is synchronous, we are fine.
-             return None
-
-    for p in tqdm(files, desc="scan"):
+    own_session = session is None
+    session = session or ScanSession(conn, config)
+    known, states, partials, shared = session.known, session.states, session.partials, session.shared
+    clusters = session.clusters
+    vec_counter = next_vec_id(conn)
+    # Earlier vision/OCR results for the same bytes (and model/prompt) are reused
+    cache = AnalysisCache(conn, vision_adapter.model_name if vision_adapter else "",
+                          vision_adapter.prompt_hash if vision_adapter else "", OCR_ENGINE)
+    claimed = set()
+    lock = threading.Lock()
+    counts = {"added": 0, "skipped": 0}
+    # file_state rows and moves found by the hash workers, written on this thread
+    pending_states, pending_moves = [], []
+    # ...and once written, (rows, moves) per commit for the session snapshot
+    committed_states = []
+
+    def on_error(stage, item, exc):
+        print(f"Scan stage '{stage}' failed: {exc}")
+        items = item if isinstance(item, list) else [item]
+        with lock:
+            counts["skipped"] += len(items)
+        if job:
+            for it in items:
+                job.finish(it["path"] if isinstance(it, dict) else getattr(it, "path", it), "failed")
+
+    # File bytes read by the hash stage and not yet handed to a decode worker
+    inflight = {"bytes": 0}
+
+    def release(n):
+        if n:
+            with lock:
+                inflight["bytes"] -= n
+
+    def skip(fs, row=None):
+        with lock:
+            counts["skipped"] += 1
+            if row:
+                # Checkpointed once the row commits (states_written), not before
+                pending_states.append(row)
+                return None
+        if job:
+            job.finish(fs.path, "skipped")
+        return None
+
+    def hash_stage(fs):
+        p = str(fs.path)
+        prev = states.get(p)
+        if prev and not rebuild and prev[:3] == (fs.size, fs.mtime_ns, fs.inode) and prev[3] in known:
+            # Unchanged since the last scan: no bytes read
+            return skip(fs)
+        partial_h = partial_hash(fs.path, fs.size)
+        moved_from = partials.get((fs.size, partial_h))
+        if (not rebuild and prev is None and moved_from and moved_from[1] in known
+                and known[moved_from[1]][2] == moved_from[0] and not os.path.exists(moved_from[0])):
+            # Same size and head/tail as a file that disappeared: a move, not new content
+            h = moved_from[1]
+            with lock:
+                if h not in claimed:
+                    claimed.add(h)
+                    pending_moves.append((moved_from[0], p, h))
+            return skip(fs, (p, fs.size, fs.mtime_ns, fs.inode, partial_h, h))
+        # Read once: the same bytes feed the hash and the decode, while the bytes
+        # waiting between the two stay under the budget. Past it the file is hashed
+        # in chunks and the decode worker reads it again.
+        with lock:
+            carry = inflight["bytes"] + fs.size <= config.max_inflight_bytes
+            if carry:
+                inflight["bytes"] += fs.size
         try:
-            h = file_hash(p)
+            data = fs.path.read_bytes() if carry else None
+            h = hashlib.sha256(data).hexdigest() if carry else file_hash(fs.path)
         except Exception:
-            skipped += 1
-            continue
+            release(fs.size if carry else 0)
+            raise
+        row = (p, fs.size, fs.mtime_ns, fs.inode, partial_h, h)
+        with lock:
+            # Duplicates inside this scan are only processed once
+            duplicate = h in claimed or (h in known and not rebuild)
+            if not duplicate:
+                claimed.add(h)
+        if duplicate:
+            release(fs.size if carry else 0)
+            return skip(fs, row)
+        fid, vec_id, _ = known.get(h, (None, None, None))
+        if fid is None and prev and prev[3] in known and known[prev[3]][2] == p and prev[3] not in shared:
+            # Edited in place: replace the memory this path used to hold
+            fid, vec_id, _ = known[prev[3]]
+        return {"path": fs.path, "hash": h, "file_id": fid or str(uuid.uuid4()), "vec_id": vec_id, "state": row,
+                "data": data, "carried": fs.size if carry else 0,
+                "ocr": cache.get("ocr", h),
+                "vision_json": cache.get("vision", h) if vision_adapter else None}
 
-        # Check existing
-        cur.execute("SELECT file_id, path, vision_status FROM memories WHERE hash=?", (h,))
-        row = cur.fetchone()
-
-        # Determine if we need to process
-        # If rebuild=True, always process
-        # If not in DB, process
-        # If in DB but vision_status is failed/null and we have an adapter now, we might want to retry?
-        # User requirement: "If vision inference fails... indexed with vision_status failed"
-        # Let's say we only process if not exists or rebuild is set.
-
-        if row and not rebuild:
-            # Maybe check if we should retry vision?
-            # For now stick to simple "skip if exists" unless rebuild
-            skipped += 1
-            continue
+    vision_opts = vision_adapter.encode_options() if vision_adapter else None
 
-        fid = str(uuid.uuid4())
-        # If updating existing
-        if row:
-            fid = row[0]
+    def decode_stage(item):
+        # No vision copy or OCR input for what the cache already answered
+        opts = vision_opts if item["vision_json"] is None else None
+        try:
+            item.update(session.run(decode_file, str(item["path"]), item.pop("data"), opts,
+                                    item["ocr"] is None, config.ocr_precheck))
+        finally:
+            release(item.pop("carried"))
+        return item
 
-        # 1. Basic Metadata
-        created = datetime_iso(p)
-        modified = datetime_iso(p)
-        exif_date = get_exif_date(p) or created
+    ocr_engine = ocr.OcrEngine(session.run)
 
-        # 2. Vision Analysis
-        vision_res = None
-        vision_status = "pending"
-        vision_json_str = None
+    def ocr_stage(item):
+        # After vision, so text the model already read is not OCR'd again
+        buf = item.pop("ocr_input", None)
+        if item["ocr"] is not None:
+            ocr_engine.skip("cached")
+            return item
+        text_content = item["vision"].text_content if item.get("vision") else None
+        if text_content and text_content.strip().lower() not in ("", "none", "n/a", "null"):
+            item["ocr"] = text_content
+            ocr_engine.skip("vision_text")
+        elif buf is None:
+            item["ocr"] = ""
+            ocr_engine.skip("no_text" if item.get("decoded", True) else "undecodable")
+        else:
+            text = ocr_engine.read(buf)
+            # A failed run is not cached, so the next scan tries again
+            item["ocr"] = text or ""
+            item["fresh_ocr"] = text is not None
+        return item
+
+    def vision_stage(item):
+        rep = None
+        if item.get("phash") is not None:
+            rep = clusters.assign(item["phash"], item.get("dhash"), item["file_id"])
+            item["cluster_id"] = rep["cluster_id"]
+            if rep["cluster_id"] == item["file_id"]:
+                try:
+                    return analyze(item)
+                finally:
+                    # Members waiting on this representative can go ahead
+                    rep["vision_json"] = item["vision_json"] if item["vision_status"] == "success" else None
+                    rep["done"].set()
+        return analyze(item, rep)
 
+    def analyze(item, rep=None):
+        image_bytes = item.pop("vision_image", None)
+        item["vision"] = None
+        item["vision_status"] = "pending"
+        if (item["vision_json"] is None and rep is not None and vision_adapter
+                and config.reuse_cluster_vision):
+            # Burst shot or light edit of an analyzed photo: borrow its description
+            item["vision_json"] = clusters.vision_for(rep)
+        if item["vision_json"] is not None:
+            try:
+                item["vision"] = VisionOutput.model_validate_json(item["vision_json"])
+                item["vision_status"] = "success"
+                return item
+            except Exception as e:
+                print(f"Ignoring unreadable cached vision result: {e}")
+        item["vision_json"] = None
         if vision_adapter:
-            # We need to run async in this sync loop.
-            # If `scan` is a sync function in FastAPI, it runs in a threadpool.
-            # So `asyncio.run` creates a new loop for each call which is inefficient but works.
             try:
-                vision_res = asyncio.run(vision_adapter.analyze_image(str(p)))
+                # Runs on the adapter's own loop and connection pool
+                vision_res = vision_adapter.analyze_image_sync(
+                    str(item["path"]), image_bytes=image_bytes,
+                    mime=item.get("vision_mime", "image/jpeg"), encode_ms=item.get("vision_encode_ms", 0.0))
                 if vision_res:
-                    vision_status = "success"
+                    item["vision"] = vision_res
+                    item["vision_status"] = "success"
                     # Pydantic v2 use model_dump_json()
-                    vision_json_str = vision_res.model_dump_json()
+                    item["vision_json"] = vision_res.model_dump_json()
+                    item["fresh_vision"] = True
                 else:
-                    vision_status = "failed"
+                    item["vision_status"] = "failed"
             except Exception as e:
                 print(f"Vision crash: {e}")
-                vision_status = "failed"
-
-        # 3. Text Extraction (Fallback or augment)
-        ocr = do_ocr(p)
-        caption = p.stem
-
-        # 4. Derive Summary & Tags
-        if vision_res:
-            summary = vision_res.summary
-            tag_list = vision_res.objects[:5] + [vision_res.setting, vision_res.time_of_day]
-            tags = ", ".join([str(t) for t in tag_list if t])
-            # Embed based on vision
-            emb_text = f"{summary} {tags} {ocr}"
-        else:
-            # Fallback
-            summary = summarize_text(ocr, caption)
-            tags = "ocr-fallback"
-            emb_text = f"{caption} {summary} {ocr}"
+                item["vision_status"] = "failed"
+        return item
 
-        # 5. Embed
-        try:
-            emb = model.encode(emb_text).astype("float32")
-        except Exception:
-            emb = np.zeros((384,), dtype="float32")
+    embedder = model if isinstance(model, EmbeddingService) else EmbeddingService(model)
 
-        thumb = make_thumbnail_bytes(p)
+    def embed_stage(batch):
+        # One forward pass per batch; vectors come back normalized float32
+        embs = embedder.encode([derive_text(item)["emb_text"] for item in batch])
+        for item, emb in zip(batch, embs):
+            item["embedding"] = emb
+        return batch
 
-        # 6. Save
-        cur.execute("""
-            INSERT OR REPLACE INTO memories
-            (file_id, path, hash, created_at, modified_at, exif_date, ocr_text, caption, memory_summary, tags, vision_json, vision_status, embedding, thumbnail)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (fid, str(p), h, created, modified, exif_date, ocr, caption, summary, tags, vision_json_str, vision_status, emb.tobytes(), thumb))
-        conn.commit()
-        added += 1
+    seen = set()
 
-        # incrementally add to faiss if provided
+    def walk():
+        for fs in (walk_images(root) if paths is None else stat_paths(paths)):
+            seen.add(str(fs.path))
+            yield fs
+
+    pipe = Pipeline(queue_size=config.queue_size, on_error=on_error)
+    pipe.source(job.track(walk()) if job else walk())
+    pipe.stage("hash", hash_stage, workers=config.hash_workers)
+    pipe.stage("decode", decode_stage, workers=session.decode_workers)
+    vision_workers = (config.vision_workers or vision_adapter.max_concurrency) if vision_adapter else 1
+    pipe.stage("vision", vision_stage, workers=vision_workers)
+    pipe.stage("ocr", ocr_stage, workers=session.decode_workers)
+    pipe.batch_stage("embed", embed_stage, config.embed_batch_size, config.embed_flush_seconds)
+
+    # Vectors reach FAISS in groups: one remove_ids/add_with_ids call per flush
+    new_ids, new_vecs, upd_ids, upd_vecs = [], [], [], []
+
+    def flush_faiss():
         if faiss_mgr:
-            faiss_mgr.add_vector(emb, (fid, str(p)))
+            faiss_mgr.add(new_ids, new_vecs)
+            faiss_mgr.update(upd_ids, upd_vecs)
+        for lst in (new_ids, new_vecs, upd_ids, upd_vecs):
+            lst.clear()
+
+    def write_states(cur, rows, moves):
+        for old, new, h in moves:
+            cur.execute("UPDATE memories SET path=? WHERE hash=? AND path=?", (new, h, old))
+            cur.execute("DELETE FROM file_state WHERE path=?", (old,))
+            cur.execute("DELETE FROM memory_paths WHERE path=?", (old,))
+        if rows:
+            cur.executemany(FILE_STATE_SQL, rows)
+            # Unchanged bytes under another name (copies, moves) only add a path record
+            link_paths(cur, rows)
+
+    def restore_states(rows, moves):
+        # Rolled back: written again with the next batch
+        print(f"Requeueing {len(rows)} file stats and {len(moves)} moves")
+        with lock:
+            pending_states[:0] = rows
+            pending_moves[:0] = moves
+
+    def states_written(rows, moves):
+        committed_states.append((rows, moves))
+        if job:
+            for row in rows:
+                job.finish(row[0], "skipped")
+
+    def queue_states():
+        """Moves and stats found by the hash workers, as one unit of the next batch."""
+        with lock:
+            rows, moves = pending_states[:], pending_moves[:]
+            pending_states.clear()
+            pending_moves.clear()
+        if rows or moves:
+            writer.add([partial(write_states, rows=rows, moves=moves)],
+                       on_commit=partial(states_written, rows, moves),
+                       on_fail=partial(restore_states, rows, moves))
+
+    def item_writes(item, vec_id):
+        """Every row one finished item writes, for the batch writer."""
+        h = item["hash"]
+        writes = [(MEMORY_SQL, (
+            item["file_id"], str(item["path"]), h, item["created"], item["modified"], item["exif_date"], item["ocr"],
+            item["caption"], item["summary"], item["tags"], item["vision_json"], item["vision_status"],
+            item["embedding"].tobytes(), vec_id,
+            perceptual.to_sql(item["phash"]) if item.get("phash") is not None else None,
+            perceptual.to_sql(item["dhash"]) if item.get("dhash") is not None else None,
+            item.get("cluster_id")))]
+        writes += [(thumbnails.STORE_SQL, row) for row in thumbnails.store_rows(h, item["thumbs"])]
+        if item.get("fresh_vision"):
+            writes.append((CACHE_SQL, cache.row("vision", h, item["vision_json"])))
+        if item.get("fresh_ocr"):
+            writes.append((CACHE_SQL, cache.row("ocr", h, item["ocr"])))
+        writes.append((FILE_STATE_SQL, item["state"]))
+        writes.append(partial(link_paths, rows=[item["state"]]))
+        return writes
+
+    def saved(p, vec_id, emb, is_update, row, file_id):
+        session.record(conn, row, file_id, vec_id)
+        with lock:
+            counts["added"] += 1
+        if job:
+            job.finish(p, "processed")
+        if is_update:
+            upd_ids.append(vec_id)
+            upd_vecs.append(emb)
+        else:
+            new_ids.append(vec_id)
+            new_vecs.append(emb)
+
+    def failed(p):
+        print(f"Failed to save {p}")
+        with lock:
+            counts["skipped"] += 1
+        if job:
+            job.finish(p, "failed")
+
+    # One transaction per batch of finished items; moves and duplicates found by the
+    # hash workers ride along in the same commit
+    writer = BatchWriter(conn, config.write_batch_size, config.write_flush_seconds, lock=write_lock)
+
+    def flush():
+        queue_states()
+        writer.flush()
+        after_flush()
+
+    def record_states():
+        for rows, moves in committed_states:
+            for old, _, h in moves:
+                session.moved(conn, old, h)
+            for row in rows:
+                session.record(conn, row)
+        committed_states.clear()
+
+    def after_flush():
+        # Committed rows reach FAISS, the session snapshot and the job checkpoint together
+        record_states()
+        flush_faiss()
+        if job:
+            job.checkpoint()
+
+    if job:
+        job.attach(pipe)
+
+    try:
+        for item in tqdm(pipe.start().results(), desc="scan"):
+            p, emb = item["path"], item["embedding"]
+            is_update = item["vec_id"] is not None
+            vec_id = item["vec_id"] if is_update else vec_counter
+            if not is_update:
+                vec_counter += 1
+            writer.add(item_writes(item, vec_id),
+                       on_commit=partial(saved, p, vec_id, emb, is_update, item["state"], item["file_id"]),
+                       on_fail=partial(failed, p))
+            if writer.due():
+                flush()
+        flush()
+        if paths is None and not (job and job.cancelled):
+            # Forget stats and path records of files that are gone (their memories are left alone)
+            prefix = os.path.join(str(root), "")
+            gone = [path for path in states if path.startswith(prefix) and path not in seen]
+            if gone:
+                writer.add([("DELETE FROM file_state WHERE path=?", (path,)) for path in gone]
+                           + [partial(unlink_paths, paths=gone)])
+                writer.flush()
+    finally:
+        pipe.stop()
+        cache.close()
+        queue_states()
+        writer.close()
+        record_states()
+        if own_session:
+            session.close()
+        flush_faiss()
+        hits = cache.stats()
+        if hits["vision"]["hits"] or hits["ocr"]["hits"]:
+            print(f"Reused cached results: vision {hits['vision']['hits']}, OCR {hits['ocr']['hits']}")
+        if stats is not None:
+            stats["ocr"] = ocr_engine.stats()
+        if job:
+            job.checkpoint(force=True)
 
-    return added, skipped
+    return counts["added"], counts["skipped"]
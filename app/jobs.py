@@ -0,0 +1,301 @@
+# app/jobs.py
+import time
+import uuid
+import queue
+import threading
+from datetime import datetime
+from typing import Callable, Optional
+
+from .pipeline import PipelineConfig
+
+ACTIVE = ("queued", "running", "paused")
+FINISHED = ("completed", "cancelled", "failed")
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+class ScanJob:
+    """
+    Progress, control and checkpoint state for one background scan.
+
+    `scan_and_index(..., job=job)` reports into it: `track()` wraps the file walk,
+    `finish()` is called once per file and `checkpoint()` from the writer thread
+    persists finished paths so an interrupted job resumes without re-hashing them.
+    Job rows are written through `pool` (a db.ConnectionPool), never the scan's connection.
+    """
+
+    CHECKPOINT_SECONDS = 2.0
+
+    def __init__(self, job_id: str, root: str, rescan: bool = False, config: Optional[PipelineConfig] = None):
+        self.id = job_id
+        self.root = root
+        self.rescan = rescan
+        self.config = config
+        self.pool = None
+        self.status = "queued"
+        self.error = None
+        self.created_at = _now()
+        self.counts = {"discovered": 0, "processed": 0, "skipped": 0, "failed": 0}
+        self.walk_done = False
+        self.done_paths = set()      # restored from scan_checkpoints on resume
+        self._pending = []           # finished paths not yet written
+        self._lock = threading.Lock()
+        self._pipe = None
+        self._paused = False
+        self._cancelled = False
+        self._started = None
+        self._paused_at = None
+        self._paused_total = 0.0
+        self._finished = None
+        self._last_checkpoint = 0.0
+
+    # --- hooks called by scan_and_index ---
+
+    def attach(self, pipe):
+        with self._lock:
+            self._pipe = pipe
+            if self._cancelled:
+                pipe.stop()
+            elif self._paused:
+                pipe.pause()
+
+    def track(self, paths):
+        """Wraps the file walk: counts discoveries and drops paths finished before a restart."""
+        for p in paths:
+            with self._lock:
+                self.counts["discovered"] += 1
+                # The walker yields indexer.FileStat entries; plain paths work too
+                if str(getattr(p, "path", p)) in self.done_paths:
+                    self.counts["skipped"] += 1
+                    continue
+            yield p
+        self.walk_done = True
+
+    def finish(self, path, outcome: str):
+        # outcome: processed | skipped | failed. Failed files are not checkpointed, so they are retried.
+        with self._lock:
+            self.counts[outcome] += 1
+            if outcome != "failed" and path is not None:
+                self._pending.append(str(path))
+
+    def checkpoint(self, force=False):
+        now = time.monotonic()
+        if self.pool is None or (not force and now - self._last_checkpoint < self.CHECKPOINT_SECONDS):
+            return
+        self._last_checkpoint = now
+        with self._lock:
+            pending, self._pending = self._pending, []
+        try:
+            with self.pool.write() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO scan_checkpoints (job_id, path) VALUES (?, ?)",
+                    [(self.id, p) for p in pending],
+                )
+                self.save(conn)
+        except Exception as e:
+            print(f"Scan checkpoint failed: {e}")
+            with self._lock:
+                self._pending = pending + self._pending
+
+    # --- control ---
+
+    def pause(self):
+        with self._lock:
+            if self.status != "running" and self.status != "queued":
+                return False
+            self._paused = True
+            self.status = "paused"
+            self._paused_at = time.monotonic()
+            if self._pipe:
+                self._pipe.pause()
+        return True
+
+    def resume(self):
+        with self._lock:
+            if self.status != "paused":
+                return False
+            self._paused = False
+            self.status = "running" if self._started else "queued"
+            if self._paused_at is not None:
+                self._paused_total += time.monotonic() - self._paused_at
+                self._paused_at = None
+            if self._pipe:
+                self._pipe.resume()
+        return True
+
+    def cancel(self):
+        with self._lock:
+            if self.status in FINISHED:
+                return False
+            self._cancelled = True
+            if self._pipe:
+                self._pipe.stop()
+        return True
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    # --- reporting ---
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+            elapsed = 0.0
+            if self._started is not None:
+                end = self._finished or self._paused_at or time.monotonic()
+                elapsed = max(0.0, end - self._started - self._paused_total)
+        handled = counts["processed"] + counts["skipped"] + counts["failed"]
+        throughput = handled / elapsed if elapsed > 0 else 0.0
+        remaining = max(0, counts["discovered"] - handled)
+        eta = None
+        if self.walk_done and throughput > 0 and self._finished is None:
+            eta = round(remaining / throughput, 1)
+        return {
+            "job_id": self.id,
+            "root": self.root,
+            "status": self.status,
+            "error": self.error,
+            **counts,
+            "walk_done": self.walk_done,
+            "elapsed_seconds": round(elapsed, 1),
+            "files_per_second": round(throughput, 2),
+            "eta_seconds": eta,
+            "created_at": self.created_at,
+        }
+
+    def save(self, conn):
+        """Writes the job row; the caller's transaction commits it."""
+        c = self.counts
+        conn.execute("""
+            INSERT OR REPLACE INTO scan_jobs
+            (job_id, root, rescan, config, status, discovered, processed, skipped, failed, error, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (self.id, self.root, int(self.rescan), self.config.model_dump_json() if self.config else None,
+              self.status, c["discovered"], c["processed"], c["skipped"], c["failed"], self.error,
+              self.created_at, _now()))
+
+
+class JobManager:
+    """
+    Runs scan jobs one at a time on a background thread (scans share the single
+    DB writer). `run_fn(job)` does the actual scan; it is supplied by main.py.
+    """
+
+    def __init__(self, run_fn: Callable[[ScanJob], None]):
+        self.run_fn = run_fn
+        self.jobs = {}
+        self.pool = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def attach(self, pool):
+        """Loads the job history of a newly mounted DB. Jobs cut short by a restart become 'interrupted'."""
+        with self._lock:
+            self.pool = pool
+            self.jobs = {jid: j for jid, j in self.jobs.items() if j.status in ACTIVE}
+            rows = pool.reader().execute("""
+                SELECT job_id, root, rescan, config, status, discovered, processed, skipped, failed, error, created_at
+                FROM scan_jobs ORDER BY created_at
+            """).fetchall()
+            for jid, root, rescan, config, status, disc, proc, skip, fail, error, created in rows:
+                if jid in self.jobs:
+                    continue
+                job = ScanJob(jid, root, bool(rescan), PipelineConfig.model_validate_json(config) if config else None)
+                job.counts.update(discovered=disc or 0, processed=proc or 0, skipped=skip or 0, failed=fail or 0)
+                job.error, job.created_at = error, created
+                job.status = "interrupted" if status in ACTIVE else status
+                job.walk_done = True
+                job.pool = pool
+                self.jobs[jid] = job
+
+    def submit(self, root: str, rescan: bool = False, config: Optional[PipelineConfig] = None) -> ScanJob:
+        job = ScanJob(uuid.uuid4().hex[:12], root, rescan, config)
+        job.pool = self.pool
+        with self._lock:
+            self.jobs[job.id] = job
+        self._save(job)
+        self._enqueue(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[ScanJob]:
+        return self.jobs.get(job_id)
+
+    def list(self):
+        return [j.snapshot() for j in sorted(self.jobs.values(), key=lambda j: j.created_at, reverse=True)]
+
+    def resume(self, job_id: str) -> Optional[ScanJob]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job.status == "interrupted":
+            # Fresh run of the same job id; finished paths are skipped via the checkpoint table
+            fresh = ScanJob(job.id, job.root, job.rescan, job.config)
+            fresh.created_at = job.created_at
+            fresh.pool = self.pool
+            if self.pool is not None:
+                fresh.done_paths = {r[0] for r in self.pool.reader().execute(
+                    "SELECT path FROM scan_checkpoints WHERE job_id=?", (job.id,))}
+            with self._lock:
+                self.jobs[job.id] = fresh
+            self._enqueue(fresh)
+            return fresh
+        return job if job.resume() else None
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        if job.status == "interrupted":
+            # Nothing is running; just retire it and drop its checkpoint
+            job.status = "cancelled"
+            self._save(job, drop_checkpoint=True)
+            return True
+        return job.cancel()
+
+    def _enqueue(self, job):
+        self._queue.put(job)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="scan-jobs", daemon=True)
+                self._thread.start()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job.cancelled:
+                job.status = "cancelled"
+            else:
+                self._run(job)
+            # Only interrupted jobs resume, so a finished one no longer needs its checkpoint
+            self._save(job, drop_checkpoint=True)
+
+    def _save(self, job, drop_checkpoint=False):
+        if self.pool is None:
+            return
+        try:
+            with self.pool.write() as conn:
+                if drop_checkpoint:
+                    conn.execute("DELETE FROM scan_checkpoints WHERE job_id=?", (job.id,))
+                job.save(conn)
+        except Exception as e:
+            print(f"Failed to save scan job {job.id}: {e}")
+
+    def _run(self, job):
+        with job._lock:
+            job._started = time.monotonic()
+            if job._paused:
+                job._paused_at = job._started
+            else:
+                job.status = "running"
+        try:
+            self.run_fn(job)
+            job.status = "cancelled" if job.cancelled else "completed"
+        except Exception as e:
+            print(f"Scan job {job.id} failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+        job._finished = time.monotonic()
@@ -1,14 +1,19 @@
 # app/main.py
 import os
 import io
+import json
+import time
+import asyncio
+import threading
 import hashlib
+from collections import deque
 import sqlite3
 import base64
 from pathlib import Path
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Query
 from pydantic import BaseModel
-from fastapi.responses import Response, JSONResponse, FileResponse
+from fastapi.responses import Response, JSONResponse, FileResponse, StreamingResponse
 from sentence_transformers import SentenceTransformer
 from PIL import Image, ImageOps
 import numpy as np
@@ -16,10 +21,18 @@ import faiss
 import pytesseract
 from datetime import datetime
 
-from .db import init_db, row_to_dict
-from .indexer import scan_and_index
-from .faiss_mgr import FaissManager
-from .vision.adapter import VisionAdapter
+from .db import init_db, row_to_dict, fts_search, fts_tag_expr, has_fts, ConnectionPool
+from .indexer import scan_and_index, remove_paths, ScanSession
+from .pipeline import PipelineConfig
+from .embedding import EmbeddingService
+from .faiss_mgr import FaissManager, IndexConfig, INDEX_TYPES, index_path_for, load_index_config
+from .vector_store import EmbeddingStore, STORE_DTYPES, store_path_for
+from .faiss_bench import benchmark
+from .vision.adapter import VisionAdapter, CircuitBreaker, IMAGE_FORMATS
+from .query_cache import QueryCache, cache_key
+from . import thumbnails, analysis_cache
+from .jobs import JobManager, FINISHED
+from .watcher import DirectoryWatcher
 
 APP_DIR = Path(__file__).resolve().parent
 app = FastAPI(title="Memory Brain - Phase1.5")
@@ -38,14 +51,31 @@ app.add_middleware(
 
 MODEL_NAME = "all-MiniLM-L6-v2"
 EMBED_DIM = 384
+# /search waits this long for the LLM rewrite, then goes ahead with the raw query
+EXPANSION_BUDGET = 0.3
 
 # Global runtime state (simple single-drive focus)
 state = {
     "mounted_path": None,
     "db_path": None,
     "conn": None,
+    # Per-thread read-only connections to the mounted DB (see read_conn)
+    "pool": None,
     "faiss": None,
-    "embed_model": None
+    "embed_model": None,
+    "embedder": None,
+    "watcher": None,
+    # Payload/encode/latency summary of the last scan's vision requests
+    "vision_stats": None,
+    "ocr_stats": None,
+    # Expanded queries and query vectors, persisted per mounted DB
+    "query_cache": QueryCache(),
+    # Long-lived adapter, circuit breaker and counters for query expansion (see expansion_client)
+    "expansion": None,
+    # The running scan's adapter, so searches can see when the vision endpoint is saturated
+    "scan_adapter": None,
+    # Snapshot, cluster index and process pool reused by every watch batch (see index_changes)
+    "watch_session": None
 }
 
 # Simple boot
@@ -53,11 +83,119 @@ state = {
 def load_model():
     try:
         state["embed_model"] = SentenceTransformer(MODEL_NAME)
+        state["embedder"] = EmbeddingService(state["embed_model"], dim=EMBED_DIM)
     except Exception as e:
         raise RuntimeError(f"Failed loading embedding model: {e}")
 
+def load_vision_adapter(conn) -> Optional[VisionAdapter]:
+    try:
+        c = conn.cursor()
+        c.execute("SELECT endpoint_url, model_name, api_key, max_concurrency, max_edge, image_format, quality FROM vision_config WHERE id=1")
+        row = c.fetchone()
+        if row:
+            return VisionAdapter(row[0], row[1], row[2], max_concurrency=row[3] or 4,
+                                 max_edge=row[4] or 1024, image_format=row[5] or "jpeg", quality=row[6] or 85)
+    except Exception as e:
+        print(f"Failed to load vision config: {e}")
+    return None
+
+def vision_config_key(conn):
+    # What an expansion depends on besides the query text
+    try:
+        row = conn.execute("SELECT endpoint_url, model_name FROM vision_config WHERE id=1").fetchone()
+        return tuple(row) if row else None
+    except Exception:
+        return None
+
+def expansion_client(conn):
+    """Shared adapter and breaker for query expansion; rebuilt after a remount or a vision config change."""
+    if state["expansion"] is None:
+        state["expansion"] = {
+            "adapter": load_vision_adapter(conn),
+            "breaker": CircuitBreaker(),
+            # Cache key -> running expansion, so a repeated query joins it instead of asking again
+            "pending": {},
+            "latency_ms": deque(maxlen=1000),
+            "counts": {"expanded": 0, "failed": 0, "over_budget": 0, "skipped_busy": 0, "skipped_open": 0},
+        }
+    return state["expansion"]
+
+def reset_expansion():
+    exp, state["expansion"] = state["expansion"], None
+    if exp and exp["adapter"]:
+        exp["adapter"].close()
+
+def vision_saturated(adapter) -> bool:
+    # An indexing job keeps every slot busy; a rewrite would only queue behind it
+    scan = state.get("scan_adapter")
+    if scan is not None and scan.endpoint_url == adapter.endpoint_url and scan.saturated():
+        return True
+    return adapter.saturated()
+
+def read_conn():
+    """This thread's read-only connection to the mounted DB; reads never share the writer's cursor."""
+    pool = state.get("pool")
+    return pool.reader() if pool else state["conn"]
+
+def save_index():
+    if not state.get("faiss") or not state.get("db_path"):
+        return
+    try:
+        # Pruning the vector log is a write; it goes through the API writer like any other
+        with state["pool"].write() as conn:
+            state["faiss"].save(index_path_for(state["db_path"]), conn)
+    except Exception as e:
+        print(f"Failed to save FAISS index: {e}")
+
+@app.on_event("shutdown")
+def persist_index():
+    stop_watcher()
+    save_index()
+    reset_expansion()
+    if state.get("pool"):
+        state["pool"].close()
+
+# Scans, scan jobs and watcher batches all write through the one connection; one at a time.
+# Reentrant: a watcher batch holds it around run_scan, which takes it too.
+scan_lock = threading.RLock()
+
+def stop_watcher():
+    if state.get("watcher"):
+        state["watcher"].stop()
+        state["watcher"] = None
+    with scan_lock:
+        close_watch_session()
+
+def close_watch_session():
+    # Callers hold scan_lock
+    session, state["watch_session"] = state["watch_session"], None
+    if session:
+        session.close()
+
+def index_changes(changed, deleted):
+    # Called by the watcher with a debounced batch of paths
+    conn = state["conn"]
+    if not conn:
+        return
+    added = 0
+    # Held from opening the session to the last write: a full scan or remount in between
+    # would close the session (and its process pool) under this batch
+    with scan_lock:
+        # Opened by the first batch, then kept: a few files must not reload the library
+        if state["watch_session"] is None:
+            state["watch_session"] = ScanSession(conn)
+        session = state["watch_session"]
+        if changed:
+            added, _ = run_scan(Path(state["mounted_path"]), conn, paths=sorted(changed), session=session)
+        with state["pool"].write_lock:
+            removed = remove_paths(conn, deleted, state.get("faiss"), session=session)
+    if added or removed:
+        print(f"Watcher: indexed {added}, removed {removed}")
+
 class MountRequest(BaseModel):
     path: str
+    # Index new/changed/deleted photos as they appear (watchdog if installed, else polling)
+    watch: Optional[bool] = False
 
 @app.post("/mount")
 def mount(req: MountRequest):
@@ -65,24 +203,75 @@ def mount(req: MountRequest):
     if not p.exists() or not p.is_dir():
         raise HTTPException(status_code=400, detail="path does not exist or is not a directory")
     db_path = p.joinpath(".memory_index.db")
+    stop_watcher()
     conn = init_db(str(db_path))
+    index_cfg = load_index_config(conn)
+    reset_expansion()
+    if state.get("pool"):
+        state["pool"].close()
     state.update({
         "mounted_path": str(p),
         "db_path": str(db_path),
         "conn": conn,
-        "faiss": FaissManager(EMBED_DIM)
+        "pool": ConnectionPool(str(db_path), conn),
+        "faiss": FaissManager(EMBED_DIM, index_cfg,
+                              store=EmbeddingStore(store_path_for(str(db_path)), EMBED_DIM, index_cfg.store_dtype))
     })
-    # Build FAISS from existing DB
-    state["faiss"].build_from_db(conn)
+    state["query_cache"].attach(state["pool"])
+    jobs.attach(state["pool"])
+    # Map the saved index and replay the change log; full rebuild only if it is missing or stale
+    if not state["faiss"].load(index_path_for(str(db_path)), conn):
+        state["faiss"].build_from_db(conn)
+        save_index()
     # count entries
     cur = conn.cursor()
     cur.execute("SELECT COUNT(1) FROM memories")
     count = cur.fetchone()[0]
-    return {"status": "ok", "db_path": str(db_path), "count": count}
+    if req.watch:
+        state["watcher"] = DirectoryWatcher(str(p), index_changes).start()
+    return {"status": "ok", "db_path": str(db_path), "count": count,
+            "watching": state["watcher"].mode if state["watcher"] else None}
 
 class ScanRequest(BaseModel):
     path: Optional[str] = None
     rescan: Optional[bool] = False
+    workers: Optional[PipelineConfig] = None
+    # Run as a job: returns a job_id immediately, progress via /jobs/{job_id}/events
+    background: Optional[bool] = False
+
+def run_scan(base: Path, conn, rescan=False, config=None, job=None, paths=None, session=None):
+    with scan_lock:
+        if paths is None:
+            # The watch snapshot would miss everything this scan writes
+            close_watch_session()
+        # Load vision config if available. One adapter (and connection pool) for the whole scan.
+        vision_adapter = load_vision_adapter(conn)
+        state["scan_adapter"] = vision_adapter
+        stats = {}
+        try:
+            added, skipped = scan_and_index(base, conn, state["embedder"], rebuild=rescan, faiss_mgr=state.get("faiss"), vision_adapter=vision_adapter, config=config, job=job, paths=paths, stats=stats, session=session,
+                                           write_lock=state["pool"].write_lock if state.get("pool") else None)
+        finally:
+            if stats.get("ocr"):
+                state["ocr_stats"] = stats["ocr"]
+            state["scan_adapter"] = None
+            if vision_adapter:
+                state["vision_stats"] = vision_adapter.stats()
+                vision_adapter.close()
+        # The scan updated FAISS in place; only rebuild if it drifted from the DB.
+        # The save rewrites the file only if something changed (a no-op rescan keeps the mapping).
+        # Watcher batches skip the save: the vector log replays them on the next load.
+        if state.get("faiss") and paths is None:
+            state["faiss"].sync(conn)
+            save_index()
+    return added, skipped
+
+def run_scan_job(job):
+    if not state["conn"]:
+        raise RuntimeError("no mounted drive")
+    run_scan(Path(job.root), state["conn"], rescan=job.rescan, config=job.config, job=job)
+
+jobs = JobManager(run_scan_job)
 
 @app.post("/scan")
 def scan(req: ScanRequest):
@@ -94,133 +283,420 @@ def scan(req: ScanRequest):
         base = Path(state["mounted_path"])
     if not base.exists():
         raise HTTPException(status_code=400, detail="scan path does not exist")
+    if req.background:
+        if not state["conn"]:
+            raise HTTPException(status_code=400, detail="Background scans need a mounted drive. Call /mount first.")
+        job = jobs.submit(str(base), rescan=bool(req.rescan), config=req.workers)
+        return {"status": "queued", "scanned_path": str(base), "job_id": job.id}
     conn = state["conn"] or init_db(str(base.joinpath(".memory_index.db")))
-    model = state["embed_model"]
+    added, skipped = run_scan(base, conn, rescan=req.rescan, config=req.workers)
+    return {"status": "ok", "scanned_path": str(base), "new": added, "skipped": skipped}
 
-    # Load vision config if available
-    vision_adapter = None
-    try:
-        c = conn.cursor()
-        c.execute("SELECT endpoint_url, model_name, api_key FROM vision_config WHERE id=1")
-        row = c.fetchone()
-        if row:
-            vision_adapter = VisionAdapter(row[0], row[1], row[2])
-    except Exception as e:
-        print(f"Failed to load vision config: {e}")
+def require_job(job_id: str):
+    job = jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job
 
-    added, skipped = scan_and_index(base, conn, model, rebuild=req.rescan, faiss_mgr=state.get("faiss"), vision_adapter=vision_adapter)
-    # After scan, ensure FAISS rebuilt if needed
-    if state.get("faiss"):
-        state["faiss"].build_from_db(conn)
-    return {"status": "ok", "scanned_path": str(base), "new": added, "skipped": skipped}
+@app.get("/jobs")
+def list_jobs():
+    return {"jobs": jobs.list()}
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    return require_job(job_id).snapshot()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str, interval: float = 1.0):
+    """Server-sent events: one progress snapshot per interval until the job ends."""
+    require_job(job_id)
+
+    async def stream():
+        while True:
+            # Re-fetch: resuming an interrupted job replaces the object
+            snap = jobs.get(job_id).snapshot()
+            yield f"event: progress\ndata: {json.dumps(snap)}\n\n"
+            if snap["status"] in FINISHED or snap["status"] == "interrupted":
+                break
+            await asyncio.sleep(max(0.1, interval))
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/jobs/{job_id}/pause")
+def pause_job(job_id: str):
+    job = require_job(job_id)
+    if not job.pause():
+        raise HTTPException(status_code=409, detail=f"cannot pause a {job.status} job")
+    return job.snapshot()
+
+@app.post("/jobs/{job_id}/resume")
+def resume_job(job_id: str):
+    job = jobs.resume(require_job(job_id).id)
+    if not job:
+        raise HTTPException(status_code=409, detail="job is not paused or interrupted")
+    return job.snapshot()
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    job = require_job(job_id)
+    if not jobs.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"cannot cancel a {job.status} job")
+    return job.snapshot()
 
 class SearchRequest(BaseModel):
     query: str
     top_k: Optional[int] = 12
     date_from: Optional[str] = None
     date_to: Optional[str] = None
+    # Thumbnails are served by /thumbnail/{file_id}; inline base64 only on request
+    inline_thumbnails: Optional[bool] = False
+    # One result per near-duplicate cluster (burst shots, edits), the best-ranked member
+    collapse_clusters: Optional[bool] = False
 
-@app.post("/search")
-async def search(req: SearchRequest):
-    if not state.get("faiss") or state["faiss"].index.ntotal == 0:
+class BatchSearchRequest(BaseModel):
+    queries: List[SearchRequest]
+
+def require_index():
+    if not state.get("faiss") or state["faiss"].count() == 0:
         # try to build from DB
         if state.get("conn"):
-            state["faiss"].build_from_db(state["conn"])
+            state["faiss"].build_from_db(read_conn())
         else:
             raise HTTPException(status_code=400, detail="no index available; mount and scan first")
 
-    # Query rewriting
-    search_query = req.query
-    conn = state.get("conn")
-    if conn:
+async def run_expansion(exp, query: str, key: str) -> str:
+    # Runs to completion even when the search that started it stopped waiting,
+    # so a late answer still lands in the cache and still counts for the breaker
+    t0 = time.perf_counter()
+    try:
+        expanded = await exp["adapter"].expand_query(query)
+    except Exception as e:
+        print(f"Query expansion failed: {e}")
+        expanded = None
+    exp["latency_ms"].append((time.perf_counter() - t0) * 1000)
+    exp["breaker"].record(expanded is not None)
+    if expanded is None:
+        exp["counts"]["failed"] += 1
+        return query
+    exp["counts"]["expanded"] += 1
+    if len(expanded) > 5:
+        print(f"Rewrote query '{query}' -> '{expanded}'")
+        # Only successful rewrites are cached; failures retry next time.
+        # Skipped if the drive was remounted meanwhile: the cache now belongs to another DB
+        if state["expansion"] is exp:
+            state["query_cache"].put("expansion", key, expanded)
+        return expanded
+    return query
+
+async def expand_search_query(query: str, budget: Optional[float] = EXPANSION_BUDGET) -> str:
+    """
+    LLM rewrite of the query, or the query itself when the rewrite is not back within
+    `budget` seconds (None waits for the request timeout), the endpoint keeps failing,
+    or a scan has every vision slot busy.
+    """
+    if not state.get("conn"):
+        return query
+    conn = read_conn()
+    vision_key = vision_config_key(conn)
+    if not vision_key:
+        return query
+    cache = state["query_cache"]
+    key = cache_key(query, *vision_key)
+    cached = cache.get("expansion", key)
+    if cached is not None:
+        return cached
+    exp = expansion_client(conn)
+    if not exp["adapter"]:
+        return query
+    task = exp["pending"].get(key)
+    if task is None:
+        if vision_saturated(exp["adapter"]):
+            exp["counts"]["skipped_busy"] += 1
+            return query
+        if not exp["breaker"].allow():
+            exp["counts"]["skipped_open"] += 1
+            return query
+        task = asyncio.ensure_future(run_expansion(exp, query, key))
+        exp["pending"][key] = task
+        task.add_done_callback(lambda _: exp["pending"].pop(key, None))
+    try:
+        # shield: giving up on the wait must not cancel the request itself
+        return await asyncio.wait_for(asyncio.shield(task), budget)
+    except asyncio.TimeoutError:
+        exp["counts"]["over_budget"] += 1
+        return query
+
+async def encode_search_query(text: str) -> np.ndarray:
+    cache = state["query_cache"]
+    key = cache_key(text, MODEL_NAME)
+    qvec = cache.get("vector", key)
+    if qvec is None:
+        # Concurrent searches are micro-batched into one forward pass
+        qvec = await state["embedder"].aencode(text)
+        cache.put("vector", key, qvec)
+    return qvec
+
+@app.post("/search")
+async def search(req: SearchRequest):
+    require_index()
+    search_query = await expand_search_query(req.query)
+    qvec = await encode_search_query(search_query)
+    return {"results": rank_results(req, qvec)}
+
+@app.post("/search/stream")
+async def search_stream(req: SearchRequest):
+    """
+    NDJSON, one object per line. First {"phase": "initial"}: vector hits for the raw
+    query, without waiting for the LLM. Then {"phase": "refined", "final": true}: the
+    hybrid ranking for the expanded query, which replaces the first list.
+    """
+    require_index()
+
+    async def stream():
+        t0 = time.perf_counter()
+        # Expansion starts now and runs while the first phase is answered
+        # Nothing is blocked on it, so no latency budget: wait for the LLM's own timeout
+        expansion = asyncio.create_task(expand_search_query(req.query, budget=None))
         try:
-            c = conn.cursor()
-            c.execute("SELECT endpoint_url, model_name, api_key FROM vision_config WHERE id=1")
-            row = c.fetchone()
-            if row:
-                adapter = VisionAdapter(row[0], row[1], row[2])
-                expanded = await adapter.expand_query(req.query)
-                if expanded and len(expanded) > 5:
-                    print(f"Rewrote query '{req.query}' -> '{expanded}'")
-                    search_query = expanded
-        except Exception as e:
-            print(f"Query expansion failed: {e}")
-
-    qvec = state["embed_model"].encode(search_query).astype("float32")
-    results = state["faiss"].search(qvec, topk=req.top_k)
-    
-    # ------------------ Hybrid Scoring & Re-ranking ------------------
-    # Boost factor: If raw query terms exist in text, improve score (lower distance).
-    raw_terms = [t.lower() for t in req.query.split() if len(t) > 2] # Ignore small words
-    
+            qvec = await encode_search_query(req.query)
+            yield json.dumps({"phase": "initial", "query": req.query, "results": rank_results(req, qvec, hybrid=False),
+                              "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}) + "\n"
+            expanded = await expansion
+            if expanded != req.query:
+                qvec = await encode_search_query(expanded)
+            yield json.dumps({"phase": "refined", "final": True, "query": req.query, "expanded_query": expanded,
+                              "results": rank_results(req, qvec),
+                              "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1)}) + "\n"
+        finally:
+            # Client went away before the refinement was needed
+            if not expansion.done():
+                expansion.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache"})
+
+@app.post("/search/batch")
+async def search_batch(req: BatchSearchRequest):
+    require_index()
+    expanded = await asyncio.gather(*(expand_search_query(q.query) for q in req.queries))
+    cache = state["query_cache"]
+    keys = [cache_key(text, MODEL_NAME) for text in expanded]
+    qvecs = [cache.get("vector", k) for k in keys]
+    missing = [i for i, v in enumerate(qvecs) if v is None]
+    if missing:
+        # Uncached queries encoded in a single forward pass
+        fresh = await asyncio.to_thread(state["embedder"].encode, [expanded[i] for i in missing])
+        for i, vec in zip(missing, fresh):
+            qvecs[i] = vec
+            cache.put("vector", keys[i], vec)
+    return {"batches": [{"query": q.query, "results": rank_results(q, v)} for q, v in zip(req.queries, qvecs)]}
+
+@app.get("/search/cache")
+def search_cache_stats():
+    return state["query_cache"].stats()
+
+@app.get("/search/expansion")
+def search_expansion_stats():
+    """Query expansion health: breaker state, outcomes and LLM latency."""
+    exp = state["expansion"]
+    if not exp or not exp["adapter"]:
+        return {"configured": False, "budget_ms": EXPANSION_BUDGET * 1000}
+    ms = sorted(exp["latency_ms"])
+    out = {"configured": True, "budget_ms": EXPANSION_BUDGET * 1000, "breaker": exp["breaker"].stats(),
+           "in_flight": len(exp["pending"]), **exp["counts"]}
+    if ms:
+        out.update({"llm_ms_mean": round(sum(ms) / len(ms), 1), "llm_ms_p95": round(ms[int(0.95 * (len(ms) - 1))], 1)})
+    return out
+
+@app.delete("/search/cache")
+def clear_search_cache():
+    state["query_cache"].clear()
+    return {"status": "ok"}
+
+def date_filter_sql(req: SearchRequest):
+    # Rows without an exif_date are never filtered out (matches the old post-filter)
+    clauses, params = [], []
+    if req.date_from:
+        clauses.append("(exif_date IS NULL OR exif_date >= ?)")
+        params.append(req.date_from)
+    if req.date_to:
+        clauses.append("(exif_date IS NULL OR exif_date <= ?)")
+        params.append(req.date_to)
+    return clauses, params
+
+def thumbnail_url(file_id, content_hash):
+    # The hash in the query string makes the URL change when the file does, so it can be cached forever
+    return f"/thumbnail/{file_id}?v={(content_hash or '')[:16]}"
+
+def inline_thumbnails_for(hashes):
+    """Default-size thumbnails as data URLs, {hash: data_url}, for the opt-in inline mode."""
+    out = {}
+    for h in hashes:
+        data, _ = thumbnails.get_thumbnail(read_conn(), h, write=state["pool"].write)
+        out[h] = thumbnails.data_url(data)
+    return out
+
+def copy_counts(hashes):
+    if not hashes:
+        return {}
+    rows = read_conn().execute(
+        f"SELECT hash, COUNT(*) FROM memory_paths WHERE hash IN ({','.join('?' * len(hashes))}) GROUP BY hash",
+        list(hashes)).fetchall()
+    return dict(rows)
+
+def hydrate(vec_ids, inline_thumbnails=False):
+    """One query for all hits instead of one SELECT per vector. Returns {vec_id: row dict}."""
+    if not vec_ids:
+        return {}
+    cols = "vec_id, file_id, path, created_at, exif_date, memory_summary, tags, vision_status, hash, cluster_id"
+    c = read_conn().cursor()
+    c.execute(f"SELECT {cols} FROM memories WHERE vec_id IN ({','.join('?' * len(vec_ids))})", list(vec_ids))
+    rows = c.fetchall()
+    inline = inline_thumbnails_for({row[8] for row in rows if row[8]}) if inline_thumbnails else {}
+    copies = copy_counts([row[8] for row in rows if row[8]])
+    out = {}
+    for row in rows:
+        vec_id, file_id, path_val, created_at, exif_date, summary, tags, vision_status, content_hash, cluster_id = row
+        rec = {
+            "file_id": file_id,
+            "path": path_val,
+            "summary": summary,
+            "tags": tags,
+            "vision_status": vision_status,
+            "created_at": created_at,
+            "exif_date": exif_date,
+            "thumbnail_url": thumbnail_url(file_id, content_hash),
+            # Identical files are one memory; this is how many paths hold it
+            "copies": copies.get(content_hash, 1),
+            "cluster_id": cluster_id,
+        }
+        if inline_thumbnails:
+            rec["thumbnail_b64"] = inline.get(content_hash)
+        out[vec_id] = rec
+    return out
+
+# Reciprocal rank fusion constant (standard value from the RRF paper)
+RRF_K = 60
+
+def collapse_clusters(ranked, top_k):
+    """Keeps the best-ranked hit of each near-duplicate cluster. Returns (ranked, {cluster_id: size})."""
+    if not ranked:
+        return ranked, {}
+    conn = read_conn()
+    ids = [vec_id for vec_id, _ in ranked]
+    clusters = dict(conn.execute(
+        f"SELECT vec_id, cluster_id FROM memories WHERE vec_id IN ({','.join('?' * len(ids))})", ids).fetchall())
+    out, taken = [], set()
+    for vec_id, rrf in ranked:
+        cid = clusters.get(vec_id)
+        if cid is not None:
+            if cid in taken:
+                continue
+            taken.add(cid)
+        out.append((vec_id, rrf))
+        if len(out) == top_k:
+            break
+    sizes = {}
+    if taken:
+        sizes = dict(conn.execute(
+            f"SELECT cluster_id, COUNT(*) FROM memories WHERE cluster_id IN ({','.join('?' * len(taken))}) GROUP BY cluster_id",
+            list(taken)).fetchall())
+    return out, sizes
+
+def rank_results(req: SearchRequest, qvec, hybrid=True):
+    """
+    Hybrid search: FAISS neighbours of the (expanded) query vector and BM25 hits for
+    the raw query words are retrieved independently, then merged by reciprocal rank fusion.
+    `hybrid=False` ranks by the vector alone (the streaming search's first phase).
+    """
+    conn = read_conn()
+
+    # Date filters run in SQL (idx_keyset_exif) and restrict both retrievers
+    allowed = None
+    clauses, params = date_filter_sql(req)
+    if clauses:
+        c = conn.cursor()
+        c.execute(f"SELECT vec_id FROM memories WHERE vec_id IS NOT NULL AND {' AND '.join(clauses)}", params)
+        allowed = [r[0] for r in c.fetchall()]
+    # Collapsing drops cluster members, so retrieve extra candidates to still fill top_k
+    fetch_k = req.top_k * 3 if req.collapse_clusters else req.top_k
+    vector_hits = state["faiss"].search(qvec, topk=fetch_k, allowed_ids=allowed)
+    keyword_ids = fts_search(conn, req.query, fetch_k, clauses, params) if hybrid else []
+
+    fused = {}
+    distances = {}
+    for rank, r in enumerate(vector_hits):
+        fused[r["vec_id"]] = 1.0 / (RRF_K + rank + 1)
+        distances[r["vec_id"]] = r["score"]
+    for rank, vec_id in enumerate(keyword_ids):
+        fused[vec_id] = fused.get(vec_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+    # Keyword-only hits still get a real distance so scores stay comparable
+    missing = [v for v in keyword_ids if v not in distances]
+    if missing:
+        c = conn.cursor()
+        c.execute(f"SELECT vec_id, embedding FROM memories WHERE vec_id IN ({','.join('?' * len(missing))})", missing)
+        q = np.asarray(qvec, dtype="float32").ravel()
+        for vec_id, emb_blob in c.fetchall():
+            if emb_blob and len(emb_blob) == q.size * 4:
+                diff = np.frombuffer(emb_blob, dtype=np.float32) - q
+                distances[vec_id] = float(diff @ diff)
+
+    ranked = sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
+    if req.collapse_clusters:
+        ranked, cluster_sizes = collapse_clusters(ranked, req.top_k)
+    ranked = ranked[:req.top_k]
+    rows = hydrate([vec_id for vec_id, _ in ranked], req.inline_thumbnails)
+    keyword_set = set(keyword_ids)
+    vector_set = {r["vec_id"] for r in vector_hits}
+
     processed_results = []
-    
-    c = conn.cursor()
-    for r in results:
-        fid, path, score = r["file_id"], r["path"], r["score"]
-        
-        c.execute("SELECT file_id, path, created_at, exif_date, memory_summary, thumbnail, tags, vision_status FROM memories WHERE file_id=?", (fid,))
-        row = c.fetchone()
-        if not row:
+    for vec_id, rrf in ranked:
+        rec = rows.get(vec_id)
+        if not rec:
             continue
-            
-        file_id, path_val, created_at, exif_date, summary, thumbnail_blob, tags, vision_status = row
-
-        # Date filtering
-        if req.date_from or req.date_to:
-            ok = True
-            if req.date_from and exif_date and exif_date < req.date_from: ok = False
-            if req.date_to and exif_date and exif_date > req.date_to: ok = False
-            if not ok: continue
-        
-        # --- Keyword Boosting ---
-        text_content = (summary or "").lower() + " " + (tags or "").lower()
-        
-        # Count exact keyword matches
-        matches = sum(1 for term in raw_terms if term in text_content)
-        if matches > 0:
-            # Significant boost for exact matches
-            # e.g. 1 match -> score * 0.6, 2 matches -> score * 0.4
-            multiplier = max(0.2, 0.7 - (matches * 0.15)) 
-            score = score * multiplier
-        
-        thumb_b64 = None
-        if thumbnail_blob:
-            thumb_b64 = "data:image/jpeg;base64," + base64.b64encode(thumbnail_blob).decode("utf-8")
-
-        processed_results.append({
-             "file_id": file_id,
-             "path": path_val,
-             "score": float(score),
-             "summary": summary,
-             "tags": tags,
-             "vision_status": vision_status,
-             "created_at": created_at,
-             "exif_date": exif_date,
-             "thumbnail_b64": thumb_b64
-        })
-
-    # Sort by new scores (Ascending)
-    processed_results.sort(key=lambda x: x["score"])
-    
+        if vec_id in vector_set and vec_id in keyword_set:
+            match = "both"
+        elif vec_id in keyword_set:
+            match = "keyword"
+        else:
+            match = "vector"
+        processed_results.append({**rec, "score": distances.get(vec_id, 0.0), "rrf": rrf, "match": match})
+        if req.collapse_clusters:
+            processed_results[-1]["cluster_size"] = cluster_sizes.get(rec["cluster_id"], 1)
+
     # --- Dynamic Filtering ---
-    # Only show results within a reasonable range of the top result
+    # Vector-only results must be within a reasonable range of the best distance;
+    # lexical matches are kept regardless (that's the point of recalling them separately)
     if processed_results:
-        best_score = processed_results[0]["score"]
-        # Allow results up to +0.5 distance from best (or 1.5x, whichever is safer)
-        cutoff = best_score + 0.5 
-        
-        # Hard cap to prevent total garbage if everything is bad (e.g. > 1.4 unboosted)
-        # But if boosted, score will be < 1.0.
-        
-        filtered = [res for res in processed_results if res["score"] <= cutoff]
-        processed_results = filtered
+        # Allow results up to +0.5 distance from best
+        cutoff = min(r["score"] for r in processed_results) + 0.5
+        processed_results = [r for r in processed_results if r["match"] != "vector" or r["score"] <= cutoff]
 
     print(f"Search found {len(processed_results)} results (after filtering).")
     for r in processed_results[:3]:
         print(f" - {r['path']} (Score: {r['score']})")
 
-    return {"results": processed_results}
+    return processed_results
+
+@app.post("/index/rebuild")
+def rebuild_index():
+    if not state.get("conn"):
+        raise HTTPException(status_code=400, detail="No DB loaded")
+    state["faiss"].build_from_db(read_conn())
+    save_index()
+    return {"status": "ok", "count": state["faiss"].count(), "index_type": state["faiss"].kind}
+
+class BenchmarkRequest(BaseModel):
+    configs: Optional[List[IndexConfig]] = None
+    queries: Optional[int] = 200
+    top_k: Optional[int] = 10
+
+@app.post("/index/benchmark")
+def benchmark_index(req: BenchmarkRequest):
+    """Recall@k and latency of each index config against the exact flat baseline."""
+    if not state.get("conn"):
+        raise HTTPException(status_code=400, detail="No DB loaded")
+    return {"report": benchmark(read_conn(), EMBED_DIM, req.configs, n_queries=req.queries, k=req.top_k)}
 
 class OpenRequest(BaseModel):
     file_id: str
@@ -229,7 +705,7 @@ class OpenRequest(BaseModel):
 def open_file(req: OpenRequest):
     if not state.get("conn"):
         raise HTTPException(status_code=400, detail="No DB loaded")
-    c = state["conn"].cursor()
+    c = read_conn().cursor()
     c.execute("SELECT path FROM memories WHERE file_id=?", (req.file_id,))
     row = c.fetchone()
     if not row:
@@ -255,7 +731,7 @@ def open_file(req: OpenRequest):
 def get_full_image(file_id: str):
     if not state.get("conn"):
         raise HTTPException(status_code=400, detail="No DB loaded")
-    c = state["conn"].cursor()
+    c = read_conn().cursor()
     c.execute("SELECT path FROM memories WHERE file_id=?", (file_id,))
     row = c.fetchone()
     if not row:
@@ -268,21 +744,37 @@ def get_full_image(file_id: str):
     return FileResponse(path)
 
 @app.get("/thumbnail/{file_id}")
-def thumbnail(file_id: str):
+def thumbnail(file_id: str, request: Request, size: int = thumbnails.DEFAULT_SIZE,
+              fmt: str = Query(thumbnails.DEFAULT_FORMAT, alias="format"), v: Optional[str] = None):
     if not state.get("conn"):
         raise HTTPException(status_code=400, detail="No DB loaded")
-    c = state["conn"].cursor()
-    c.execute("SELECT thumbnail FROM memories WHERE file_id=?", (file_id,))
+    if fmt not in thumbnails.THUMB_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {sorted(thumbnails.THUMB_FORMATS)}")
+    c = read_conn().cursor()
+    c.execute("SELECT hash, path FROM memories WHERE file_id=?", (file_id,))
     row = c.fetchone()
     if not row or not row[0]:
         raise HTTPException(status_code=404, detail="thumbnail not found")
-    return Response(content=row[0], media_type="image/jpeg")
+    content_hash, path_val = row
+    size = thumbnails.snap_size(size)
+    tag = thumbnails.etag(content_hash, size, fmt)
+    # Versioned URLs (?v=<hash>) never change content; bare ones revalidate via the ETag
+    versioned = bool(v) and content_hash.startswith(v)
+    headers = {"ETag": tag, "Cache-Control": "public, max-age=31536000, immutable" if versioned else "no-cache"}
+    if request.headers.get("if-none-match") == tag:
+        return Response(status_code=304, headers=headers)
+    data, final = thumbnails.get_thumbnail(read_conn(), content_hash, size, fmt, path_val, write=state["pool"].write)
+    if data is None:
+        raise HTTPException(status_code=404, detail="thumbnail not found")
+    if not final:
+        headers = {"Cache-Control": "no-store"}
+    return Response(content=data, media_type=thumbnails.mime_for(fmt), headers=headers)
 
 @app.get("/memory/{file_id}")
 def memory(file_id: str):
     if not state.get("conn"):
         raise HTTPException(status_code=400, detail="No DB loaded")
-    c = state["conn"].cursor()
+    c = read_conn().cursor()
     c.execute("SELECT file_id, path, hash, created_at, modified_at, exif_date, ocr_text, caption, memory_summary, tags, vision_json, vision_status FROM memories WHERE file_id=?", (file_id,))
     row = c.fetchone()
     if not row:
@@ -301,43 +793,120 @@ def memory(file_id: str):
         "vision_json": row[10],
         "vision_status": row[11]
     }
+    # Every file with these bytes (the memory itself is stored once)
+    c.execute("SELECT path FROM memory_paths WHERE hash=? ORDER BY path", (row[2],))
+    rec["paths"] = [r[0] for r in c.fetchall()] or [row[1]]
     return rec
 
 @app.get("/health")
 def health():
     return {"status": "ok", "mounted_path": state.get("mounted_path")}
 
+# /memories field name -> column. thumbnail_url is built from file_id + hash.
+MEMORY_FIELDS = {
+    "file_id": "file_id",
+    "path": "path",
+    "summary": "memory_summary",
+    "tags": "tags",
+    "vision_status": "vision_status",
+    "exif_date": "exif_date",
+    "created_at": "created_at",
+    "hash": "hash",
+    "thumbnail_url": "hash",
+}
+DEFAULT_MEMORY_FIELDS = ("file_id", "path", "summary", "tags", "vision_status", "exif_date", "thumbnail_url")
+SORT_COLUMNS = ("created_at", "exif_date")
+
+def encode_cursor(sort_value, file_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, file_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        sort_value, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return sort_value, file_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
 @app.get("/memories")
-def get_memories(limit: int = 50, offset: int = 0):
+def get_memories(limit: int = 50, cursor: Optional[str] = None, sort: str = "created_at",
+                 fields: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                 tag: Optional[str] = None, vision_status: Optional[str] = None,
+                 inline_thumbnails: bool = False, offset: int = 0):
+    """
+    Newest first, paged by keyset on (sort column, file_id): pass back `next_cursor`
+    to continue. Every page is an index range scan regardless of depth.
+    `fields` is a comma-separated projection; `offset` is kept for old clients.
+    """
     if not state.get("conn"):
         raise HTTPException(status_code=400, detail="No DB loaded")
-    c = state["conn"].cursor()
-    c.execute("""
-        SELECT file_id, path, created_at, exif_date, memory_summary, thumbnail, tags, vision_status
-        FROM memories 
-        ORDER BY created_at DESC 
-        LIMIT ? OFFSET ?
-    """, (limit, offset))
-    rows = c.fetchall()
-    
+    if sort not in SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"sort must be one of {SORT_COLUMNS}")
+    wanted = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(DEFAULT_MEMORY_FIELDS)
+    unknown = [f for f in wanted if f not in MEMORY_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"unknown fields: {unknown}")
+    limit = max(1, min(limit, 500))
+
+    cols = list(dict.fromkeys([sort, "file_id", "hash"] + [MEMORY_FIELDS[f] for f in wanted]))
+    clauses, params = [], []
+    if date_from:
+        clauses.append(f"{sort} >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append(f"{sort} <= ?")
+        params.append(date_to)
+    if vision_status:
+        clauses.append("vision_status = ?")
+        params.append(vision_status)
+    if tag:
+        expr = fts_tag_expr(tag)
+        if not expr or not has_fts(read_conn()):
+            return {"results": [], "next_cursor": None}
+        clauses.append("vec_id IN (SELECT rowid FROM memories_fts WHERE memories_fts MATCH ?)")
+        params.append(expr)
+
+    def page(extra, extra_params, n, skip=0):
+        where = " AND ".join(clauses + extra) or "1"
+        sql = f"SELECT {', '.join(cols)} FROM memories WHERE {where} ORDER BY {sort} DESC, file_id DESC LIMIT ? OFFSET ?"
+        return read_conn().execute(sql, params + extra_params + [n, skip]).fetchall()
+
+    # Rows without a sort value come last (SQLite sorts NULL lowest); they are paged separately
+    # so the main range stays a plain (sort, file_id) < (?, ?) index seek.
+    after = decode_cursor(cursor) if cursor else None
+    # Legacy offset spans both ranges: what the first range does not use up skips NULL rows
+    skip = offset if offset > 0 and not cursor else 0
+    rows = []
+    if after is None or after[0] is not None:
+        keyset = [f"({sort}, file_id) < (?, ?)"] if after else [f"{sort} IS NOT NULL"]
+        rows = page(keyset, list(after) if after else [], limit + 1, skip)
+        if skip and not rows:
+            where = " AND ".join(clauses + keyset)
+            skip -= read_conn().execute(f"SELECT COUNT(*) FROM memories WHERE {where}", params).fetchone()[0]
+        else:
+            skip = 0
+    if len(rows) <= limit:
+        null_keyset = [f"{sort} IS NULL"] + (["file_id < ?"] if after and after[0] is None else [])
+        rows += page(null_keyset, [after[1]] if after and after[0] is None else [], limit + 1 - len(rows), max(0, skip))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    idx = {c: i for i, c in enumerate(cols)}
+    inline = inline_thumbnails_for({r[idx["hash"]] for r in rows if r[idx["hash"]]}) if inline_thumbnails else {}
     out = []
     for row in rows:
-        file_id, path_val, created_at, exif_date, summary, thumbnail_blob, tags, vision_status = row
-        thumb_b64 = None
-        if thumbnail_blob:
-            thumb_b64 = "data:image/jpeg;base64," + base64.b64encode(thumbnail_blob).decode("utf-8")
-        
-        out.append({
-            "file_id": file_id,
-            "path": path_val,
-            "score": 0.0, # No score for direct listing
-            "summary": summary,
-            "tags": tags,
-            "vision_status": vision_status,
-            "exif_date": exif_date,
-            "thumbnail_b64": thumb_b64
-        })
-    return {"results": out}
+        rec = {}
+        for f in wanted:
+            if f == "thumbnail_url":
+                rec[f] = thumbnail_url(row[idx["file_id"]], row[idx["hash"]])
+            else:
+                rec[f] = row[idx[MEMORY_FIELDS[f]]]
+        if fields is None:
+            rec["score"] = 0.0 # No score for direct listing
+        if inline_thumbnails:
+            rec["thumbnail_b64"] = inline.get(row[idx["hash"]])
+        out.append(rec)
+    next_cursor = encode_cursor(rows[-1][idx[sort]], rows[-1][idx["file_id"]]) if has_more and rows else None
+    return {"results": out, "next_cursor": next_cursor}
 
 # --- Config Endpoints ---
 
@@ -345,6 +914,11 @@ class VisionConfig(BaseModel):
     endpoint_url: str
     model_name: str
     api_key: Optional[str] = "lm-studio"
+    max_concurrency: Optional[int] = 4
+    # Images are downscaled to max_edge and re-encoded before upload
+    max_edge: Optional[int] = 1024
+    image_format: Optional[str] = "jpeg"
+    quality: Optional[int] = 85
 
 @app.get("/config/vision")
 def get_vision_config():
@@ -353,25 +927,90 @@ def get_vision_config():
          # User might want to config before mount? No, DB is in mounted path.
          raise HTTPException(status_code=400, detail="Mount drive first to configure vision")
 
-    c = state["conn"].cursor()
-    c.execute("SELECT endpoint_url, model_name, api_key FROM vision_config WHERE id=1")
+    c = read_conn().cursor()
+    c.execute("SELECT endpoint_url, model_name, api_key, max_concurrency, max_edge, image_format, quality FROM vision_config WHERE id=1")
     row = c.fetchone()
     if row:
-        return {"endpoint_url": row[0], "model_name": row[1], "api_key": row[2]}
-    return {"endpoint_url": "", "model_name": "", "api_key": ""}
+        return {"endpoint_url": row[0], "model_name": row[1], "api_key": row[2], "max_concurrency": row[3] or 4,
+                "max_edge": row[4] or 1024, "image_format": row[5] or "jpeg", "quality": row[6] or 85}
+    return {"endpoint_url": "", "model_name": "", "api_key": "", "max_concurrency": 4,
+            "max_edge": 1024, "image_format": "jpeg", "quality": 85}
 
 @app.post("/config/vision")
 def set_vision_config(cfg: VisionConfig):
     if not state.get("conn"):
         raise HTTPException(status_code=400, detail="Mount drive first")
 
-    c = state["conn"].cursor()
+    cfg.image_format = (cfg.image_format or "jpeg").lower()
+    if cfg.image_format not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"image_format must be one of {sorted(IMAGE_FORMATS)}")
+
     # upsert
-    c.execute("INSERT OR REPLACE INTO vision_config (id, endpoint_url, model_name, api_key) VALUES (1, ?, ?, ?)",
-              (cfg.endpoint_url, cfg.model_name, cfg.api_key))
-    state["conn"].commit()
+    with state["pool"].write() as conn:
+        conn.execute("INSERT OR REPLACE INTO vision_config (id, endpoint_url, model_name, api_key, max_concurrency, max_edge, image_format, quality) VALUES (1, ?, ?, ?, ?, ?, ?, ?)",
+                     (cfg.endpoint_url, cfg.model_name, cfg.api_key, cfg.max_concurrency, cfg.max_edge, cfg.image_format, cfg.quality))
+    reset_expansion()
     return {"status": "saved"}
 
+@app.get("/vision/stats")
+def get_vision_stats():
+    return state["vision_stats"] or {"requests": 0}
+
+@app.get("/ocr/stats")
+def get_ocr_stats():
+    """OCR time per file and how many files skipped OCR (and why), for the last scan."""
+    return state["ocr_stats"] or {"files": 0}
+
+@app.get("/vision/cache")
+def get_analysis_cache():
+    if not state.get("conn"):
+        raise HTTPException(status_code=400, detail="Mount drive first")
+    return {"entries": analysis_cache.summary(read_conn())}
+
+@app.delete("/vision/cache")
+def clear_analysis_cache(kind: Optional[str] = None):
+    """Forget cached vision/OCR results so the next rescan asks the model again."""
+    if not state.get("conn"):
+        raise HTTPException(status_code=400, detail="Mount drive first")
+    if kind and kind not in analysis_cache.KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {', '.join(analysis_cache.KINDS)}")
+    with state["pool"].write() as conn:
+        analysis_cache.clear(conn, kind)
+    return {"status": "ok"}
+
+@app.get("/config/index")
+def get_index_config():
+    if not state.get("conn"):
+        raise HTTPException(status_code=400, detail="Mount drive first")
+    cfg = load_index_config(read_conn())
+    return {**cfg.model_dump(), "active_type": state["faiss"].kind, "count": state["faiss"].count()}
+
+@app.post("/config/index")
+def set_index_config(cfg: IndexConfig):
+    if not state.get("conn"):
+        raise HTTPException(status_code=400, detail="Mount drive first")
+    if cfg.index_type not in INDEX_TYPES:
+        raise HTTPException(status_code=400, detail=f"index_type must be one of {', '.join(INDEX_TYPES)}")
+    if cfg.index_type == "ivf_pq" and EMBED_DIM % cfg.pq_m:
+        raise HTTPException(status_code=400, detail=f"pq_m must divide the embedding dimension ({EMBED_DIM})")
+    if cfg.store_dtype not in STORE_DTYPES:
+        raise HTTPException(status_code=400, detail=f"store_dtype must be one of {', '.join(STORE_DTYPES)}")
+
+    with state["pool"].write() as conn:
+        conn.execute("""INSERT OR REPLACE INTO index_config
+                        (id, index_type, train_threshold, nlist, pq_m, hnsw_m, nprobe, ef_search, store_dtype)
+                        VALUES (1, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (cfg.index_type, cfg.train_threshold, cfg.nlist, cfg.pq_m, cfg.hnsw_m, cfg.nprobe, cfg.ef_search,
+                      cfg.store_dtype))
+    # Search knobs apply immediately; a different index type means a rebuild.
+    # A new store dtype is picked up by the next rebuild (the old files no longer match).
+    state["faiss"].config = cfg
+    if state["faiss"].store is not None:
+        state["faiss"].store.dtype = cfg.store_dtype
+    if state["faiss"].sync(read_conn()):
+        save_index()
+    return {"status": "saved", "active_type": state["faiss"].kind}
+
 @app.post("/config/vision/test")
 async def test_vision_config(cfg: VisionConfig):
     # Try to reach the endpoint with a simple chat message
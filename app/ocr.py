@@ -0,0 +1,143 @@
+# app/ocr.py
+import time
+import threading
+from collections import deque
+from typing import Optional, Tuple
+
+import numpy as np
+import pytesseract
+from PIL import Image
+
+# Pre-check: OCR only runs on images with something shaped like a line of text. Every
+# 16px column block of the edge map (sharp horizontal light/dark steps) is split into
+# runs of rows with stroke edges in them; a run is a line candidate when it is glyph-height
+# and stroke-dense, and a text line is such a band continuing across LINE_BLOCKS
+# neighbouring blocks (allowing LINE_DRIFT rows of slant per block). The search runs at
+# each of PRECHECK_SCALES so small captions and big sign lettering both fit LINE_HEIGHT.
+# Calibrated on photos (people, water, crowds, foliage, noise), which score 0-24, versus
+# documents, screenshots, receipts, slides, signs and captions on photos, which mostly
+# score in the hundreds; tiny or faint lettering can still fall under TEXT_LINE_MIN.
+PRECHECK_SCALES = (1024, 512, 256)
+PRECHECK_BLOCK = 16
+EDGE_DELTA = 32
+ROW_STROKES = 3 / PRECHECK_BLOCK
+LINE_HEIGHT = (4, 26)
+LINE_DENSITY = 0.2
+LINE_BLOCKS = 5
+LINE_DRIFT = 2
+TEXT_LINE_MIN = 32
+
+SKIP_REASONS = ("no_text", "vision_text", "cached", "undecodable")
+
+
+def _widen(mask: np.ndarray, rows: int) -> np.ndarray:
+    """Grow a (rows, blocks) mask up and down by `rows`."""
+    out = mask.copy()
+    for i in range(1, rows + 1):
+        out[i:] |= mask[:-i]
+        out[:-i] |= mask[i:]
+    return out
+
+
+def _line_rows(small: Image.Image) -> int:
+    """Block-rows of `small` that lie on a text line."""
+    px = np.asarray(small, dtype=np.int16)
+    h, w = px.shape
+    blocks = (w - 1) // PRECHECK_BLOCK
+    if blocks < LINE_BLOCKS or h < LINE_HEIGHT[0]:
+        return 0
+    edges = np.abs(np.diff(px, axis=1)) > EDGE_DELTA
+    density = edges[:, :blocks * PRECHECK_BLOCK].reshape(h, blocks, PRECHECK_BLOCK).mean(axis=2)
+    # Rows with a few strokes in them, bridging one-row gaps (noise has no real gaps)
+    active = _widen(density >= ROW_STROKES, 1)
+    starts = active & ~np.vstack([np.zeros((1, blocks), bool), active[:-1]])
+    run = np.cumsum(starts, axis=0) * active + np.arange(blocks) * (h + 1)
+    run = run.ravel()
+    size = blocks * (h + 1)
+    height = np.bincount(run, weights=active.ravel(), minlength=size)
+    ink = np.bincount(run, weights=(density * active).ravel(), minlength=size)
+    band = (height >= LINE_HEIGHT[0]) & (height <= LINE_HEIGHT[1]) & (ink >= LINE_DENSITY * height)
+    band[np.arange(blocks) * (h + 1)] = False  # id 0 of each block is "no run"
+    band = band[run].reshape(h, blocks)
+    # A line: the band carries on, give or take LINE_DRIFT rows, across LINE_BLOCKS blocks
+    reach = band[:, :blocks - LINE_BLOCKS + 1]
+    for k in range(1, LINE_BLOCKS):
+        reach = _widen(reach, LINE_DRIFT) & band[:, k:blocks - LINE_BLOCKS + 1 + k]
+    return int(reach.sum())
+
+
+def text_likelihood(gray: Image.Image) -> float:
+    """Text-line area found at the best scale, in rows at PRECHECK_SCALES[0]; 0 for none."""
+    small = gray.copy()
+    best = 0.0
+    for edge in PRECHECK_SCALES:
+        small.thumbnail((edge, edge))
+        best = max(best, _line_rows(small) * PRECHECK_SCALES[0] / edge)
+    return best
+
+
+def prepare(gray: Image.Image, precheck: bool = True) -> Optional[Tuple[bytes, Tuple[int, int]]]:
+    """Raw 8-bit buffer and size to send to an OCR worker, or None when the pre-check finds no text."""
+    if precheck and text_likelihood(gray) < TEXT_LINE_MIN:
+        return None
+    return gray.tobytes(), gray.size
+
+
+def ocr_buffer(data: bytes, size: Tuple[int, int]) -> Tuple[Optional[str], float]:
+    """Runs in a worker process: (text, milliseconds); text is None if tesseract failed."""
+    t0 = time.perf_counter()
+    try:
+        text = pytesseract.image_to_string(Image.frombytes("L", size, data))
+    except Exception:
+        text = None
+    return text, (time.perf_counter() - t0) * 1000
+
+
+class OcrEngine:
+    """
+    Tesseract on a process pool (the scan's decode pool, through `run`), fed grayscale buffers
+    the decode step already downscaled. Records per-file time and why files were skipped.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.timings = deque(maxlen=5000)
+        self.skips = {reason: 0 for reason in SKIP_REASONS}
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def read(self, buf: Tuple[bytes, Tuple[int, int]]) -> Optional[str]:
+        """Recognized text, or None if tesseract failed (missing binary, bad input)."""
+        text, ms = self.run(ocr_buffer, *buf)
+        with self._lock:
+            self.timings.append(ms)
+            if text is None:
+                self.failed += 1
+        return text
+
+    def skip(self, reason: str):
+        with self._lock:
+            self.skips[reason] += 1
+
+    def stats(self):
+        with self._lock:
+            ms = sorted(self.timings)
+            skips = dict(self.skips)
+        skipped = sum(skips.values())
+        files = len(ms) + skipped
+        if not files:
+            return {"files": 0}
+        out = {
+            "files": files,
+            "ocr_runs": len(ms),
+            "failed": self.failed,
+            "skipped": skips,
+            "skip_rate": round(skipped / files, 3),
+        }
+        if ms:
+            out.update({
+                "ocr_ms_mean": round(sum(ms) / len(ms), 1),
+                "ocr_ms_p95": round(ms[int(0.95 * (len(ms) - 1))], 1),
+                "ocr_ms_total": round(sum(ms), 1),
+            })
+        return out
@@ -0,0 +1,159 @@
+# app/perceptual.py
+import sqlite3
+import threading
+
+import numpy as np
+from PIL import Image
+
+from .db import configure
+
+# Bits that may differ for two images to count as the same shot (burst frames,
+# re-encodes, light edits). Out of 64; unrelated photos sit around 32.
+NEAR_DUP_DISTANCE = 6
+
+_DCT_SIZE = 32
+# DCT-II basis, so pHash needs no scipy
+_DCT = np.cos(np.pi * np.outer(np.arange(_DCT_SIZE), 2 * np.arange(_DCT_SIZE) + 1) / (2 * _DCT_SIZE))
+
+
+def _bits_to_int(bits) -> int:
+    out = 0
+    for b in np.asarray(bits).ravel():
+        out = (out << 1) | int(b)
+    return out
+
+
+def phash(image: Image.Image) -> int:
+    """64-bit DCT hash: low frequencies above/below their median."""
+    px = np.asarray(image.convert("L").resize((_DCT_SIZE, _DCT_SIZE), Image.LANCZOS), dtype="float64")
+    low = (_DCT @ px @ _DCT.T)[:8, :8]
+    # The DC term is overall brightness; it would dominate the median
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def dhash(image: Image.Image) -> int:
+    """64-bit gradient hash: is each pixel brighter than its right neighbour."""
+    px = np.asarray(image.convert("L").resize((9, 8), Image.LANCZOS), dtype="int16")
+    return _bits_to_int(px[:, 1:] > px[:, :-1])
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def to_sql(h: int) -> int:
+    # SQLite integers are signed 64-bit
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def from_sql(v: int) -> int:
+    return v + (1 << 64) if v < 0 else v
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes under Hamming distance. A radius query
+    only descends into children whose edge distance is within radius of the
+    query's distance to the node, which prunes most of the tree for small radii.
+    """
+
+    def __init__(self):
+        self.root = None  # [hash, value, {distance: child}]
+        self.size = 0
+
+    def add(self, h: int, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [h, value, {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, value, {}]
+                return
+            node = child
+
+    def search(self, h: int, radius: int):
+        """[(distance, value)] within radius, closest first."""
+        out = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                out.append((d, node[1]))
+            for edge, child in node[2].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        out.sort(key=lambda x: x[0])
+        return out
+
+    def nearest(self, h: int, radius: int):
+        hits = self.search(h, radius)
+        return hits[0][1] if hits else None
+
+
+class ClusterIndex:
+    """
+    Near-duplicate clusters for one scan. Cluster representatives live in a BK-tree;
+    a new image joins the nearest representative within `radius`, or starts its own
+    cluster. Each representative is a dict with its cluster_id (the representative's
+    file_id), its vision JSON once known and a `done` event set when analysis finished.
+    """
+
+    def __init__(self, conn, radius: int = NEAR_DUP_DISTANCE):
+        self.radius = radius
+        self.tree = BKTree()
+        self._lock = threading.Lock()
+        self._conn = None
+        path = conn.execute("PRAGMA database_list").fetchone()[2]
+        if path:
+            # Stored vision results are fetched lazily from worker threads
+            self._conn = configure(sqlite3.connect(path, check_same_thread=False))
+        rows = conn.execute(
+            "SELECT file_id, phash, dhash, vision_status FROM memories WHERE phash IS NOT NULL AND cluster_id = file_id"
+        )
+        for file_id, h, d, status in rows:
+            self.tree.add(from_sql(h), self._rep(file_id, from_sql(d) if d is not None else None,
+                                                 stored=status == "success", done=True))
+
+    @staticmethod
+    def _rep(file_id, d=None, stored=False, done=False):
+        rep = {"cluster_id": file_id, "dhash": d, "vision_json": None, "stored": stored, "done": threading.Event()}
+        if done:
+            rep["done"].set()
+        return rep
+
+    def assign(self, h: int, d: int, file_id: str):
+        """
+        The representative `file_id` belongs to; itself (newly added) if none is close enough.
+        Candidates found by pHash must also be close by dHash, which catches the rare
+        different-layout pair whose low frequencies happen to agree.
+        """
+        with self._lock:
+            for _, rep in self.tree.search(h, self.radius):
+                if rep["dhash"] is None or d is None or hamming(d, rep["dhash"]) <= 2 * self.radius:
+                    return rep
+            rep = self._rep(file_id, d)
+            self.tree.add(h, rep)
+            return rep
+
+    def vision_for(self, rep, timeout: float = 120.0):
+        """The representative's vision JSON, waiting while it is still being analyzed."""
+        if not rep["done"].wait(timeout):
+            return None
+        if rep["vision_json"] is None and rep["stored"] and self._conn is not None:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT vision_json FROM memories WHERE file_id=? AND vision_status='success'", (rep["cluster_id"],)
+                ).fetchone()
+            rep["vision_json"] = row[0] if row else None
+            rep["stored"] = False
+        return rep["vision_json"]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
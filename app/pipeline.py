@@ -0,0 +1,195 @@
+# app/pipeline.py
+import queue
+import threading
+from typing import Callable, Iterable, List, Optional
+
+from pydantic import BaseModel
+
+# Sentinel passed down a queue once a stage has no more work for the next one.
+_DONE = object()
+
+
+class PipelineConfig(BaseModel):
+    """Worker counts and queue bounds for the scan pipeline. `None` means auto."""
+    hash_workers: int = 4
+    decode_workers: Optional[int] = None  # process pool size, defaults to cpu count
+    vision_workers: Optional[int] = None  # defaults to the vision adapter's max_concurrency
+    embed_batch_size: int = 32
+    embed_flush_seconds: float = 0.2
+    queue_size: int = 64
+    # File bytes the hash stage may hold for the decode stage; queues bound items, not size
+    max_inflight_bytes: int = 256 * 1024 * 1024
+    # Skip OCR for images with no text-line-like band of strokes (see ocr.text_likelihood)
+    ocr_precheck: bool = True
+    # Rows per write transaction, and the longest a finished item waits to be committed
+    write_batch_size: int = 256
+    write_flush_seconds: float = 2.0
+    # Perceptual-hash bits two photos may differ by and still be one cluster (bursts, edits)
+    near_dup_distance: int = 6
+    # Members of a cluster reuse the representative's vision analysis instead of a new call
+    reuse_cluster_vision: bool = True
+
+
+class Pipeline:
+    """
+    A chain of stages joined by bounded queues. Each stage runs `workers` threads
+    that pull an item, call its function and push the result downstream.
+    Functions return None to drop an item (e.g. a skipped file).
+    The last queue is drained by the caller via `results()`, so DB writes stay
+    on the caller's thread.
+    """
+
+    def __init__(self, queue_size: int = 64, on_error: Optional[Callable] = None):
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.stopped = threading.Event()
+        # Cleared while paused; stage workers stop pulling new items until it is set again
+        self.running = threading.Event()
+        self.running.set()
+        self._source = None
+        self._stages = []
+        self._threads: List[threading.Thread] = []
+        self._out = queue.Queue(maxsize=queue_size)
+
+    def source(self, iterable: Iterable):
+        self._source = iterable
+        return self
+
+    def stage(self, name: str, fn: Callable, workers: int = 1):
+        self._stages.append(("map", name, fn, max(1, workers), None))
+        return self
+
+    def batch_stage(self, name: str, fn: Callable, batch_size: int, flush_seconds: float):
+        # fn receives a list of items and returns a list of results (None entries are dropped)
+        self._stages.append(("batch", name, fn, 1, (max(1, batch_size), flush_seconds)))
+        return self
+
+    # --- queue helpers that never block forever once the pipeline is stopped ---
+
+    def _put(self, q, item):
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q, timeout=0.2, gated=True):
+        while not self.stopped.is_set():
+            if gated and not self.running.wait(timeout):
+                continue
+            try:
+                return q.get(timeout=timeout)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _fail(self, name, item, exc):
+        if self.on_error:
+            self.on_error(name, item, exc)
+        else:
+            print(f"Pipeline stage '{name}' failed: {exc}")
+
+    # --- stage runners ---
+
+    def _run_source(self, outq):
+        try:
+            for item in self._source:
+                if not self._put(outq, item):
+                    break
+        except Exception as e:
+            self._fail("source", None, e)
+        finally:
+            self._put(outq, _DONE)
+
+    def _run_map(self, name, fn, inq, outq, remaining):
+        while True:
+            item = self._get(inq)
+            if item is _DONE:
+                # Let sibling workers see the sentinel too; the last one forwards it.
+                self._put(inq, _DONE)
+                break
+            try:
+                res = fn(item)
+            except Exception as e:
+                self._fail(name, item, e)
+                continue
+            if res is not None:
+                self._put(outq, res)
+        with remaining["lock"]:
+            remaining["n"] -= 1
+            last = remaining["n"] == 0
+        if last:
+            self._put(outq, _DONE)
+
+    def _run_batch(self, name, fn, inq, outq, batch_size, flush_seconds):
+        done = False
+        while not done:
+            item = self._get(inq)
+            if item is _DONE:
+                break
+            batch = [item]
+            while len(batch) < batch_size:
+                try:
+                    item = inq.get(timeout=flush_seconds)
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    done = True
+                    break
+                batch.append(item)
+            try:
+                results = fn(batch)
+            except Exception as e:
+                self._fail(name, batch, e)
+                continue
+            for res in results:
+                if res is not None:
+                    self._put(outq, res)
+        self._put(outq, _DONE)
+
+    def start(self):
+        inq = queue.Queue(maxsize=self.queue_size)
+        self._spawn("source", self._run_source, inq)
+        for i, (kind, name, fn, workers, opts) in enumerate(self._stages):
+            outq = self._out if i == len(self._stages) - 1 else queue.Queue(maxsize=self.queue_size)
+            if kind == "batch":
+                self._spawn(name, self._run_batch, name, fn, inq, outq, *opts)
+            else:
+                remaining = {"n": workers, "lock": threading.Lock()}
+                for _ in range(workers):
+                    self._spawn(name, self._run_map, name, fn, inq, outq, remaining)
+            inq = outq
+        if not self._stages:
+            self._out = inq
+        return self
+
+    def _spawn(self, name, target, *args):
+        t = threading.Thread(target=target, args=args, name=f"pipeline-{name}", daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def results(self):
+        """Yields finished items until every stage has drained."""
+        try:
+            while True:
+                # Not gated: items already in flight still reach the writer while paused
+                item = self._get(self._out, gated=False)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self.stop()
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.running.set()
+        for t in self._threads:
+            t.join(timeout=5)
@@ -0,0 +1,127 @@
+# app/query_cache.py
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+KINDS = ("expansion", "vector")
+
+
+def cache_key(*parts) -> str:
+    return hashlib.sha1("\x1f".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class QueryCache:
+    """
+    Bounded LRU + TTL cache for LLM query expansions and query vectors.
+    Entries are written through to the mounted DB's `query_cache` table (via the
+    pool's API write connection) so repeated searches stay fast across restarts.
+    `put` runs on the event loop, so it never waits for the write lock: rows that
+    arrive while a scan is committing are written with the next put.
+
+    Keys are built by the caller with `cache_key(...)`, e.g.
+    (query, vision endpoint, vision model) for expansions and
+    (text, embedding model) for vectors.
+    """
+
+    def __init__(self, max_entries: int = 2048, ttl_seconds: float = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # (kind, key) -> (value, created_at)
+        self._lock = threading.Lock()
+        self.pool = None
+        self._unsaved = []
+        self.hits = {k: 0 for k in KINDS}
+        self.misses = {k: 0 for k in KINDS}
+
+    def attach(self, pool):
+        """Switches to a newly mounted DB (a db.ConnectionPool) and warms the LRU with its freshest entries."""
+        with self._lock:
+            self.pool = pool
+            self._entries.clear()
+            self._unsaved = []
+            cutoff = time.time() - self.ttl_seconds
+            try:
+                with pool.write() as conn:
+                    conn.execute("DELETE FROM query_cache WHERE created_at < ?", (cutoff,))
+                    rows = conn.execute(
+                        "SELECT kind, key, value, created_at FROM query_cache ORDER BY created_at DESC LIMIT ?",
+                        (self.max_entries,),
+                    ).fetchall()
+            except Exception as e:
+                print(f"Query cache load failed: {e}")
+                return
+            for kind, key, value, created_at in reversed(rows):
+                self._entries[(kind, key)] = (self._decode(kind, value), created_at)
+
+    @staticmethod
+    def _encode(kind, value):
+        return np.asarray(value, dtype="float32").tobytes() if kind == "vector" else value
+
+    @staticmethod
+    def _decode(kind, value):
+        return np.frombuffer(value, dtype="float32") if kind == "vector" else value
+
+    def get(self, kind, key):
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is not None and time.time() - entry[1] > self.ttl_seconds:
+                del self._entries[(kind, key)]
+                entry = None
+            if entry is None:
+                self.misses[kind] += 1
+                return None
+            self._entries.move_to_end((kind, key))
+            self.hits[kind] += 1
+            return entry[0]
+
+    def put(self, kind, key, value):
+        now = time.time()
+        with self._lock:
+            self._entries[(kind, key)] = (value, now)
+            self._entries.move_to_end((kind, key))
+            self._unsaved.append((kind, key, value, now))
+            while len(self._entries) > self.max_entries:
+                self._unsaved.append(self._entries.popitem(last=False)[0] + (None, None))
+            if self.pool is None:
+                self._unsaved = []
+                return
+            try:
+                with self.pool.write(blocking=False) as conn:
+                    if conn is None:
+                        return
+                    for kind, key, value, created_at in self._unsaved:
+                        if created_at is None:
+                            # Evicted from the LRU
+                            conn.execute("DELETE FROM query_cache WHERE kind=? AND key=?", (kind, key))
+                        else:
+                            conn.execute(
+                                "INSERT OR REPLACE INTO query_cache (kind, key, value, created_at) VALUES (?, ?, ?, ?)",
+                                (kind, key, self._encode(kind, value), created_at),
+                            )
+                self._unsaved = []
+            except Exception as e:
+                self._unsaved = []
+                print(f"Query cache write failed: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._unsaved = []
+            if self.pool is not None:
+                with self.pool.write() as conn:
+                    conn.execute("DELETE FROM query_cache")
+
+    def stats(self):
+        with self._lock:
+            out = {"entries": len(self._entries), "max_entries": self.max_entries, "ttl_seconds": self.ttl_seconds}
+            for kind in KINDS:
+                total = self.hits[kind] + self.misses[kind]
+                out[kind] = {
+                    "hits": self.hits[kind],
+                    "misses": self.misses[kind],
+                    "hit_rate": round(self.hits[kind] / total, 4) if total else 0.0,
+                }
+            return out
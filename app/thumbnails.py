@@ -0,0 +1,125 @@
+# app/thumbnails.py
+import io
+import base64
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps, features
+
+# Edge lengths we serve; requests snap up to the next one
+THUMB_SIZES = (64, 256, 1024)
+# Rendered during the scan from the image it already decoded; 1024 is made on first request
+SCAN_SIZES = (64, 256)
+DEFAULT_SIZE = 256
+DEFAULT_FORMAT = "webp"
+
+# format -> (PIL format, MIME type, quality)
+THUMB_FORMATS = {
+    "webp": ("WEBP", "image/webp", 80),
+    "jpeg": ("JPEG", "image/jpeg", 85),
+}
+if features.check("avif"):
+    THUMB_FORMATS["avif"] = ("AVIF", "image/avif", 60)
+
+
+def snap_size(size: int) -> int:
+    for s in THUMB_SIZES:
+        if size <= s:
+            return s
+    return THUMB_SIZES[-1]
+
+
+def mime_for(fmt: str) -> str:
+    return THUMB_FORMATS[fmt][1]
+
+
+def etag(content_hash: str, size: int, fmt: str) -> str:
+    # Thumbnails are keyed by content hash, so the tag never has to change for the same bytes
+    return f'"{content_hash[:32]}-{size}-{fmt}"'
+
+
+def render(image: Image.Image, size: int, fmt: str = DEFAULT_FORMAT) -> bytes:
+    pil_fmt, _, quality = THUMB_FORMATS[fmt]
+    im = image.copy()
+    im.thumbnail((size, size))
+    buf = io.BytesIO()
+    im.save(buf, format=pil_fmt, quality=quality)
+    return buf.getvalue()
+
+
+def reencode(data: bytes, size: int, fmt: str = DEFAULT_FORMAT) -> bytes:
+    """A stored thumbnail in another format (e.g. legacy JPEGs to the default)."""
+    return render(Image.open(io.BytesIO(data)).convert("RGB"), size, fmt)
+
+
+def render_all(image: Image.Image, sizes=SCAN_SIZES, fmt: str = DEFAULT_FORMAT) -> Dict[Tuple[int, str], bytes]:
+    return {(size, fmt): render(image, size, fmt) for size in sizes}
+
+
+def blank(sizes=SCAN_SIZES, fmt: str = DEFAULT_FORMAT):
+    return render_all(Image.new("RGB", (max(sizes), max(sizes)), (100, 100, 100)), sizes, fmt)
+
+
+STORE_SQL = "INSERT OR REPLACE INTO thumbnails (hash, size, format, data) VALUES (?, ?, ?, ?)"
+
+
+def store_rows(content_hash: str, thumbs: Dict[Tuple[int, str], bytes]):
+    return [(content_hash, size, fmt, data) for (size, fmt), data in thumbs.items()]
+
+
+def store(cur, content_hash: str, thumbs: Dict[Tuple[int, str], bytes]):
+    cur.executemany(STORE_SQL, store_rows(content_hash, thumbs))
+
+
+def _source_image(conn, content_hash: str, path: Optional[str], size: int):
+    # Prefer the original; fall back to the largest stored thumbnail (drive offline, file moved)
+    if path:
+        try:
+            im = Image.open(path)
+            im.draft("RGB", (size, size))
+            return ImageOps.exif_transpose(im).convert("RGB"), True
+        except Exception:
+            pass
+    row = conn.execute(
+        "SELECT data FROM thumbnails WHERE hash=? ORDER BY size DESC LIMIT 1", (content_hash,)
+    ).fetchone()
+    if row:
+        return Image.open(io.BytesIO(row[0])).convert("RGB"), False
+    return None, False
+
+
+def get_thumbnail(conn, content_hash: str, size: int = DEFAULT_SIZE, fmt: str = DEFAULT_FORMAT,
+                  path: Optional[str] = None, write=None) -> Tuple[Optional[bytes], bool]:
+    """
+    Stored thumbnail bytes, rendering and caching the size/format on first request.
+    Reads go through `conn`; a new rendering is stored in a `write()` transaction
+    (e.g. ConnectionPool.write), or on `conn` itself without one.
+    Returns (data, final); final is False for a stand-in upscaled from a smaller thumbnail.
+    """
+    row = conn.execute(
+        "SELECT data FROM thumbnails WHERE hash=? AND size=? AND format=?", (content_hash, size, fmt)
+    ).fetchone()
+    if row:
+        return row[0], True
+    image, original = _source_image(conn, content_hash, path, size)
+    if image is None:
+        return None, False
+    data = render(image, size, fmt)
+    if not original:
+        # Made from a smaller thumbnail; serve it but keep trying the original next time
+        return data, False
+    try:
+        if write is None:
+            store(conn, content_hash, {(size, fmt): data})
+            conn.commit()
+        else:
+            with write() as writer:
+                store(writer, content_hash, {(size, fmt): data})
+    except Exception as e:
+        print(f"Failed to cache thumbnail: {e}")
+    return data, True
+
+
+def data_url(data: Optional[bytes], fmt: str = DEFAULT_FORMAT) -> Optional[str]:
+    if not data:
+        return None
+    return f"data:{mime_for(fmt)};base64," + base64.b64encode(data).decode("utf-8")
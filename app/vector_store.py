@@ -0,0 +1,148 @@
+# app/vector_store.py
+import os
+import json
+from itertools import chain
+
+import numpy as np
+
+from .db import get_meta, vector_log_seq
+
+STORE_FORMAT_VERSION = 1
+STORE_DTYPES = ("float32", "float16", "int8")
+# Embeddings are unit length, so every component is in [-1, 1]
+INT8_SCALE = 127.0
+CHUNK_ROWS = 65536
+
+
+def store_path_for(db_path: str) -> str:
+    # .memory_index.db -> .memory_index.vectors.npy / .ids.npy / .vectors.json
+    return os.path.splitext(db_path)[0] + ".vectors"
+
+
+def quantize(mat, dtype):
+    if dtype == "int8":
+        return np.clip(np.rint(mat * INT8_SCALE), -127, 127).astype("int8")
+    return np.asarray(mat, dtype=dtype)
+
+
+def dequantize(mat):
+    """float32 copy of a (slice of a) stored matrix."""
+    if mat.dtype == np.int8:
+        return mat.astype("float32") / INT8_SCALE
+    return np.ascontiguousarray(mat, dtype="float32")
+
+
+class EmbeddingStore:
+    """
+    Every embedding as one contiguous .npy matrix next to the DB, row-aligned with an
+    int64 array of vec_ids, optionally stored as float16 or int8 (2x / 4x smaller).
+    `load()` memory-maps both files, so a rebuild reads pages straight from disk
+    instead of decoding one BLOB per row.
+
+    The meta file records the vector_log seq the matrix reflects; `sync()` brings it up
+    to date by rewriting only the changed rows, or re-reads the DB when the log was pruned.
+    """
+
+    def __init__(self, base_path: str, dim: int, dtype: str = "float32"):
+        self.base_path = base_path
+        self.dim = dim
+        self.dtype = dtype if dtype in STORE_DTYPES else "float32"
+        self.seq = None
+
+    @property
+    def vectors_path(self):
+        return self.base_path + ".npy"
+
+    @property
+    def ids_path(self):
+        return self.base_path + ".ids.npy"
+
+    @property
+    def meta_path(self):
+        return self.base_path + ".json"
+
+    def load(self, conn):
+        """(ids, matrix) memory-mapped, or None if missing, foreign or in another dtype."""
+        try:
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if (meta.get("version") != STORE_FORMAT_VERSION or meta.get("dim") != self.dim
+                    or meta.get("dtype") != self.dtype or meta.get("db_uuid") != get_meta(conn, "db_uuid")):
+                return None
+            mat = np.load(self.vectors_path, mmap_mode="r")
+            ids = np.load(self.ids_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        if mat.shape != (meta["n"], self.dim) or ids.shape != (meta["n"],):
+            return None
+        self.seq = meta["seq"]
+        return ids, mat
+
+    def _read_rows(self, conn, where="", params=()):
+        """Yields (ids, quantized matrix) chunks straight from the memories table."""
+        c = conn.cursor()
+        c.execute(f"SELECT vec_id, embedding FROM memories WHERE vec_id IS NOT NULL AND length(embedding) = ?{where}",
+                  (self.dim * 4, *params))
+        while True:
+            rows = c.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            ids = np.fromiter((r[0] for r in rows), dtype="int64", count=len(rows))
+            mat = np.frombuffer(b"".join(r[1] for r in rows), dtype="float32").reshape(len(rows), self.dim)
+            yield ids, quantize(mat, self.dtype)
+
+    def _write_tmp(self, parts, n):
+        """Streams (ids, matrix) parts into temporary files; `_commit` swaps them in."""
+        out = np.lib.format.open_memmap(self.vectors_path + ".tmp.npy", mode="w+", dtype=self.dtype, shape=(n, self.dim))
+        out_ids = np.lib.format.open_memmap(self.ids_path + ".tmp.npy", mode="w+", dtype="int64", shape=(n,))
+        pos = 0
+        for ids, mat in parts:
+            out[pos:pos + len(ids)] = mat
+            out_ids[pos:pos + len(ids)] = ids
+            pos += len(ids)
+        out.flush()
+        out_ids.flush()
+
+    def _commit(self, conn, seq, n):
+        # Callers drop their maps of the old files first; Windows refuses to replace a mapped file
+        os.replace(self.vectors_path + ".tmp.npy", self.vectors_path)
+        os.replace(self.ids_path + ".tmp.npy", self.ids_path)
+        meta = {"version": STORE_FORMAT_VERSION, "db_uuid": get_meta(conn, "db_uuid"), "seq": seq,
+                "dim": self.dim, "dtype": self.dtype, "n": n}
+        with open(self.meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(self.meta_path + ".tmp", self.meta_path)
+        self.seq = seq
+
+    def rebuild(self, conn):
+        head = vector_log_seq(conn)
+        n = conn.execute("SELECT COUNT(*) FROM memories WHERE vec_id IS NOT NULL AND length(embedding) = ?",
+                         (self.dim * 4,)).fetchone()[0]
+        self._write_tmp(self._read_rows(conn), n)
+        self._commit(conn, head, n)
+
+    def sync(self, conn):
+        """Up-to-date (ids, matrix), memory-mapped. Rewrites the files only if something changed."""
+        head = vector_log_seq(conn)
+        loaded = self.load(conn)
+        if loaded is not None and self.seq == head:
+            return loaded
+        if loaded is not None and self.seq >= int(get_meta(conn, "log_pruned_seq", 0)):
+            ids, mat = loaded
+            changed = np.array([r[0] for r in conn.execute(
+                "SELECT DISTINCT vec_id FROM vector_log WHERE seq > ? AND seq <= ?", (self.seq, head))], dtype="int64")
+            keep = ~np.isin(ids, changed)
+            fresh = []
+            for i in range(0, len(changed), 500):
+                chunk = changed[i:i + 500].tolist()
+                fresh += list(self._read_rows(conn, f" AND vec_id IN ({','.join('?' * len(chunk))})", chunk))
+            kept_parts = ((ids[i:i + CHUNK_ROWS][keep[i:i + CHUNK_ROWS]], mat[i:i + CHUNK_ROWS][keep[i:i + CHUNK_ROWS]])
+                          for i in range(0, len(ids), CHUNK_ROWS))
+            n = int(keep.sum()) + sum(len(f[0]) for f in fresh)
+            self._write_tmp(chain(kept_parts, fresh), n)
+            del ids, mat, loaded, kept_parts
+            self._commit(conn, head, n)
+        else:
+            self.rebuild(conn)
+        return self.load(conn)
+
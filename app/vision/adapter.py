@@ -1,135 +1,363 @@
+import io
 import json
+import time
 import base64
+import hashlib
+import random
+import asyncio
+import mimetypes
+import threading
+from collections import deque
 import httpx
+from PIL import Image, ImageOps
 from typing import Optional, Dict, Any
 from .contract import VisionOutput
 
+# Responses worth retrying: rate limiting and transient server errors
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# image_format setting -> (PIL format, MIME type)
+IMAGE_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+# Structured prompt enforcing JSON
+SYSTEM_PROMPT = (
+    "You are a visual memory assistant. Analyze the image and return a STRICT JSON object. "
+    "Do not include markdown formatting (like ```json). "
+    "The JSON must have these keys: "
+    "summary (1 sentence), description (detailed), activity, setting, social_context, "
+    "objects (list of strings), people_count (int), text_content (if any visible text), "
+    "weather (if outdoor), time_of_day."
+)
+USER_PROMPT = "Analyze this image."
+# Cached vision results are only reused for the same prompt (see analysis_cache.py)
+PROMPT_HASH = hashlib.sha1(f"{SYSTEM_PROMPT}\n{USER_PROMPT}".encode("utf-8")).hexdigest()[:16]
+
+
+def encode_for_vision(image_path: str, max_edge: int = 1024, image_format: str = "jpeg", quality: int = 85):
+    """
+    Downscales an image file to `max_edge` and re-encodes it. Returns (bytes, mime).
+    Local vision models resize to a few hundred px anyway; sending the original only costs upload and preprocessing.
+    """
+    fmt, mime = IMAGE_FORMATS.get(image_format, IMAGE_FORMATS["jpeg"])
+    with Image.open(image_path) as im:
+        im.draft("RGB", (max_edge, max_edge))
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        im.thumbnail((max_edge, max_edge))
+        buf = io.BytesIO()
+        im.save(buf, format=fmt, quality=quality)
+    return buf.getvalue(), mime
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint after `failure_threshold` consecutive failures.
+    Once `reset_seconds` have passed a single probe call is let through: success
+    closes the circuit, another failure keeps it open for `reset_seconds` more.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_seconds: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.reset_seconds else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok: bool):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.failures = 0
+                self._opened_at = None
+                return
+            self.failures += 1
+            if self._opened_at is not None or self.failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    self.trips += 1
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures,
+                    "trips": self.trips, "rejected": self.rejected}
+
 class VisionAdapter:
-    def __init__(self, endpoint_url: str, model_name: str, api_key: str = "lm-studio"):
+    """
+    Long-lived client for an OpenAI-compatible vision endpoint.
+    Owns one event loop (on a background thread) and one httpx connection pool,
+    so a whole scan reuses connections. In-flight requests are capped by a
+    semaphore sized to the server's parallel slots.
+    """
+
+    prompt_hash = PROMPT_HASH
+
+    def __init__(self, endpoint_url: str, model_name: str, api_key: str = "lm-studio",
+                 max_concurrency: int = 4, max_retries: int = 3, backoff: float = 0.5,
+                 max_edge: int = 1024, image_format: str = "jpeg", quality: int = 85):
         self.endpoint_url = endpoint_url.rstrip('/')
         self.model_name = model_name
         self.api_key = api_key
+        self.max_concurrency = max(1, int(max_concurrency or 1))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_edge = max(64, int(max_edge or 1024))
+        self.image_format = image_format if image_format in IMAGE_FORMATS else "jpeg"
+        self.quality = max(1, min(100, int(quality or 85)))
+        # One entry per image request: payload size, encode and round-trip time
+        self.metrics = deque(maxlen=1000)
+        # Requests queued for or holding a semaphore slot
+        self.in_flight = 0
         # Check if it's Ollama or OpenAI compatible
         self.is_ollama = "ollama" in self.endpoint_url or "localhost:11434" in self.endpoint_url
 
-    async def analyze_image(self, image_path: str) -> Optional[VisionOutput]:
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._start_lock = threading.Lock()
+
+    # --- loop / client lifecycle ---
+
+    def _ensure_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=loop.run_forever, name="vision-adapter", daemon=True)
+                self._thread.start()
+                self._loop = loop
+                asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+        return self._loop
+
+    async def _open(self):
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        self._client = httpx.AsyncClient(timeout=60.0, limits=limits)
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+
+    def submit(self, coro):
+        """Schedules a coroutine on the adapter's loop; returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    async def _dispatch(self, coro):
+        # Callers on another loop (e.g. FastAPI's) hop onto ours; the client is bound to it
+        loop = self._ensure_loop()
+        try:
+            if asyncio.get_running_loop() is loop:
+                return await coro
+        except RuntimeError:
+            pass
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    def close(self):
+        with self._start_lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), loop).result(timeout=5)
+        except Exception:
+            pass
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(timeout=5)
+        loop.close()
+
+    def _headers(self):
+        headers = {"Content-Type": "application/json"}
+        if self.api_key and self.api_key.strip():
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    async def _post(self, payload: Dict[str, Any], timeout: float = 60.0, retries: Optional[int] = None):
+        """
+        POST to /v1/chat/completions through the shared pool, holding a semaphore slot.
+        Retries 429/5xx and transport errors with exponential backoff (honours Retry-After).
+        """
+        url = f"{self.endpoint_url}/v1/chat/completions"
+        retries = self.max_retries if retries is None else retries
+        attempt = 0
+        while True:
+            delay = self.backoff * (2 ** attempt) * (1 + random.random() * 0.25)
+            self.in_flight += 1
+            try:
+                async with self._sem:
+                    response = await self._client.post(url, headers=self._headers(), json=payload, timeout=timeout)
+                if response.status_code not in RETRY_STATUS or attempt >= retries:
+                    return response
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+            except httpx.TransportError:
+                if attempt >= retries:
+                    raise
+            finally:
+                self.in_flight -= 1
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    # --- public API ---
+
+    def saturated(self) -> bool:
+        """True while every parallel slot of the endpoint is taken by this adapter."""
+        return self.in_flight >= self.max_concurrency
+
+    def encode_options(self):
+        """(max_edge, PIL format, mime, quality) so the scan can build the vision copy from its own decode."""
+        fmt, mime = IMAGE_FORMATS[self.image_format]
+        return self.max_edge, fmt, mime, self.quality
+
+    async def analyze_image(self, image_path: str, image_bytes: Optional[bytes] = None,
+                            mime: str = "image/jpeg", encode_ms: float = 0.0) -> Optional[VisionOutput]:
+        return await self._dispatch(self._analyze_image(image_path, image_bytes, mime, encode_ms))
+
+    def analyze_image_sync(self, image_path: str, image_bytes: Optional[bytes] = None,
+                           mime: str = "image/jpeg", encode_ms: float = 0.0) -> Optional[VisionOutput]:
+        """Blocking variant for worker threads (e.g. the scan pipeline)."""
+        return self.submit(self._analyze_image(image_path, image_bytes, mime, encode_ms)).result()
+
+    def stats(self):
+        """Aggregates of the recorded image requests."""
+        m = list(self.metrics)
+        if not m:
+            return {"requests": 0}
+        payload = sorted(x["payload_bytes"] for x in m)
+        return {
+            "requests": len(m),
+            "failed": sum(1 for x in m if not x["ok"]),
+            "payload_kb_mean": round(sum(payload) / len(m) / 1024, 1),
+            "payload_kb_p95": round(payload[int(0.95 * (len(m) - 1))] / 1024, 1),
+            "encode_ms_mean": round(sum(x["encode_ms"] for x in m) / len(m), 2),
+            "request_ms_mean": round(sum(x["request_ms"] for x in m) / len(m), 1),
+            "max_edge": self.max_edge,
+            "image_format": self.image_format,
+            "quality": self.quality,
+        }
+
+    async def expand_query(self, query: str) -> Optional[str]:
+        return await self._dispatch(self._expand_query(query))
+
+    async def _analyze_image(self, image_path: str, image_bytes: Optional[bytes] = None,
+                             mime: str = "image/jpeg", encode_ms: float = 0.0) -> Optional[VisionOutput]:
         """
         Sends image to LLM and returns structured VisionOutput.
+        `image_bytes` is a copy the scan already prepared with `encode_options()`;
+        without it the file at `image_path` is downscaled and re-encoded here.
         Returns None if analysis fails.
         """
+        metric = {"path": image_path, "payload_bytes": 0, "encode_ms": encode_ms, "request_ms": 0.0, "ok": False}
+        self.metrics.append(metric)
         try:
-            with open(image_path, "rb") as img_file:
-                base64_image = base64.b64encode(img_file.read()).decode("utf-8")
-
-            # Structured prompt enforcing JSON
-            system_prompt = (
-                "You are a visual memory assistant. Analyze the image and return a STRICT JSON object. "
-                "Do not include markdown formatting (like ```json). "
-                "The JSON must have these keys: "
-                "summary (1 sentence), description (detailed), activity, setting, social_context, "
-                "objects (list of strings), people_count (int), text_content (if any visible text), "
-                "weather (if outdoor), time_of_day."
-            )
-
-            user_prompt = "Analyze this image."
-
-            payload = self._build_payload(base64_image, system_prompt, user_prompt)
-
-            # Using httpx for async
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                url = f"{self.endpoint_url}/v1/chat/completions"
-                # Handle Ollama specific path if needed, but Ollama now supports /v1/chat/completions
-
-                headers = {"Content-Type": "application/json"}
-                if self.api_key and self.api_key.strip():
-                    headers["Authorization"] = f"Bearer {self.api_key}"
-
-                response = await client.post(
-                    url,
-                    headers=headers,
-                    json=payload
-                )
+            if image_bytes is None:
+                t0 = time.perf_counter()
+                try:
+                    image_bytes, mime = await asyncio.to_thread(
+                        encode_for_vision, image_path, self.max_edge, self.image_format, self.quality)
+                except Exception as e:
+                    # Not decodable by PIL: send the file as is, labelled with its real type
+                    print(f"Vision re-encode failed for {image_path}: {e}")
+                    with open(image_path, "rb") as img_file:
+                        image_bytes = img_file.read()
+                    mime = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+                metric["encode_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            base64_image = base64.b64encode(image_bytes).decode("utf-8")
+            metric["payload_bytes"] = len(base64_image)
 
-                if response.status_code != 200:
-                    print(f"Vision API Error: {response.status_code} - {response.text}")
-                    return None
+            payload = self._build_payload(base64_image, SYSTEM_PROMPT, USER_PROMPT, mime)
 
-                data = response.json()
-                content = data["choices"][0]["message"]["content"]
-
-                # Cleanup potential markdown code blocks
-                if "```json" in content:
-                    content = content.split("```json")[1].split("```")[0].strip()
-                elif "```" in content:
-                    content = content.split("```")[1].strip()
-                
-                # Regex fallback if it's still not valid JSON or has leading/trailing text
-                import re
-                json_match = re.search(r'\{.*\}', content, re.DOTALL)
-                if json_match:
-                    content = json_match.group(0)
+            # Handle Ollama specific path if needed, but Ollama now supports /v1/chat/completions
+            t0 = time.perf_counter()
+            response = await self._post(payload)
+            metric["request_ms"] = round((time.perf_counter() - t0) * 1000, 1)
 
-                try:
-                    json_data = json.loads(content)
-                    return VisionOutput(**json_data)
-                except json.JSONDecodeError:
-                    print(f"Failed to decode JSON from LLM. Falling back to raw text.")
-                    # Fallback: Use the raw content as the description
-                    return VisionOutput(
-                        summary=content[:2000],
-                        description=content,
-                        activity="Unknown",
-                        setting="Unknown",
-                        social_context="Unknown",
-                        objects=[],
-                        people_count=0,
-                        text_content=None,
-                        weather="Unknown",
-                        time_of_day="Unknown"
-                    )
-                except Exception as e:
-                    print(f"Validation error: {e}")
-                    return None
+            if response.status_code != 200:
+                print(f"Vision API Error: {response.status_code} - {response.text}")
+                return None
+
+            data = response.json()
+            content = data["choices"][0]["message"]["content"]
+            metric["ok"] = True
+
+            # Cleanup potential markdown code blocks
+            if "```json" in content:
+                content = content.split("```json")[1].split("```")[0].strip()
+            elif "```" in content:
+                content = content.split("```")[1].strip()
+
+            # Regex fallback if it's still not valid JSON or has leading/trailing text
+            import re
+            json_match = re.search(r'\{.*\}', content, re.DOTALL)
+            if json_match:
+                content = json_match.group(0)
+
+            try:
+                json_data = json.loads(content)
+                return VisionOutput(**json_data)
+            except json.JSONDecodeError:
+                print(f"Failed to decode JSON from LLM. Falling back to raw text.")
+                # Fallback: Use the raw content as the description
+                return VisionOutput(
+                    summary=content[:2000],
+                    description=content,
+                    activity="Unknown",
+                    setting="Unknown",
+                    social_context="Unknown",
+                    objects=[],
+                    people_count=0,
+                    text_content=None,
+                    weather="Unknown",
+                    time_of_day="Unknown"
+                )
+            except Exception as e:
+                print(f"Validation error: {e}")
+                return None
 
         except Exception as e:
             print(f"Vision Adapter Error: {e}")
             return None
 
-    async def expand_query(self, query: str) -> str:
+    async def _expand_query(self, query: str) -> Optional[str]:
         """
         Expands a short query into a descriptive scene sentence using the LLM.
+        Returns None if the endpoint failed, so callers can tell an outage from a no-op rewrite.
         """
         try:
-             async with httpx.AsyncClient(timeout=10.0) as client:
-                url = f"{self.endpoint_url}/v1/chat/completions"
-                payload = {
-                    "model": self.model_name,
-                    "messages": [
-                        {"role": "system", "content": "You are a keyword optimizer. Convert the user's query into a list of relevant visual keywords and synonyms. Output ONLY the keywords. Do not use full sentences. Do not explain. Example: 'wearing a suit' -> 'suit, formal wear, tuxedo, blazer, business attire, standing man'."},
-                        {"role": "user", "content": f"Query: {query}"}
-                    ],
-                    "temperature": 0.0,
-                    "max_tokens": 40
-                }
-
-                headers = {"Content-Type": "application/json"}
-                if self.api_key and self.api_key.strip():
-                    headers["Authorization"] = f"Bearer {self.api_key}"
+            payload = {
+                "model": self.model_name,
+                "messages": [
+                    {"role": "system", "content": "You are a keyword optimizer. Convert the user's query into a list of relevant visual keywords and synonyms. Output ONLY the keywords. Do not use full sentences. Do not explain. Example: 'wearing a suit' -> 'suit, formal wear, tuxedo, blazer, business attire, standing man'."},
+                    {"role": "user", "content": f"Query: {query}"}
+                ],
+                "temperature": 0.0,
+                "max_tokens": 40
+            }
 
-                response = await client.post(
-                    url,
-                    headers=headers,
-                    json=payload
-                )
+            # Interactive path: short timeout and no retries
+            response = await self._post(payload, timeout=10.0, retries=0)
 
-                if response.status_code == 200:
-                    data = response.json()
-                    return data["choices"][0]["message"]["content"].strip()
-                return query
+            if response.status_code == 200:
+                data = response.json()
+                return data["choices"][0]["message"]["content"].strip()
+            return None
         except Exception:
-            return query
+            return None
 
-    def _build_payload(self, base64_image, system_prompt, user_prompt):
+    def _build_payload(self, base64_image, system_prompt, user_prompt, mime="image/jpeg"):
         # OpenAI / LocalAI standard format
         return {
             "model": self.model_name,
@@ -145,7 +373,7 @@ class VisionAdapter:
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
+                                "url": f"data:{mime};base64,{base64_image}"
                             }
                         }
                     ]
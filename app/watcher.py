@@ -0,0 +1,152 @@
+# app/watcher.py
+import os
+import time
+import threading
+from pathlib import Path
+from typing import Callable, Set
+
+from .indexer import SUPPORTED_EXT, walk_images
+
+try:
+    # inotify on Linux, FSEvents on macOS, ReadDirectoryChangesW on Windows
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# Polling walks the tree at most 1/POLL_DUTY of the time
+POLL_DUTY = 50
+
+
+def _is_image(path) -> bool:
+    return os.path.splitext(str(path))[1].lower() in SUPPORTED_EXT
+
+
+class _Handler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        if event.event_type == "moved":
+            self.watcher.record(event.src_path, deleted=True)
+            self.watcher.record(event.dest_path)
+        elif event.event_type == "deleted":
+            self.watcher.record(event.src_path, deleted=True)
+        elif event.event_type in ("created", "modified", "closed"):
+            self.watcher.record(event.src_path)
+
+
+class DirectoryWatcher:
+    """
+    Watches a mounted drive and hands debounced batches of changed and deleted
+    image paths to `on_changes(changed, deleted)`.
+
+    Uses watchdog's native events. Without them it polls the tree comparing
+    (size, mtime_ns), at least `poll_interval` seconds apart and never spending more
+    than 1/POLL_DUTY of the time walking, so a large drive is polled less often. A batch is flushed once
+    no event arrived for `debounce` seconds, or after `max_delay` while a copy
+    keeps producing events.
+    """
+
+    def __init__(self, root: str, on_changes: Callable[[Set[str], Set[str]], None],
+                 debounce: float = 2.0, max_delay: float = 15.0, poll_interval: float = 30.0):
+        self.root = str(root)
+        self.on_changes = on_changes
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self._interval = poll_interval
+        self.mode = "inotify" if Observer is not None else "polling"
+        self._changed = set()
+        self._deleted = set()
+        self._first = None
+        self._last = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._observer = None
+        self._threads = []
+
+    def record(self, path, deleted=False):
+        path = str(path)
+        if not _is_image(path):
+            return
+        with self._lock:
+            if deleted:
+                self._changed.discard(path)
+                self._deleted.add(path)
+            else:
+                self._deleted.discard(path)
+                self._changed.add(path)
+            now = time.monotonic()
+            self._first = self._first or now
+            self._last = now
+
+    def start(self):
+        if self._observer is None and Observer is not None:
+            try:
+                self._observer = Observer()
+                self._observer.schedule(_Handler(self), self.root, recursive=True)
+                self._observer.start()
+            except Exception as e:
+                # e.g. inotify watch limit reached on a huge tree
+                print(f"Native file watching unavailable ({e}); polling instead")
+                self._observer = None
+                self.mode = "polling"
+        if self._observer is None:
+            self._spawn("watch-poll", self._poll)
+        self._spawn("watch-flush", self._flush_loop)
+        print(f"Watching {self.root} ({self.mode})")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join(timeout=5)
+        for t in self._threads:
+            t.join(timeout=5)
+
+    def _spawn(self, name, target):
+        t = threading.Thread(target=target, name=name, daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def _snapshot(self):
+        return {str(fs.path): (fs.size, fs.mtime_ns) for fs in walk_images(Path(self.root))}
+
+    def _timed_snapshot(self):
+        t0 = time.monotonic()
+        snap = self._snapshot()
+        # Walking 100k files takes seconds; the wait grows with the tree
+        self._interval = max(self.poll_interval, (time.monotonic() - t0) * POLL_DUTY)
+        return snap
+
+    def _poll(self):
+        before = self._timed_snapshot()
+        while not self._stop.wait(self._interval):
+            after = self._timed_snapshot()
+            for path, st in after.items():
+                if before.get(path) != st:
+                    self.record(path)
+            for path in before.keys() - after.keys():
+                self.record(path, deleted=True)
+            before = after
+
+    def _flush_loop(self):
+        while not self._stop.wait(0.5):
+            with self._lock:
+                if self._last is None:
+                    continue
+                now = time.monotonic()
+                if now - self._last < self.debounce and now - self._first < self.max_delay:
+                    continue
+                changed, deleted = self._changed, self._deleted
+                self._changed, self._deleted = set(), set()
+                self._first = self._last = None
+            try:
+                self.on_changes(changed, deleted)
+            except Exception as e:
+                print(f"Watcher failed to index changes: {e}")
@@ -0,0 +1,106 @@
+# app/writer.py
+import time
+import threading
+from typing import Callable, List, Optional
+
+# Seconds between passive WAL checkpoints while a scan keeps writing
+CHECKPOINT_SECONDS = 30.0
+
+
+class BatchWriter:
+    """
+    Groups the scan's writes into one transaction per `max_rows` units or
+    `max_seconds`, instead of a commit (and WAL fsync) per photo.
+
+    A unit is the list of writes for one item: (sql, params) tuples, run as one
+    executemany per distinct statement across the batch, and callables taking the
+    cursor for writes that need reads in between. `on_commit` runs once the unit
+    is durable; if the batch fails it is replayed unit by unit, so one bad row only
+    fails its own unit (`on_fail`).
+    `lock` is held for each transaction; share it with anything else that writes
+    to the same database.
+    """
+
+    def __init__(self, conn, max_rows: int = 256, max_seconds: float = 2.0,
+                 checkpoint_seconds: float = CHECKPOINT_SECONDS, lock=None):
+        self.conn = conn
+        self.lock = lock or threading.Lock()
+        self.cur = conn.cursor()
+        self.max_rows = max(1, max_rows)
+        self.max_seconds = max_seconds
+        self.checkpoint_seconds = checkpoint_seconds
+        self.units = []
+        self._oldest = None
+        self._last_checkpoint = time.monotonic()
+
+    def add(self, writes: List, on_commit: Optional[Callable] = None, on_fail: Optional[Callable] = None):
+        self.units.append((writes, on_commit, on_fail))
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def due(self) -> bool:
+        return bool(self.units) and (len(self.units) >= self.max_rows
+                                     or time.monotonic() - self._oldest >= self.max_seconds)
+
+    def _run(self, units):
+        grouped = {}
+        calls = []
+        for writes, _, _ in units:
+            for w in writes:
+                if callable(w):
+                    calls.append(w)
+                else:
+                    grouped.setdefault(w[0], []).append(w[1])
+        with self.lock:
+            try:
+                # Statements keep the order they first appeared in, so inserts precede dependent updates
+                for sql, rows in grouped.items():
+                    self.cur.executemany(sql, rows)
+                for fn in calls:
+                    fn(self.cur)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def flush(self):
+        units, self.units, self._oldest = self.units, [], None
+        try:
+            self._run(units)
+            done = units
+        except Exception as e:
+            if len(units) == 1:
+                print(f"Write failed: {e}")
+                done = []
+                failed = units
+            else:
+                # Find the offending rows; everything else still lands
+                done, failed = [], []
+                for unit in units:
+                    try:
+                        self._run([unit])
+                        done.append(unit)
+                    except Exception as e:
+                        print(f"Write failed: {e}")
+                        failed.append(unit)
+            for _, _, on_fail in failed:
+                if on_fail:
+                    on_fail()
+        for _, on_commit, _ in done:
+            if on_commit:
+                on_commit()
+        self._maybe_checkpoint()
+
+    def _maybe_checkpoint(self, force=False):
+        # Keeps the WAL from growing for the whole scan; PASSIVE never waits on readers
+        if force or time.monotonic() - self._last_checkpoint >= self.checkpoint_seconds:
+            try:
+                with self.lock:
+                    self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            except Exception as e:
+                print(f"WAL checkpoint failed: {e}")
+            self._last_checkpoint = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._maybe_checkpoint(force=True)
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { Brain, LayoutGrid, Clock, BookOpen, ListChecks, Settings, X, Search } from 'lucide-react';
 import { DriveSelector } from './components/DriveSelector';
 import { ScanControls } from './components/ScanControls';
@@ -32,6 +32,7 @@ function App() {
   // Filters
   const [dateFilters, setDateFilters] = useState<{ from?: string, to?: string }>({});
   const [lastQuery, setLastQuery] = useState('');
+  const searchCounter = useRef(0);
 
   // Initial Health Check
   useEffect(() => {
@@ -76,10 +77,15 @@ function App() {
 
     setLoading(true);
     setLastQuery(query);
+    const searchId = ++searchCounter.current;
     try {
-      const res = await memoryApi.searchMemories(query, 50, from, to);
-      setSearchResults(res.results);
-      setIsSearchActive(true);
+      // Vector hits show immediately; the refined ranking replaces them when the LLM answers
+      await memoryApi.searchMemoriesStream(query, (phase) => {
+        if (searchId !== searchCounter.current) return;
+        setSearchResults(phase.results);
+        setIsSearchActive(true);
+        setLoading(false);
+      }, 50, from, to);
     } catch (err) {
       console.error(err);
       alert('Search failed. Ensure backend is running.');
@@ -325,8 +331,11 @@ function App() {
           memoryId={selectedMemoryId}
           thumbnailB64={
             // Try to find thumb in search results OR main memories
-            searchResults.find(m => m.file_id === selectedMemoryId)?.thumbnail_b64 ||
-            memories.find(m => m.file_id === selectedMemoryId)?.thumbnail_b64
+            memoryApi.thumbnailSrc(
+              searchResults.find(m => m.file_id === selectedMemoryId) ||
+              memories.find(m => m.file_id === selectedMemoryId) ||
+              { file_id: selectedMemoryId, path: '' }
+            )
           }
           onClose={() => setSelectedMemoryId(null)}
         />
@@ -11,7 +11,12 @@ export interface Memory {
   vision_status?: string;
   exif_date?: string;
   thumbnail_b64?: string;
+  thumbnail_url?: string;
+  match?: 'vector' | 'keyword' | 'both';
   created_at?: string;
+  copies?: number;
+  cluster_id?: string;
+  cluster_size?: number;
 }
 
 export interface MemoryDetail {
@@ -27,10 +32,22 @@ export interface MemoryDetail {
   tags: string;
   vision_json?: string;
   vision_status?: string;
+  paths?: string[];
 }
 
 export interface SearchResponse {
   results: Memory[];
+  next_cursor?: string | null;
+}
+
+// One line of /search/stream: 'initial' (vector hits for the raw query), then 'refined'
+export interface SearchPhase {
+  phase: 'initial' | 'refined';
+  final?: boolean;
+  query: string;
+  expanded_query?: string;
+  results: Memory[];
+  elapsed_ms: number;
 }
 
 export interface ScanResponse {
@@ -50,6 +67,10 @@ export interface VisionConfig {
   endpoint_url: string;
   model_name: string;
   api_key?: string;
+  max_concurrency?: number;
+  max_edge?: number;
+  image_format?: 'jpeg' | 'webp';
+  quality?: number;
 }
 
 export interface ConfigTestResponse {
@@ -103,8 +124,44 @@ export const memoryApi = {
     return res.json();
   },
 
-  async getRecentMemories(limit: number = 50, offset: number = 0): Promise<SearchResponse> {
-    const res = await fetch(`${API_BASE}/memories?limit=${limit}&offset=${offset}`);
+  // Streams search phases; onPhase runs for each, the last call has final: true
+  async searchMemoriesStream(
+    query: string,
+    onPhase: (phase: SearchPhase) => void,
+    top_k: number = 12,
+    date_from?: string,
+    date_to?: string,
+  ): Promise<void> {
+    const res = await fetch(`${API_BASE}/search/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ query, top_k, date_from, date_to }),
+    });
+    if (!res.ok || !res.body) {
+      const err = await res.json();
+      throw new Error(err.detail || 'Search failed');
+    }
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    for (;;) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      let newline;
+      while ((newline = buffer.indexOf('\n')) >= 0) {
+        const line = buffer.slice(0, newline).trim();
+        buffer = buffer.slice(newline + 1);
+        if (line) onPhase(JSON.parse(line));
+      }
+    }
+  },
+
+  // Keyset paging: pass the previous page's next_cursor to continue
+  async getRecentMemories(limit: number = 50, cursor?: string | null): Promise<SearchResponse> {
+    const params = new URLSearchParams({ limit: String(limit) });
+    if (cursor) params.set('cursor', cursor);
+    const res = await fetch(`${API_BASE}/memories?${params}`);
     if (!res.ok) {
       const err = await res.json();
       throw new Error(err.detail || 'Failed to fetch memories');
@@ -125,6 +182,13 @@ export const memoryApi = {
     return `${API_BASE}/thumbnail/${file_id}`;
   },
 
+  // Inline base64 when the backend sent it, otherwise the cached /thumbnail URL
+  thumbnailSrc(memory: Memory): string | undefined {
+    if (memory.thumbnail_b64) return memory.thumbnail_b64;
+    if (memory.thumbnail_url) return `${API_BASE}${memory.thumbnail_url}`;
+    return undefined;
+  },
+
   // --- Vision Config ---
 
   async getVisionConfig(): Promise<VisionConfig> {
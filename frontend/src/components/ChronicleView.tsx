@@ -1,5 +1,5 @@
 import React from 'react';
-import { type Memory } from '../api/memoryApi';
+import { type Memory, memoryApi } from '../api/memoryApi';
 import { ArrowRight, BookOpen } from 'lucide-react';
 import { format } from 'date-fns';
 
@@ -49,8 +49,8 @@ export const ChronicleView: React.FC<ChronicleViewProps> = ({ selectedMemories,
 
             {/* Image */}
             <div className="w-20 h-20 flex-shrink-0 bg-gray-100 rounded-md overflow-hidden border border-gray-200 relative z-10">
-               {mem.thumbnail_b64 ? (
-                 <img src={mem.thumbnail_b64} className="w-full h-full object-cover" />
+               {memoryApi.thumbnailSrc(mem) ? (
+                 <img src={memoryApi.thumbnailSrc(mem)} className="w-full h-full object-cover" />
                ) : (
                  <div className="w-full h-full bg-gray-200" />
                )}
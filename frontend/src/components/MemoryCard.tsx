@@ -1,5 +1,5 @@
 import React from 'react';
-import { type Memory } from '../api/memoryApi';
+import { type Memory, memoryApi } from '../api/memoryApi';
 import { ImageIcon, CheckCircle, EyeOff } from 'lucide-react';
 import clsx from 'clsx';
 import { format } from 'date-fns';
@@ -20,6 +20,7 @@ export const MemoryCard: React.FC<MemoryCardProps> = ({ memory, onClick, selecte
     : [];
 
   const isVisionFailed = memory.vision_status === 'failed';
+  const thumbSrc = memoryApi.thumbnailSrc(memory);
 
   return (
     <div
@@ -33,9 +34,9 @@ export const MemoryCard: React.FC<MemoryCardProps> = ({ memory, onClick, selecte
     >
       {/* Thumbnail */}
       <div className="relative aspect-square bg-gray-100 overflow-hidden">
-        {memory.thumbnail_b64 ? (
+        {thumbSrc ? (
           <img
-            src={memory.thumbnail_b64}
+            src={thumbSrc}
             alt={memory.summary || "Memory"}
             className={clsx(
               "w-full h-full object-cover transition-transform duration-300",
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from app.db import init_db
+from app.faiss_mgr import FaissManager, IndexConfig
+
+DIM = 16
+N = 400
+
+
+def make_manager(kind):
+    config = IndexConfig(index_type=kind, train_threshold=100, nlist=8, pq_m=4, hnsw_m=8)
+    mgr = FaissManager(DIM, config)
+    mat = np.random.default_rng(0).random((N, DIM), dtype=np.float32)
+    mgr._build(np.arange(1, N + 1), mat)
+    assert mgr.kind == kind
+    return mgr, mat
+
+
+@pytest.mark.parametrize("kind", ["flat", "hnsw", "ivf_flat", "ivf_pq", "sq8", "sq_fp16"])
+def test_remove_twice_then_search(kind):
+    mgr, mat = make_manager(kind)
+    assert mgr.remove([10]) == 1
+    assert mgr.remove([11]) == 1
+    mgr.update([12], mat[12:13])
+    assert mgr.count() == N - 2
+    hits = [h["vec_id"] for h in mgr.search(mat[9], topk=20)]
+    assert hits and 10 not in hits and 11 not in hits
+    assert set(mgr.ids()) == set(range(1, N + 1)) - {10, 11}
+
+
+@pytest.mark.parametrize("kind", ["ivf_flat", "ivf_pq"])
+def test_remove_from_mapped_ivf(kind, tmp_path):
+    conn = init_db(str(tmp_path / "lib.db"))
+    path = str(tmp_path / "lib.faiss")
+    mgr, mat = make_manager(kind)
+    mgr.save(path, conn)
+
+    loaded = FaissManager(DIM, mgr.config)
+    assert loaded.load(path, conn)
+    assert loaded.mapped_path == path
+    assert loaded.remove([10]) == 1
+    assert loaded.remove([11]) == 1
+    assert loaded.mapped_path is None
+    hits = [h["vec_id"] for h in loaded.search(mat[9], topk=20)]
+    assert hits and 10 not in hits and 11 not in hits
+    conn.close()
+
+
+def test_save_skips_unchanged_index(tmp_path):
+    conn = init_db(str(tmp_path / "lib.db"))
+    path = str(tmp_path / "lib.faiss")
+    mgr, mat = make_manager("flat")
+    assert mgr.save(path, conn)
+    assert not mgr.save(path, conn)
+
+    loaded = FaissManager(DIM, mgr.config)
+    assert loaded.load(path, conn)
+    assert not loaded.save(path, conn)
+    assert loaded.mapped_path == path
+
+    loaded.reset()
+    assert loaded.save(path, conn)
+    conn.close()